@@ -0,0 +1,120 @@
+"""
+Activity Feed Utilities
+Keeps the denormalised ActivityEntry timeline in step with attendance,
+balance adjustments, payments and salary payments
+"""
+import datetime
+from django.utils import timezone
+from .models import ActivityEntry, AttendanceRecord, BalanceAdjustment, PaymentRecord, SalaryPayment
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _attendance_activity(record):
+    occurred_at = timezone.make_aware(
+        datetime.datetime.combine(record.date, record.check_in_time),
+        timezone=timezone.get_current_timezone()
+    )
+    event_name = record.event_fk.name if record.event_fk_id else "Not specified"
+    return occurred_at, f"{event_name} - {record.overtime_hours} hrs OT", record.amount_paid
+
+
+def _adjustment_activity(adjustment):
+    return adjustment.date, adjustment.reason, adjustment.amount
+
+
+def _payment_activity(payment):
+    return payment.payment_date, f"Marked payment via {payment.get_payment_method_display()}", -payment.amount
+
+
+def _salary_activity(payment):
+    return payment.paid_at, f"Salary for {payment.month_year:%B %Y}", payment.total_amount
+
+
+# Model -> (activity type, function giving the row's occurred_at, summary and signed amount)
+ACTIVITY_SOURCES = {
+    AttendanceRecord: ('attendance', _attendance_activity),
+    BalanceAdjustment: ('adjustment', _adjustment_activity),
+    PaymentRecord: ('payment', _payment_activity),
+    SalaryPayment: ('salary', _salary_activity),
+}
+
+
+def build_activity(instance):
+    """Unsaved ActivityEntry describing instance"""
+    activity_type, describe = ACTIVITY_SOURCES[type(instance)]
+    occurred_at, summary, amount = describe(instance)
+    return ActivityEntry(
+        user_id=instance.user_id,
+        activity_type=activity_type,
+        source_id=instance.pk,
+        occurred_at=occurred_at,
+        summary=(summary or '')[:255],
+        amount=amount or 0
+    )
+
+
+def record_activity(instance, created=False):
+    """Insert the feed entry for a new row, or refresh it in place for an edited one"""
+    entry = build_activity(instance)
+    if not created:
+        updated = ActivityEntry.objects.filter(
+            activity_type=entry.activity_type,
+            source_id=entry.source_id
+        ).update(occurred_at=entry.occurred_at, summary=entry.summary, amount=entry.amount)
+        if updated:
+            return
+    ActivityEntry.objects.bulk_create([entry], ignore_conflicts=True)
+
+
+def record_activities(instances):
+    """Feed entries for rows written with bulk_create(), in one INSERT"""
+    entries = [build_activity(instance) for instance in instances]
+    if entries:
+        ActivityEntry.objects.bulk_create(entries, ignore_conflicts=True)
+
+
+def refresh_activities(instances):
+    """Rewrite the feed entries of rows changed with bulk_update(): one DELETE per type and one INSERT"""
+    instances = list(instances)
+    source_ids = {}
+    for instance in instances:
+        activity_type, _ = ACTIVITY_SOURCES[type(instance)]
+        source_ids.setdefault(activity_type, []).append(instance.pk)
+    for activity_type, ids in source_ids.items():
+        ActivityEntry.objects.filter(activity_type=activity_type, source_id__in=ids).delete()
+    record_activities(instances)
+
+
+def remove_activity(instance):
+    activity_type, _ = ACTIVITY_SOURCES[type(instance)]
+    ActivityEntry.objects.filter(activity_type=activity_type, source_id=instance.pk).delete()
+
+
+def backfill_activity(chunk_size=2000):
+    """
+    Create feed entries for existing history. Rows that already have an entry
+    are skipped, so this is safe to run more than once.
+    """
+    sources = (
+        AttendanceRecord.objects.select_related('event_fk'),
+        BalanceAdjustment.objects.all(),
+        PaymentRecord.objects.all(),
+        SalaryPayment.objects.all(),
+    )
+    created = 0
+    for queryset in sources:
+        before = ActivityEntry.objects.count()
+        batch = []
+        for instance in queryset.order_by('pk').iterator(chunk_size=chunk_size):
+            batch.append(build_activity(instance))
+            if len(batch) >= chunk_size:
+                ActivityEntry.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        if batch:
+            ActivityEntry.objects.bulk_create(batch, ignore_conflicts=True)
+        created += ActivityEntry.objects.count() - before
+
+    logger.info(f"Activity feed backfilled with {created} entries")
+    return created
@@ -2,7 +2,8 @@ from django.contrib import admin
 from .models import (
     Profile, AttendanceRecord, Event, BalanceAdjustment, ExpenseReimbursement, 
     SalaryPayment, EmployeeOnboarding, PaymentRecord, EmailNotification, 
-    MpesaPayment
+    MpesaPayment, BalanceLedgerEntry, PayrollRun, PayrollRunLine, PayRule,
+    MaintenanceCheckpoint, DisbursementBatch, MpesaCallbackLog, MpesaReconcileRun
 )
 from django.contrib.auth.models import User, Group
 from django.utils import timezone
@@ -12,7 +13,12 @@ from django.utils.decorators import method_decorator
 from django import forms
 from django.urls import reverse
 from django.utils.html import format_html
-from .mpesa_utils import MpesaClient
+from .mpesa_utils import queue_stk_push, process_callback_log
+from .payroll_utils import draft_payroll_run, commit_payroll_run
+from .pay_utils import reprice_attendance
+from .disbursement_utils import start_batch
+from django.core.exceptions import ValidationError
+from django.db.models import Count, Q, Sum
 from .email_utils import EventCRMNotifier
 
 
@@ -64,7 +70,7 @@ class ProfileAdmin(admin.ModelAdmin):
         }),
         ('Financial', {
             'fields': ('balance',),
-            'description': 'User\'s current balance (sum of unpaid attendance, reimbursements, and salary payments)'
+            'description': 'User\'s current balance (sum of unpaid attendance, balance adjustments, and salary payments)'
         }),
     )
     
@@ -181,6 +187,24 @@ class AttendanceRecordAdmin(LimitedEventManagerMixin, admin.ModelAdmin):
         )
     get_history_link.short_description = 'Changes History'
 
+    actions = ['reprice_records']
+
+    def get_actions(self, request):
+        """Repricing moves balances, so only superusers get it"""
+        actions = super().get_actions(request)
+        if not request.user.is_superuser:
+            actions.pop('reprice_records', None)
+        return actions
+
+    def reprice_records(self, request, queryset):
+        """Recompute the selected unpaid records' amounts from the pay rate card"""
+        result = reprice_attendance(queryset)
+        self.message_user(
+            request,
+            f"Repriced {result['changed']} of {result['scanned']} unpaid records; balances changed by KSH {result['total_delta']:+,.2f}"
+        )
+    reprice_records.short_description = "Reprice from pay rules"
+
 
 @admin.register(Event)
 class EventAdmin(LimitedEventManagerMixin, admin.ModelAdmin):
@@ -233,6 +257,24 @@ class BalanceAdjustmentAdmin(admin.ModelAdmin):
             obj.adjusted_by = request.user
         super().save_model(request, obj, form, change)
 
+@admin.register(BalanceLedgerEntry)
+class BalanceLedgerEntryAdmin(admin.ModelAdmin):
+    """Read-only view of the balance ledger - entries are written by signals only"""
+    list_display = ('user', 'amount', 'source_type', 'source_id', 'created_at')
+    list_filter = ('source_type', 'created_at')
+    search_fields = ('user__username',)
+    list_select_related = ('user',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(ExpenseReimbursement)
 class ExpenseReimbursementAdmin(admin.ModelAdmin):
     list_display = ('user', 'get_event', 'expense_type', 'amount', 'status', 'is_paid', 'send_stk_button', 'requested_at')
@@ -290,11 +332,7 @@ class ExpenseReimbursementAdmin(admin.ModelAdmin):
                             if new_status == 'approved' and not reimbursement.approved_by:
                                 reimbursement.approved_by = request.user
                                 reimbursement.approved_at = timezone.now()
-                                # Update user balance when approved
-                                profile = reimbursement.user.profile
-                                profile.balance += reimbursement.amount
-                                profile.save()
-                                # Create balance adjustment record
+                                # Balance adjustment record - the ledger signal updates the balance
                                 BalanceAdjustment.objects.create(
                                     user=reimbursement.user,
                                     reason=f"Reimbursement approved: {reimbursement.get_expense_type_display()} - KSH {reimbursement.amount}",
@@ -408,6 +446,130 @@ class SalaryPaymentAdmin(admin.ModelAdmin):
         super().save_model(request, obj, form, change)
 
 
+@admin.register(PayRule)
+class PayRuleAdmin(admin.ModelAdmin):
+    list_display = ('employment_type', 'job_role', 'event', 'effective_from', 'base_daily_pay', 'overtime_rate', 'notes')
+    list_filter = ('employment_type', 'job_role', 'effective_from')
+    search_fields = ('event__name', 'notes')
+    autocomplete_fields = ('event',)
+    readonly_fields = ('created_at',)
+
+    fieldsets = (
+        ('Applies to', {
+            'fields': ('employment_type', 'job_role', 'event'),
+            'description': 'Blank fields match everyone. The most specific matching rule wins: event, then job role, then employment type.'
+        }),
+        ('Rates', {
+            'fields': ('effective_from', 'base_daily_pay', 'overtime_rate', 'notes', 'created_at')
+        }),
+    )
+
+    def get_readonly_fields(self, request, obj=None):
+        """Rates are versioned: change them by adding a rule with a later effective date"""
+        if obj:
+            return self.readonly_fields + ('employment_type', 'job_role', 'event', 'effective_from', 'base_daily_pay', 'overtime_rate')
+        return self.readonly_fields
+
+
+@admin.register(MaintenanceCheckpoint)
+class MaintenanceCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('job', 'scope', 'status', 'processed', 'changed', 'last_pk', 'started_at', 'finished_at')
+    list_filter = ('job', 'status')
+    readonly_fields = ('job', 'scope', 'status', 'last_pk', 'processed', 'changed', 'started_at', 'updated_at', 'finished_at')
+
+    def has_add_permission(self, request):
+        return False
+
+
+class PayrollRunLineInline(admin.TabularInline):
+    model = PayrollRunLine
+    extra = 0
+    fields = ('user', 'days_worked', 'overtime_hours', 'base_salary', 'overtime_pay', 'supper_allowance', 'total_amount', 'salary_payment')
+    readonly_fields = ('user', 'days_worked', 'overtime_hours', 'total_amount', 'salary_payment')
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        """Lines can be dropped from a draft before it is committed"""
+        return obj is not None and obj.status == 'draft'
+
+    def get_readonly_fields(self, request, obj=None):
+        """Amounts can be corrected on a draft, but a committed run is final"""
+        if obj and obj.status != 'draft':
+            return self.fields
+        return self.readonly_fields
+
+
+@admin.register(PayrollRun)
+class PayrollRunAdmin(admin.ModelAdmin):
+    list_display = ('month_year', 'status', 'employee_count', 'run_total', 'computed_at', 'committed_by', 'committed_at')
+    list_filter = ('status',)
+    readonly_fields = ('status', 'created_by', 'created_at', 'computed_at', 'committed_by', 'committed_at')
+    inlines = [PayrollRunLineInline]
+    actions = ['recompute_drafts', 'commit_runs']
+
+    fieldsets = (
+        ('Payroll', {
+            'fields': ('month_year', 'notes'),
+            'description': 'Saving a new run computes a draft for every salaried employee. Review it, then use "Commit payroll runs".'
+        }),
+        ('Status', {
+            'fields': ('status', 'created_by', 'created_at', 'computed_at', 'committed_by', 'committed_at')
+        }),
+    )
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            line_count=Count('lines'),
+            line_total=Sum('lines__total_amount')
+        )
+
+    def employee_count(self, obj):
+        return obj.line_count
+    employee_count.short_description = 'Employees'
+
+    def run_total(self, obj):
+        return f"KSH {obj.line_total or 0:,.2f}"
+    run_total.short_description = 'Total'
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj:
+            return self.readonly_fields + ('month_year',)
+        return self.readonly_fields
+
+    def save_model(self, request, obj, form, change):
+        """New runs are stored against the first of the month and computed straight away"""
+        if change:
+            super().save_model(request, obj, form, change)
+            return
+        obj.month_year = obj.month_year.replace(day=1)
+        obj.created_by = request.user
+        super().save_model(request, obj, form, change)
+        _, already_paid = draft_payroll_run(obj.month_year, request.user)
+        if already_paid:
+            self.message_user(request, f"{len(already_paid)} employees were already paid for this month and were left out", level='warning')
+
+    def recompute_drafts(self, request, queryset):
+        """Recompute draft runs from the latest attendance"""
+        count = 0
+        for run in queryset.filter(status='draft'):
+            draft_payroll_run(run.month_year, request.user)
+            count += 1
+        self.message_user(request, f"Recomputed {count} draft payroll runs")
+    recompute_drafts.short_description = "Recompute selected drafts"
+
+    def commit_runs(self, request, queryset):
+        """Write the selected drafts' salary payments"""
+        for run in queryset.filter(status='draft'):
+            try:
+                created = commit_payroll_run(run, request.user)
+                self.message_user(request, f"{run.month_year:%B %Y}: {created} salary payments created")
+            except ValidationError as e:
+                self.message_user(request, ' '.join(e.messages), level='error')
+    commit_runs.short_description = "Commit payroll runs"
+
+
 @admin.register(EmployeeOnboarding)
 class EmployeeOnboardingAdmin(admin.ModelAdmin):
     list_display = ('get_full_name', 'get_status_badge', 'job_role', 'monthly_salary', 'email', 'submitted_at')
@@ -801,20 +963,24 @@ class PaymentRecordAdmin(admin.ModelAdmin):
 @admin.register(MpesaPayment)
 class MpesaPaymentAdmin(admin.ModelAdmin):
     list_display = ('user', 'phone_number', 'amount', 'status', 'payment_purpose', 'initiated_at', 'stk_push_button')
-    list_filter = ('status', 'initiated_at')
+    list_filter = ('status', 'settled_via', 'initiated_at')
     search_fields = ('user__username', 'phone_number', 'checkout_request_id')
-    readonly_fields = ('checkout_request_id', 'merchant_request_id', 'receipt_number', 'transaction_date', 'initiated_at', 'completed_at', 'result_code', 'result_description')
+    readonly_fields = ('checkout_request_id', 'merchant_request_id', 'receipt_number', 'transaction_date', 'initiated_at', 'completed_at', 'result_code', 'result_description', 'batch', 'reimbursement', 'attempts', 'dispatched_at', 'settled_at', 'settled_via', 'checked_at')
     
     fieldsets = (
         ('Payment Info', {
             'fields': ('user', 'phone_number', 'amount', 'payment_purpose', 'status')
         }),
         ('M-Pesa Details', {
-            'fields': ('checkout_request_id', 'merchant_request_id', 'receipt_number', 'result_code', 'result_description'),
+            'fields': ('checkout_request_id', 'merchant_request_id', 'receipt_number', 'result_code', 'result_description', 'attempts'),
+            'classes': ('collapse',)
+        }),
+        ('Disbursement', {
+            'fields': ('batch', 'reimbursement'),
             'classes': ('collapse',)
         }),
         ('Timestamps', {
-            'fields': ('initiated_at', 'completed_at', 'transaction_date'),
+            'fields': ('initiated_at', 'dispatched_at', 'completed_at', 'transaction_date', 'settled_at', 'settled_via', 'checked_at'),
             'classes': ('collapse',)
         }),
     )
@@ -832,30 +998,101 @@ class MpesaPaymentAdmin(admin.ModelAdmin):
     
     def initiate_stk_push_action(self, request, queryset):
         """Admin action to initiate STK push"""
-        mpesa = MpesaClient()
-        for payment in queryset.filter(status='initiated'):
+        for payment in queryset.filter(status='initiated', checkout_request_id__isnull=True).select_related('user'):
             try:
-                result = mpesa.initiate_stk_push(
-                    payment.user,
-                    payment.phone_number,
-                    payment.amount,
-                    payment.payment_purpose,
-                    payment.id
-                )
+                result = queue_stk_push(payment)
                 if result['success']:
-                    payment.checkout_request_id = result['checkout_request_id']
-                    payment.merchant_request_id = result['merchant_request_id']
-                    payment.status = 'pending'
-                    payment.save()
-                    self.message_user(request, f"STK push initiated for {payment.user.username}")
+                    self.message_user(request, f"STK push {'queued' if result['status'] == 'initiated' else 'initiated'} for {payment.user.username}")
                 else:
-                    self.message_user(request, f"Failed for {payment.user.username}: {result['message']}", level='error')
+                    self.message_user(request, f"Failed for {payment.user.username}: {result.get('message') or result.get('error')}", level='error')
             except Exception as e:
                 self.message_user(request, f"Error for {payment.user.username}: {str(e)}", level='error')
     
     initiate_stk_push_action.short_description = "Initiate M-Pesa STK Push"
 
 
+@admin.register(MpesaReconcileRun)
+class MpesaReconcileRunAdmin(admin.ModelAdmin):
+    list_display = ('started_at', 'trigger', 'status', 'checked', 'summary', 'finished_at')
+    list_filter = ('status', 'trigger')
+    readonly_fields = ('trigger', 'status', 'started_at', 'finished_at', 'checked', 'summary', 'error')
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(MpesaCallbackLog)
+class MpesaCallbackLogAdmin(admin.ModelAdmin):
+    list_display = ('received_at', 'checkout_request_id', 'result_code', 'status', 'attempts', 'processed_at')
+    list_filter = ('status', 'result_code', 'received_at')
+    search_fields = ('checkout_request_id',)
+    readonly_fields = ('received_at', 'remote_addr', 'checkout_request_id', 'result_code', 'event_key',
+                       'status', 'attempts', 'processed_at', 'error', 'body')
+    actions = ['replay_callbacks']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        """The callback log is append-only"""
+        return False
+
+    def replay_callbacks(self, request, queryset):
+        """Apply the selected callbacks again, oldest first"""
+        outcomes = {}
+        for entry in queryset.order_by('received_at', 'pk'):
+            status = process_callback_log(entry.pk, reapply=True) or 'busy'
+            outcomes[status] = outcomes.get(status, 0) + 1
+        self.message_user(request, 'Replayed: ' + ', '.join(f'{count} {status}' for status, count in sorted(outcomes.items())))
+    replay_callbacks.short_description = "Apply selected callbacks again"
+
+
+class DisbursementPaymentInline(admin.TabularInline):
+    model = MpesaPayment
+    extra = 0
+    fields = ('user', 'phone_number', 'amount', 'payment_purpose', 'status', 'attempts', 'receipt_number', 'result_description')
+    readonly_fields = fields
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(DisbursementBatch)
+class DisbursementBatchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'source', 'status', 'progress', 'created_by', 'created_at', 'finished_at', 'progress_link')
+    list_filter = ('source', 'status')
+    readonly_fields = ('source', 'status', 'created_by', 'created_at', 'started_at', 'finished_at')
+    fields = ('source', 'status', 'notes', 'created_by', 'created_at', 'started_at', 'finished_at')
+    inlines = [DisbursementPaymentInline]
+    actions = ['send_batches']
+
+    def has_add_permission(self, request):
+        """Batches are created from the Pay Crew page, which works out who is owed what"""
+        return False
+
+    def get_queryset(self, request):
+        # Counted in the list query rather than once per row
+        return super().get_queryset(request).annotate(
+            payment_count=Count('payments'),
+            completed_count=Count('payments', filter=Q(payments__status='completed'))
+        )
+
+    def progress(self, obj):
+        return f"{obj.completed_count} of {obj.payment_count} completed"
+
+    def progress_link(self, obj):
+        return format_html('<a href="{}">Live progress</a>', reverse('disbursement_detail', args=[obj.pk]))
+    progress_link.short_description = 'Progress'
+
+    def send_batches(self, request, queryset):
+        """Send any pushes in the batches that haven't gone out yet (e.g. after a restart)"""
+        for batch in queryset:
+            start_batch(batch)
+        self.message_user(request, f"Sending unsent payments for {queryset.count()} batch(es).")
+    send_batches.short_description = "Send unsent payments"
+
+
 # ============= EVENT CREW MANAGEMENT ADMIN =============
 # ============= EMAIL NOTIFICATION ADMIN =============
 @admin.register(EmailNotification)
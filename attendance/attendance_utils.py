@@ -0,0 +1,244 @@
+"""
+Attendance Utilities
+Marks attendance for many users at once (crew check-in, offline sync) with
+one bulk INSERT and one grouped balance update.
+"""
+import datetime
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from .models import AttendanceRecord, Profile, Event
+from .balance_utils import defer_balance_updates
+from .event_utils import find_or_create_event
+from .pay_utils import price
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Offline submissions older than this are rejected rather than back-dated
+OFFLINE_SUBMISSION_MAX_AGE = datetime.timedelta(days=7)
+
+
+def attendance_amount(employment_type, overtime_hours, job_role=None, event_id=None, date=None):
+    """Day rate plus overtime from the PayRule rate card (salaried staff default to overtime only)"""
+    return price(employment_type, overtime_hours, job_role=job_role, event_id=event_id, date=date).total
+
+
+def bulk_mark_attendance(entries):
+    """
+    Create attendance records for many users in one transaction.
+
+    Args:
+        entries: list of dicts with 'user_id', 'date', 'check_in_time', 'event'
+                 (Event or None) and 'overtime_hours'. Extra AttendanceRecord
+                 field values can be passed in 'fields'.
+
+    Returns:
+        list: one result per entry, in order, with user_id, status
+              ('checked_in' or 'already_marked'), record_id and amount.
+              An entry is 'already_marked' if the user has a record for that
+              date or the same (user, date) appears earlier in entries.
+    """
+    if not entries:
+        return []
+
+    user_ids = {entry['user_id'] for entry in entries}
+    dates = {entry['date'] for entry in entries}
+    profiles = {
+        user_id: (employment_type, job_role)
+        for user_id, employment_type, job_role in
+        Profile.objects.filter(user_id__in=user_ids).values_list('user_id', 'employment_type', 'job_role')
+    }
+
+    for attempt in range(2):
+        try:
+            with defer_balance_updates() as batch:
+                taken = set(
+                    AttendanceRecord.objects.filter(user_id__in=user_ids, date__in=dates)
+                    .values_list('user_id', 'date')
+                )
+                results = []
+                records = []
+                for entry in entries:
+                    key = (entry['user_id'], entry['date'])
+                    result = {'user_id': entry['user_id'], 'date': entry['date'].isoformat(),
+                              'status': 'already_marked', 'record_id': None, 'amount': None}
+                    results.append(result)
+                    if key in taken:
+                        continue
+                    taken.add(key)
+
+                    overtime_hours = entry.get('overtime_hours') or 0
+                    employment_type, job_role = profiles.get(entry['user_id'], ('casual', None))
+                    event = entry.get('event')
+                    record = AttendanceRecord(
+                        user_id=entry['user_id'],
+                        date=entry['date'],
+                        check_in_time=entry['check_in_time'],
+                        event_fk=event,
+                        overtime_hours=overtime_hours,
+                        original_overtime_hours=overtime_hours,
+                        amount_paid=attendance_amount(employment_type, overtime_hours, job_role,
+                                                      event.pk if event else None, entry['date']),
+                        **entry.get('fields', {})
+                    )
+                    records.append((result, record))
+
+                with transaction.atomic():
+                    created = AttendanceRecord.objects.bulk_create([record for _, record in records])
+                batch.add(created)
+        except IntegrityError:
+            # Someone marked one of these users between our read and the INSERT; re-read once
+            if attempt:
+                raise
+            logger.warning("Concurrent attendance insert during bulk marking, retrying")
+            continue
+        break
+
+    for result, record in records:
+        result.update(status='checked_in', record_id=record.pk, amount=float(record.amount_paid))
+
+    logger.info(f"Bulk attendance: {len(records)} of {len(entries)} entries marked")
+    return results
+
+
+def local_now():
+    """Current date and time in the configured timezone (Africa/Nairobi)"""
+    now = timezone.localtime()
+    return now.date(), now.time()
+
+
+def check_in_crew(event, user_ids, overtime_hours=0):
+    """
+    Check in members of an event's setup or event crew for today.
+
+    Returns:
+        list: bulk_mark_attendance results, plus a 'not_crew' result for ids
+              that aren't on either crew
+    """
+    crew_ids = set(event.setup_crew.values_list('id', flat=True)) | set(event.event_crew.values_list('id', flat=True))
+    today, now = local_now()
+
+    entries = []
+    rejected = []
+    for user_id in dict.fromkeys(user_ids):
+        if user_id in crew_ids:
+            entries.append({'user_id': user_id, 'date': today, 'check_in_time': now,
+                            'event': event, 'overtime_hours': overtime_hours})
+        else:
+            rejected.append({'user_id': user_id, 'date': today.isoformat(),
+                             'status': 'not_crew', 'record_id': None, 'amount': None})
+
+    return bulk_mark_attendance(entries) + rejected
+
+
+def sync_offline_submissions(user, submissions):
+    """
+    Apply attendance a user queued while offline.
+
+    Args:
+        user: User the submissions belong to
+        submissions: list of dicts with 'idempotency_key', 'checked_in_at'
+                     (ISO 8601 timestamp taken on the phone), 'overtime_hours'
+                     and either 'event_fk' (id) or 'event_name'
+
+    Returns:
+        list: one result per submission with idempotency_key and status:
+              'created', 'duplicate' (this user already applied the key,
+              or it appears earlier in the batch),
+              'already_marked' (another record exists for that day) or
+              'invalid' with an error. Every submission gets a final answer,
+              so the client can drop all of them from its queue.
+    """
+    now = timezone.now()
+    results = []
+    valid = []
+
+    for submission in submissions:
+        key = str(submission.get('idempotency_key') or '').strip()
+        result = {'idempotency_key': key, 'status': 'invalid', 'record_id': None, 'error': ''}
+        results.append(result)
+        try:
+            checked_in_at = datetime.datetime.fromisoformat(submission['checked_in_at'])
+            overtime_hours = int(submission.get('overtime_hours') or 0)
+            event_fk = int(submission['event_fk']) if submission.get('event_fk') else None
+        except (KeyError, ValueError, TypeError):
+            result['error'] = 'checked_in_at, overtime_hours or event_fk is malformed'
+            continue
+        if not key or len(key) > 64:
+            result['error'] = 'idempotency_key is required (max 64 characters)'
+            continue
+        if timezone.is_naive(checked_in_at):
+            checked_in_at = timezone.make_aware(checked_in_at)
+        if checked_in_at > now + datetime.timedelta(minutes=5) or checked_in_at < now - OFFLINE_SUBMISSION_MAX_AGE:
+            result['error'] = 'checked_in_at is in the future or too old to sync'
+            continue
+        if overtime_hours < 0:
+            result['error'] = 'Overtime hours cannot be negative'
+            continue
+        event_name = (submission.get('event_name') or '').strip()
+        if not event_fk and not event_name:
+            result['error'] = 'An event is required'
+            continue
+
+        local = timezone.localtime(checked_in_at)
+        valid.append((result, {
+            'user_id': user.id,
+            'date': local.date(),
+            'check_in_time': local.time(),
+            'overtime_hours': overtime_hours,
+            'event_fk': event_fk,
+            'event_name': event_name,
+            'fields': {'client_submission_id': key},
+        }))
+
+    if not valid:
+        return results
+
+    # Keys that were applied by an earlier (possibly interrupted) sync
+    applied = dict(
+        AttendanceRecord.objects.filter(
+            user=user, client_submission_id__in=[entry['fields']['client_submission_id'] for _, entry in valid]
+        ).values_list('client_submission_id', 'id')
+    )
+    events = Event.objects.in_bulk({entry['event_fk'] for _, entry in valid if entry['event_fk']})
+
+    pending = []
+    # A key repeated within the batch resolves to its first occurrence
+    first_seen = {}
+    repeats = []
+    for result, entry in valid:
+        key = entry['fields']['client_submission_id']
+        if key in applied:
+            result.update(status='duplicate', record_id=applied[key])
+            continue
+        if key in first_seen:
+            repeats.append((result, first_seen[key]))
+            continue
+        first_seen[key] = result
+        if entry['event_fk']:
+            entry['event'] = events.get(entry['event_fk'])
+            if entry['event'] is None:
+                result['error'] = 'Event not found'
+                continue
+        else:
+            entry['event'], _ = find_or_create_event(
+                entry['event_name'], entry['date'],
+                defaults={'location': 'Custom Event', 'description': 'User-entered event'}
+            )
+        pending.append((result, entry))
+
+    marked = bulk_mark_attendance([entry for _, entry in pending])
+    for (result, _), outcome in zip(pending, marked):
+        status = 'created' if outcome['status'] == 'checked_in' else outcome['status']
+        result.update(status=status, record_id=outcome['record_id'])
+    for result, first in repeats:
+        if first['record_id']:
+            result.update(status='duplicate', record_id=first['record_id'])
+        else:
+            result.update(status=first['status'], error=first['error'])
+
+    logger.info(f"Offline sync for {user.username}: " + ', '.join(
+        f"{sum(1 for result in results if result['status'] == status)} {status}"
+        for status in ('created', 'duplicate', 'already_marked', 'invalid')
+    ))
+    return results
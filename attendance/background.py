@@ -0,0 +1,47 @@
+"""
+Background Task Executor
+A small in-process thread pool for work that shouldn't hold up a request
+(large exports, slow third-party calls). Celery isn't configured for this
+project, so tasks run inside the web worker that submitted them and are lost
+if that worker restarts - only submit work that can safely be redone.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from django.conf import settings
+from django.db import close_old_connections
+import logging
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Process-wide executor, created on first use (after gunicorn forks)"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'BACKGROUND_WORKERS', 4),
+                    thread_name_prefix='attendance-bg'
+                )
+    return _executor
+
+
+def _run(fn, args, kwargs):
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        logger.exception(f"Background task {fn.__name__} failed")
+        raise
+    finally:
+        # Threads don't go through the request cycle, so release their DB connection here
+        close_old_connections()
+
+
+def submit(fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) on the background pool and return its Future"""
+    return get_executor().submit(_run, fn, args, kwargs)
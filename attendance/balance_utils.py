@@ -0,0 +1,335 @@
+"""
+Balance Ledger Utilities
+Keeps Profile.balance in step with attendance, adjustments and salary payments
+by appending signed deltas instead of re-aggregating each user's history.
+
+Balance = unpaid attendance + balance adjustments + salary payments
+"""
+from contextlib import contextmanager
+from decimal import Decimal, InvalidOperation
+import threading
+from django.db import connection, transaction
+from django.db.models import F, Sum, OuterRef, Subquery, Value, DecimalField, Case, When
+from django.db.models.functions import Coalesce
+from .models import Profile, AttendanceRecord, BalanceAdjustment, SalaryPayment, BalanceLedgerEntry
+from .activity_utils import record_activities
+from .cache_utils import bump_user_cache, bump_all_user_caches
+import logging
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+CENT = Decimal('0.01')
+# Profile.balance is DecimalField(max_digits=10, decimal_places=2)
+MAX_ADJUSTMENT = Decimal('99999999.99')
+
+# Holds the active BalanceBatch for the current thread while balance updates are deferred
+_deferred = threading.local()
+
+
+def to_amount(value):
+    """Coerce ints/floats/strings from views into a 2dp Decimal"""
+    if value is None:
+        return ZERO
+    return Decimal(str(value)).quantize(CENT)
+
+
+def _attendance_amount(record):
+    """Only unpaid attendance is owed to the user"""
+    return ZERO if record.is_paid else to_amount(record.amount_paid)
+
+
+# Model -> (ledger source type, function giving the row's contribution to the balance)
+LEDGER_SOURCES = {
+    AttendanceRecord: ('attendance', _attendance_amount),
+    BalanceAdjustment: ('adjustment', lambda adjustment: to_amount(adjustment.amount)),
+    SalaryPayment: ('salary', lambda payment: to_amount(payment.total_amount)),
+}
+
+
+def posted_amount(source_type, source_id):
+    """Net amount already posted to the ledger for one source row"""
+    total = BalanceLedgerEntry.objects.filter(
+        source_type=source_type,
+        source_id=source_id
+    ).aggregate(total=Sum('amount'))['total'] or ZERO
+
+    batch = getattr(_deferred, 'batch', None)
+    if batch is not None:
+        total += batch.pending_amount(source_type, source_id)
+    return total
+
+
+def post_balance_delta(user_id, source_type, source_id, delta):
+    """Append one ledger entry and bump the user's balance in the same transaction"""
+    batch = getattr(_deferred, 'batch', None)
+    if batch is not None:
+        batch.post(user_id, source_type, source_id, delta)
+        return
+
+    with transaction.atomic():
+        BalanceLedgerEntry.objects.create(
+            user_id=user_id,
+            source_type=source_type,
+            source_id=source_id,
+            amount=delta
+        )
+        Profile.objects.filter(user_id=user_id).update(balance=F('balance') + delta)
+
+
+class BalanceBatch:
+    """Ledger entries and affected users collected inside defer_balance_updates()"""
+
+    def __init__(self):
+        self.entries = []
+        self.user_ids = set()
+
+    def post(self, user_id, source_type, source_id, delta):
+        self.entries.append(BalanceLedgerEntry(
+            user_id=user_id,
+            source_type=source_type,
+            source_id=source_id,
+            amount=delta
+        ))
+        self.user_ids.add(user_id)
+
+    def pending_amount(self, source_type, source_id):
+        return sum(
+            (entry.amount for entry in self.entries
+             if entry.source_type == source_type and entry.source_id == source_id),
+            ZERO
+        )
+
+    def add(self, instances):
+        """
+        Register rows written with bulk_create(), which doesn't send post_save.
+        Posts their balance deltas and writes their activity feed entries.
+        The instances must have their primary keys set.
+        """
+        instances = list(instances)
+        for instance in instances:
+            record_balance_change(instance, created=True)
+        record_activities(instances)
+        bump_user_cache(*(instance.user_id for instance in instances))
+
+    def flush(self):
+        """Write the collected entries and recompute the affected balances once"""
+        if self.entries:
+            BalanceLedgerEntry.objects.bulk_create(self.entries)
+        if self.user_ids:
+            rebuild_balances(self.user_ids)
+        self.entries = []
+        self.user_ids = set()
+
+
+@contextmanager
+def defer_balance_updates():
+    """
+    Batch balance updates for bulk writes. Usable as a context manager or decorator:
+
+        with defer_balance_updates() as batch:
+            for user in users:
+                BalanceAdjustment.objects.create(...)
+            batch.add(AttendanceRecord.objects.bulk_create(records))
+
+    Signals still compute each row's delta, but ledger entries are written with
+    one bulk_create on exit and each affected balance is recomputed once, in a
+    single grouped UPDATE. The block runs in one transaction. Nested blocks join
+    the outermost batch.
+    """
+    batch = getattr(_deferred, 'batch', None)
+    if batch is not None:
+        yield batch
+        return
+
+    batch = BalanceBatch()
+    try:
+        with transaction.atomic():
+            _deferred.batch = batch
+            yield batch
+            _deferred.batch = None
+            batch.flush()
+    finally:
+        _deferred.batch = None
+
+
+def record_balance_change(instance, created=False):
+    """
+    Post the difference between what instance should contribute to the balance
+    and what the ledger already holds for it. New rows skip the lookup.
+    """
+    source_type, amount_for = LEDGER_SOURCES[type(instance)]
+    new_amount = amount_for(instance)
+    previous = ZERO if created else posted_amount(source_type, instance.pk)
+
+    delta = new_amount - previous
+    if delta:
+        post_balance_delta(instance.user_id, source_type, instance.pk, delta)
+    return delta
+
+
+def record_balance_removal(instance):
+    """Reverse everything posted for a deleted row"""
+    source_type, _ = LEDGER_SOURCES[type(instance)]
+    previous = posted_amount(source_type, instance.pk)
+    if previous:
+        post_balance_delta(instance.user_id, source_type, instance.pk, -previous)
+    return -previous
+
+
+def reseed_ledger(chunk_size=2000):
+    """
+    Replace the ledger with one opening entry per source row.
+    Used to repair the ledger after data was changed behind the signals' back.
+    """
+    with transaction.atomic():
+        BalanceLedgerEntry.objects.all().delete()
+        created = 0
+
+        sources = (
+            ('attendance', AttendanceRecord.objects.filter(is_paid=False).exclude(amount_paid=0), 'amount_paid'),
+            ('adjustment', BalanceAdjustment.objects.exclude(amount=0), 'amount'),
+            ('salary', SalaryPayment.objects.exclude(total_amount=0), 'total_amount'),
+        )
+        for source_type, queryset, amount_field in sources:
+            batch = []
+            rows = queryset.order_by('pk').values_list('pk', 'user_id', amount_field)
+            for pk, user_id, amount in rows.iterator(chunk_size=chunk_size):
+                batch.append(BalanceLedgerEntry(
+                    user_id=user_id,
+                    source_type=source_type,
+                    source_id=pk,
+                    amount=amount
+                ))
+                if len(batch) >= chunk_size:
+                    created += len(BalanceLedgerEntry.objects.bulk_create(batch))
+                    batch = []
+            if batch:
+                created += len(BalanceLedgerEntry.objects.bulk_create(batch))
+
+    logger.info(f"Balance ledger reseeded with {created} entries")
+    return created
+
+
+def rebuild_balances(user_ids=None):
+    """
+    Set Profile.balance to each user's ledger total in a single UPDATE.
+    Pass user_ids to limit the rebuild to those users.
+    """
+    ledger_total = BalanceLedgerEntry.objects.filter(
+        user=OuterRef('user')
+    ).values('user').annotate(total=Sum('amount')).values('total')
+
+    profiles = Profile.objects.all()
+    if user_ids is not None:
+        profiles = profiles.filter(user_id__in=user_ids)
+        bump_user_cache(*user_ids)
+    else:
+        bump_all_user_caches()
+
+    return profiles.update(balance=Coalesce(
+        Subquery(ledger_total),
+        Value(ZERO),
+        output_field=DecimalField(max_digits=10, decimal_places=2)
+    ))
+
+
+def increment_balances(deltas):
+    """
+    Add each user's delta to Profile.balance in one UPDATE.
+    deltas: {user_id: Decimal}. Uses UPDATE ... FROM (VALUES ...) on PostgreSQL
+    and a CASE expression elsewhere (SQLite has no UPDATE ... FROM before 3.33).
+    """
+    deltas = {user_id: delta for user_id, delta in deltas.items() if delta}
+    if not deltas:
+        return 0
+    bump_user_cache(*deltas)
+
+    if connection.vendor == 'postgresql':
+        table = connection.ops.quote_name(Profile._meta.db_table)
+        values = ', '.join(['(%s, %s::numeric)'] * len(deltas))
+        params = [value for pair in deltas.items() for value in pair]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} AS p SET balance = p.balance + v.delta "
+                f"FROM (VALUES {values}) AS v(user_id, delta) WHERE p.user_id = v.user_id",
+                params
+            )
+            return cursor.rowcount
+
+    return Profile.objects.filter(user_id__in=deltas.keys()).update(balance=F('balance') + Case(
+        *[When(user_id=user_id, then=Value(delta)) for user_id, delta in deltas.items()],
+        default=Value(ZERO),
+        output_field=DecimalField(max_digits=10, decimal_places=2)
+    ))
+
+
+def apply_bulk_adjustments(rows, adjusted_by, default_reason="Admin adjustment"):
+    """
+    Validate a grid of balance adjustments and save the valid ones in one go.
+
+    Args:
+        rows: iterable of dicts with 'user', 'amount' (raw input) and optional 'reason'
+        adjusted_by: User making the adjustments
+        default_reason: Reason used when a row leaves it blank
+
+    Returns:
+        list: one result dict per row with user_id, username, amount, status
+              ('saved' or 'invalid') and error
+    """
+    results = []
+    adjustments = []
+
+    for row in rows:
+        user = row['user']
+        result = {'user_id': user.id, 'username': user.username, 'amount': None, 'status': 'invalid', 'error': ''}
+        results.append(result)
+
+        try:
+            amount = Decimal(str(row['amount']).strip().replace(',', '')).quantize(CENT)
+        except (InvalidOperation, ValueError, TypeError):
+            result['error'] = f"Invalid adjustment amount for {user.username}"
+            continue
+        if not amount.is_finite() or abs(amount) > MAX_ADJUSTMENT:
+            result['error'] = f"Adjustment amount out of range for {user.username}"
+            continue
+        if amount == 0:
+            result['error'] = f"Adjustment amount for {user.username} is zero"
+            continue
+
+        reason = (row.get('reason') or '').strip() or default_reason
+        result.update(amount=amount, status='saved')
+        adjustments.append(BalanceAdjustment(
+            user=user,
+            amount=amount,
+            reason=reason[:255],
+            adjusted_by=adjusted_by
+        ))
+
+    if not adjustments:
+        return results
+
+    with transaction.atomic():
+        adjustments = BalanceAdjustment.objects.bulk_create(adjustments)
+
+        batch = getattr(_deferred, 'batch', None)
+        if batch is not None:
+            batch.add(adjustments)
+        else:
+            BalanceLedgerEntry.objects.bulk_create([
+                BalanceLedgerEntry(
+                    user_id=adjustment.user_id,
+                    source_type='adjustment',
+                    source_id=adjustment.pk,
+                    amount=adjustment.amount
+                )
+                for adjustment in adjustments
+            ])
+            deltas = {}
+            for adjustment in adjustments:
+                deltas[adjustment.user_id] = deltas.get(adjustment.user_id, ZERO) + adjustment.amount
+            increment_balances(deltas)
+            record_activities(adjustments)
+
+    logger.info(f"{len(adjustments)} balance adjustments saved by {adjusted_by}")
+    return results
@@ -0,0 +1,183 @@
+"""
+Cache Utilities
+Caches the data behind a user's own pages (dashboard, attendance history,
+assignments) and invalidates it by bumping a generation counter whenever
+that user's data changes. TwoLevelCache below serves shared reference data.
+
+Each cached fragment stores the generations it was built at. A read fetches
+the fragment and the current generations in one get_many() call and only
+trusts the fragment if they still match, so a bump invalidates every
+fragment for the user at once without having to know their keys.
+
+A bump only reaches the processes that share the default cache, so with a
+per-process backend (CACHE_BACKEND=locmem) user fragments aren't cached at
+all and shared reference data is only kept as long as the L1 tier.
+"""
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.db import transaction
+
+GLOBAL_GENERATION_KEY = 'usercache:gen:all'
+
+# Keys for shared reference data held in shared_cache
+EVENTS_VERSION_KEY = 'shared:events:version'
+ROLE_CHOICES_KEY = 'shared:profile:job_roles'
+PAY_RULES_KEY = 'shared:pay_rules'
+
+_MISSING = object()
+
+
+def default_cache_is_shared():
+    """False when the default cache lives in this process, where invalidations can't reach other workers"""
+    return not settings.CACHES['default']['BACKEND'].endswith('LocMemCache')
+
+
+def _generation_key(user_id):
+    return f'usercache:gen:{user_id}'
+
+
+def _fragment_key(user_id, fragment):
+    return f'usercache:{user_id}:{fragment}'
+
+
+def _new_generation():
+    # Counters start from the clock rather than 1 so a counter that was evicted
+    # and recreated can't line up with a fragment built before the eviction
+    return time.time_ns()
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_generation(), None)
+
+
+def bump_user_cache(*user_ids):
+    """
+    Invalidate every cached fragment for these users. The bump happens once the
+    current transaction commits, so a concurrent request can't re-cache the old data.
+    """
+    keys = {_generation_key(user_id) for user_id in user_ids if user_id is not None}
+    if keys:
+        transaction.on_commit(lambda: [_bump(key) for key in keys])
+
+
+def bump_all_user_caches():
+    """Invalidate every user's cached fragments, e.g. after an event is renamed"""
+    transaction.on_commit(lambda: _bump(GLOBAL_GENERATION_KEY))
+
+
+def _current_generations(values, user_id):
+    generations = []
+    for key in (GLOBAL_GENERATION_KEY, _generation_key(user_id)):
+        generation = values.get(key)
+        if generation is None:
+            cache.add(key, _new_generation(), None)
+            generation = cache.get(key)
+        generations.append(generation)
+    return tuple(generations)
+
+
+def cached_for_user(user_id, fragment, build, timeout=None):
+    """
+    Return build() for this user, cached until their generation is bumped.
+
+    Args:
+        user_id: Owner of the data
+        fragment: Name of the fragment, including anything else it depends on (e.g. the date)
+        build: Callable returning picklable data (evaluate querysets into lists)
+        timeout: Seconds to keep the fragment, defaults to settings.CACHE_TIMEOUT
+    """
+    if not default_cache_is_shared():
+        return build()
+
+    fragment_key = _fragment_key(user_id, fragment)
+    values = cache.get_many([GLOBAL_GENERATION_KEY, _generation_key(user_id), fragment_key])
+
+    generations = (values.get(GLOBAL_GENERATION_KEY), values.get(_generation_key(user_id)))
+    cached = values.get(fragment_key)
+    if cached is not None and None not in generations and cached[0] == generations:
+        return cached[1]
+
+    generations = _current_generations(values, user_id)
+    data = build()
+    if timeout is None:
+        timeout = getattr(settings, 'CACHE_TIMEOUT', 3600)
+    cache.set(fragment_key, (generations, data), timeout)
+    return data
+
+
+class TwoLevelCache:
+    """
+    Read-through cache for hot, rarely changing data shared by every user.
+
+    L1 is this process's 'local' cache with a short timeout, L2 is the shared
+    'default' cache. A read tries L1, then L2, then calls build() and fills
+    both. delete() clears L2 and this process's L1; other workers pick up the
+    change when their L1 copy expires (settings.L1_CACHE_TIMEOUT).
+    """
+
+    def __init__(self, l1_alias='local', l2_alias='default'):
+        self.l1_alias = l1_alias
+        self.l2_alias = l2_alias
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def l1(self):
+        return caches[self.l1_alias]
+
+    @property
+    def l2(self):
+        return caches[self.l2_alias]
+
+    def _count(self, stat):
+        with self._lock:
+            self.counters[stat] += 1
+
+    def get_or_set(self, key, build, timeout=None, l1_timeout=None):
+        if timeout is None:
+            timeout = getattr(settings, 'CACHE_TIMEOUT', 3600)
+        if l1_timeout is None:
+            l1_timeout = min(timeout, getattr(settings, 'L1_CACHE_TIMEOUT', 30))
+        if self.l2_alias == 'default' and not default_cache_is_shared():
+            # delete() can't reach other workers' copies, so keep them no longer than L1's
+            timeout = l1_timeout
+
+        value = self.l1.get(key, _MISSING)
+        if value is not _MISSING:
+            self._count('l1_hits')
+            return value
+
+        value = self.l2.get(key, _MISSING)
+        if value is not _MISSING:
+            self._count('l2_hits')
+        else:
+            self._count('misses')
+            value = build()
+            self.l2.set(key, value, timeout)
+        self.l1.set(key, value, l1_timeout)
+        return value
+
+    def delete(self, key):
+        self.l1.delete(key)
+        self.l2.delete(key)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        reads = sum(counters.values())
+        counters['hit_rate'] = round((counters['l1_hits'] + counters['l2_hits']) / reads, 3) if reads else None
+        counters['l2_backend'] = settings.CACHES[self.l2_alias]['BACKEND'].rsplit('.', 1)[-1]
+        return counters
+
+    def reset_stats(self):
+        with self._lock:
+            self.counters = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0}
+
+
+# Process-wide instance used for shared reference data (event list version, role choices, pay rules)
+shared_cache = TwoLevelCache()
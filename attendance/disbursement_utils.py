@@ -0,0 +1,195 @@
+"""
+Disbursement Utilities
+Pays many people at once, from their outstanding balances or from approved
+expense reimbursements. create_batch() records a DisbursementBatch with one
+'initiated' MpesaPayment per person (or reimbursement); run_batch() sends
+the STK pushes from a pool of threads sharing one M-Pesa client, spaced to
+stay under the Daraja rate limit and retrying pushes that failed before
+reaching Safaricom.
+
+The legs are STK pushes, which collect money rather than send it, so a
+completed leg settles nothing by itself: an admin still marks the
+reimbursement paid or adjusts the balance once the money has gone out.
+Settling automatically has to wait for a B2C payout flow.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal, ROUND_DOWN
+import time
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction, close_old_connections
+from django.db.models import Count, Sum
+from django.utils import timezone
+from .models import Profile, ExpenseReimbursement, MpesaPayment, DisbursementBatch
+from .mpesa_utils import dispatch_stk_push, format_phone_number, RateLimiter
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Largest amount M-Pesa accepts in one STK push
+MAX_PUSH_AMOUNT = Decimal('150000')
+# Payment statuses that mean a push is still in flight
+OPEN_STATUSES = ('initiated', 'pending')
+
+
+def _whole_shillings(amount):
+    """M-Pesa moves whole shillings; cents stay on the balance"""
+    return min(amount, MAX_PUSH_AMOUNT).quantize(Decimal('1'), rounding=ROUND_DOWN)
+
+
+def collect_legs(source, user_ids=None):
+    """
+    What a new batch would pay.
+
+    Balances: every active user owed at least KSH 1 with a phone number and no
+    balance payment still in flight. Reimbursements: every approved, unpaid
+    reimbursement without a push still in flight.
+
+    Returns:
+        list: dicts with user_id, phone_number, amount, payment_purpose and
+              reimbursement_id
+    """
+    if source == 'balance':
+        in_flight = MpesaPayment.objects.filter(batch__source='balance', status__in=OPEN_STATUSES).values('user_id')
+        rows = Profile.objects.filter(
+            balance__gte=1,
+            user__is_active=True
+        ).exclude(phone_number='').exclude(user_id__in=in_flight)
+        if user_ids is not None:
+            rows = rows.filter(user_id__in=user_ids)
+        legs = [
+            {
+                'user_id': user_id,
+                'phone_number': format_phone_number(phone),
+                'amount': _whole_shillings(balance),
+                'payment_purpose': 'Balance payout',
+                'reimbursement_id': None,
+            }
+            for user_id, phone, balance in rows.order_by('user_id').values_list('user_id', 'phone_number', 'balance')
+        ]
+    elif source == 'reimbursements':
+        rows = ExpenseReimbursement.objects.filter(
+            status='approved',
+            is_paid=False,
+            amount__gte=1,
+            user__profile__isnull=False
+        ).exclude(user__profile__phone_number='').exclude(
+            mpesa_payments__status__in=OPEN_STATUSES
+        )
+        if user_ids is not None:
+            rows = rows.filter(user_id__in=user_ids)
+        legs = [
+            {
+                'user_id': user_id,
+                'phone_number': format_phone_number(phone),
+                'amount': _whole_shillings(amount),
+                'payment_purpose': f'Reimbursement #{pk}',
+                'reimbursement_id': pk,
+            }
+            for pk, user_id, phone, amount in rows.order_by('pk').distinct().values_list(
+                'pk', 'user_id', 'user__profile__phone_number', 'amount'
+            )
+        ]
+    else:
+        raise ValueError(f"Unknown disbursement source: {source}")
+    return legs
+
+
+def create_batch(source, created_by=None, user_ids=None, notes=''):
+    """
+    Record a draft batch with an 'initiated' MpesaPayment for every leg.
+
+    Raises:
+        ValidationError: if there is nobody to pay
+    """
+    with transaction.atomic():
+        legs = collect_legs(source, user_ids)
+        if not legs:
+            raise ValidationError("There is nothing to pay from this source.")
+        batch = DisbursementBatch.objects.create(source=source, created_by=created_by, notes=notes)
+        MpesaPayment.objects.bulk_create([MpesaPayment(batch=batch, status='initiated', **leg) for leg in legs])
+
+    logger.info(f"Disbursement batch {batch.pk} ({source}): {len(legs)} payments")
+    return batch
+
+
+def _send_leg(payment_id, retries, limiter):
+    # Each pool thread holds its own DB connection
+    close_old_connections()
+    try:
+        return dispatch_stk_push(payment_id, retries=retries, limiter=limiter)
+    finally:
+        close_old_connections()
+
+
+def run_batch(batch_id, concurrency=None, rate=None, retries=None, progress=None):
+    """
+    Send every unsent push in a batch. Pushes that were already sent are
+    skipped, so a batch interrupted by a restart can simply be run again.
+
+    Args:
+        concurrency: parallel requests (default MPESA_DISBURSEMENT_CONCURRENCY)
+        rate: requests per second across all of them (default MPESA_RATE_LIMIT)
+        retries: retries per push (default MPESA_DISBURSEMENT_RETRIES)
+        progress: optional callable(done, total, sent, failed) called per push
+
+    Returns:
+        dict: total, sent, failed, elapsed (seconds)
+    """
+    concurrency = concurrency or settings.MPESA_DISBURSEMENT_CONCURRENCY
+    rate = settings.MPESA_RATE_LIMIT if rate is None else rate
+    retries = settings.MPESA_DISBURSEMENT_RETRIES if retries is None else retries
+
+    DisbursementBatch.objects.filter(pk=batch_id, status='draft').update(status='sending', started_at=timezone.now())
+    payment_ids = list(MpesaPayment.objects.filter(
+        batch_id=batch_id,
+        status='initiated',
+        checkout_request_id__isnull=True
+    ).order_by('pk').values_list('pk', flat=True))
+
+    stats = {'total': len(payment_ids), 'sent': 0, 'failed': 0, 'elapsed': 0.0}
+    limiter = RateLimiter(rate)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='mpesa-disburse') as pool:
+        futures = [pool.submit(_send_leg, payment_id, retries, limiter) for payment_id in payment_ids]
+        for future in as_completed(futures):
+            try:
+                sent = future.result().get('success')
+            except Exception:
+                logger.exception(f"Disbursement batch {batch_id}: a push raised")
+                sent = False
+            stats['sent' if sent else 'failed'] += 1
+            if progress:
+                progress(stats['sent'] + stats['failed'], stats['total'], stats['sent'], stats['failed'])
+    stats['elapsed'] = time.monotonic() - started
+
+    DisbursementBatch.objects.filter(pk=batch_id).update(status='sent', finished_at=timezone.now())
+    logger.info(
+        f"Disbursement batch {batch_id}: {stats['sent']} of {stats['total']} pushes sent, "
+        f"{stats['failed']} failed, in {stats['elapsed']:.1f}s"
+    )
+    return stats
+
+
+def start_batch(batch):
+    """Send a batch on the background executor once the current transaction commits"""
+    from . import background
+    transaction.on_commit(lambda: background.submit(run_batch, batch.pk))
+
+
+def batch_progress(batch):
+    """Counts and amounts of a batch's payments by status, for the progress page"""
+    rows = batch.payments.values('status').annotate(count=Count('pk'), amount=Sum('amount'))
+    by_status = {status: {'count': 0, 'amount': Decimal('0.00')} for status, _ in MpesaPayment.STATUS_CHOICES}
+    for row in rows:
+        by_status[row['status']] = {'count': row['count'], 'amount': row['amount']}
+    total = sum(row['count'] for row in by_status.values())
+    return {
+        'status': batch.status,
+        'total': total,
+        'queued': by_status['initiated']['count'],
+        'by_status': by_status,
+        'paid_amount': by_status['completed']['amount'],
+        'total_amount': sum((row['amount'] for row in by_status.values()), Decimal('0.00')),
+    }
+
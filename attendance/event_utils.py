@@ -0,0 +1,63 @@
+"""
+Event Lookup Utilities
+Normalised event names for the attendance autocomplete and for resolving
+free-typed event names to an existing event instead of creating a duplicate.
+"""
+import re
+import unicodedata
+from django.db import connection
+from .models import Event
+import logging
+
+logger = logging.getLogger(__name__)
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize_event_name(name):
+    """
+    Case-, accent- and punctuation-insensitive form of an event name.
+    "  Smith & Co. WEDDING " and "smith co wedding" both become "smith co wedding".
+    """
+    name = unicodedata.normalize('NFKD', name or '')
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    return ' '.join(_NON_WORD.sub(' ', name.casefold()).split())
+
+
+def search_events(q, queryset=None):
+    """
+    Events whose normalised name matches q.
+
+    PostgreSQL matches anywhere in the name using the pg_trgm GIN index.
+    Other databases match a prefix with a range on the (normalized_name, date)
+    B-tree index, since SQLite's case-insensitive LIKE can't use an index.
+    """
+    if queryset is None:
+        queryset = Event.objects.all()
+    term = normalize_event_name(q)
+    if not term:
+        return queryset
+
+    if connection.vendor == 'postgresql':
+        return queryset.filter(normalized_name__contains=term)
+
+    upper = term[:-1] + chr(ord(term[-1]) + 1)
+    return queryset.filter(normalized_name__gte=term, normalized_name__lt=upper)
+
+
+def find_or_create_event(name, date, defaults=None):
+    """
+    Resolve a free-typed event name to the existing event on that date with
+    the same normalised name, creating it only if there is none.
+
+    Returns:
+        tuple: (event, created)
+    """
+    normalized = normalize_event_name(name)
+    event = Event.objects.filter(normalized_name=normalized, date=date).order_by('id').first()
+    if event is not None:
+        return event, False
+
+    event = Event.objects.create(name=' '.join(name.split()), date=date, **(defaults or {}))
+    logger.info(f"Created event '{event.name}' for {date}")
+    return event, True
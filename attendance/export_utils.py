@@ -0,0 +1,188 @@
+"""
+Export Utilities
+CSV exports of attendance, balance adjustments, payments, salary payments and
+reimbursements for a date range. Rows are read with values_list().iterator()
+and written as they are read, so memory use doesn't grow with the range.
+
+Small ranges are streamed straight to the browser. Large ones are written to
+a file by the background executor ("prepare and download") so the request
+doesn't hold a gunicorn worker until its timeout. Progress is kept on an
+ExportJob row, so any worker can answer the status poll.
+"""
+import csv
+import os
+import uuid
+import datetime
+from django.conf import settings
+from django.utils import timezone
+from .models import AttendanceRecord, BalanceAdjustment, PaymentRecord, SalaryPayment, ExpenseReimbursement, ExportJob
+from . import background
+import logging
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_SIZE = 2000
+# Keep prepared exports (and their jobs) for a day
+EXPORT_TTL = 60 * 60 * 24
+
+
+def _day_bounds(start, end):
+    """Aware datetimes covering start 00:00 to the end of end, in local time"""
+    tz = timezone.get_current_timezone()
+    return (
+        timezone.make_aware(datetime.datetime.combine(start, datetime.time.min), tz),
+        timezone.make_aware(datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time.min), tz),
+    )
+
+
+def _attendance(start, end):
+    return AttendanceRecord.objects.filter(date__range=(start, end)).order_by('date', 'id')
+
+
+def _adjustments(start, end):
+    since, until = _day_bounds(start, end)
+    return BalanceAdjustment.objects.filter(date__gte=since, date__lt=until).order_by('date', 'id')
+
+
+def _payments(start, end):
+    since, until = _day_bounds(start, end)
+    return PaymentRecord.objects.filter(payment_date__gte=since, payment_date__lt=until).order_by('payment_date', 'id')
+
+
+def _salary(start, end):
+    return SalaryPayment.objects.filter(month_year__range=(start.replace(day=1), end)).order_by('month_year', 'id')
+
+
+def _reimbursements(start, end):
+    since, until = _day_bounds(start, end)
+    return ExpenseReimbursement.objects.filter(requested_at__gte=since, requested_at__lt=until).order_by('requested_at', 'id')
+
+
+# kind -> (label, queryset for a date range, [(column header, values_list field)])
+EXPORTS = {
+    'attendance': ('Attendance', _attendance, [
+        ('Date', 'date'), ('Check-in', 'check_in_time'), ('Username', 'user__username'),
+        ('First name', 'user__first_name'), ('Last name', 'user__last_name'),
+        ('Employment type', 'user__profile__employment_type'), ('Event', 'event_fk__name'),
+        ('Overtime hours', 'overtime_hours'), ('Amount', 'amount_paid'), ('Paid', 'is_paid'),
+    ]),
+    'adjustments': ('Balance adjustments', _adjustments, [
+        ('Date', 'date'), ('Username', 'user__username'), ('Amount', 'amount'),
+        ('Reason', 'reason'), ('Adjusted by', 'adjusted_by__username'),
+    ]),
+    'payments': ('Payments', _payments, [
+        ('Date', 'payment_date'), ('Username', 'user__username'), ('Amount', 'amount'),
+        ('Method', 'payment_method'), ('Reference', 'reference_number'), ('Notes', 'notes'),
+    ]),
+    'salary': ('Salary payments', _salary, [
+        ('Month', 'month_year'), ('Username', 'user__username'), ('Base salary', 'base_salary'),
+        ('Overtime pay', 'overtime_pay'), ('Supper allowance', 'supper_allowance'),
+        ('Total', 'total_amount'), ('Paid by', 'paid_by__username'), ('Paid at', 'paid_at'),
+    ]),
+    'reimbursements': ('Reimbursements', _reimbursements, [
+        ('Requested at', 'requested_at'), ('Username', 'user__username'), ('Event', 'event__name'),
+        ('Expense type', 'expense_type'), ('Amount', 'amount'), ('Status', 'status'),
+        ('Paid', 'is_paid'), ('Paid at', 'paid_at'),
+    ]),
+}
+
+EXPORT_CHOICES = [(kind, label) for kind, (label, _, _) in EXPORTS.items()]
+
+
+def _format(value):
+    if isinstance(value, datetime.datetime):
+        return timezone.localtime(value).strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, datetime.time):
+        return value.strftime('%H:%M:%S')
+    if value is None:
+        return ''
+    return value
+
+
+def export_rows(kind, start, end, username=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Header row followed by one row per record, read chunk_size rows at a time"""
+    _, queryset_for, columns = EXPORTS[kind]
+    queryset = queryset_for(start, end)
+    if username:
+        queryset = queryset.filter(user__username=username)
+
+    yield [header for header, _ in columns]
+    rows = queryset.values_list(*[field for _, field in columns])
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield [_format(value) for value in row]
+
+
+class _Echo:
+    """File-like object whose write() hands the line back to csv.writer's caller"""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows):
+    """Encode rows as CSV lines one at a time, for StreamingHttpResponse"""
+    writer = csv.writer(_Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def export_filename(kind, start, end, username=None):
+    parts = ['sound-fusion', kind, start.isoformat(), end.isoformat()]
+    if username:
+        parts.insert(2, username)
+    return '-'.join(parts) + '.csv'
+
+
+# ---- Prepare and download ----
+
+def _export_dir():
+    return getattr(settings, 'EXPORT_ROOT', os.path.join(settings.MEDIA_ROOT, 'exports'))
+
+
+def get_export_job(token):
+    """The ExportJob for token, or None if there is none or it has expired"""
+    cutoff = timezone.now() - datetime.timedelta(seconds=EXPORT_TTL)
+    return ExportJob.objects.filter(token=token, created_at__gte=cutoff).first()
+
+
+def export_file_path(token):
+    return os.path.join(_export_dir(), f'{token}.csv')
+
+
+def _remove_expired_exports():
+    cutoff = timezone.now().timestamp() - EXPORT_TTL
+    for entry in os.scandir(_export_dir()):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+    ExportJob.objects.filter(created_at__lt=timezone.now() - datetime.timedelta(seconds=EXPORT_TTL)).delete()
+
+
+def _write_export(token, kind, start, end, username):
+    path = export_file_path(token)
+    try:
+        os.makedirs(_export_dir(), exist_ok=True)
+        _remove_expired_exports()
+        rows = 0
+        with open(path + '.part', 'w', newline='', encoding='utf-8') as handle:
+            writer = csv.writer(handle)
+            for row in export_rows(kind, start, end, username):
+                writer.writerow(row)
+                rows += 1
+        os.replace(path + '.part', path)
+        ExportJob.objects.filter(token=token).update(status='ready', rows=rows - 1, finished_at=timezone.now())
+        logger.info(f"Prepared {kind} export {token} with {rows - 1} rows")
+    except Exception as e:
+        ExportJob.objects.filter(token=token).update(status='failed', error=str(e), finished_at=timezone.now())
+        logger.error(f"Export {token} failed: {e}")
+
+
+def prepare_export(kind, start, end, requested_by, username=None):
+    """Write the export to a file in the background; returns a token for get_export_job()"""
+    job = ExportJob.objects.create(
+        token=uuid.uuid4().hex,
+        requested_by=requested_by,
+        kind=kind,
+        filename=export_filename(kind, start, end, username),
+    )
+    background.submit(_write_export, job.token, kind, start, end, username)
+    return job.token
@@ -2,7 +2,8 @@ from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from .models import Profile, AttendanceRecord, Event, ExpenseReimbursement, EmployeeOnboarding
+from .models import Profile, AttendanceRecord, Event, ExpenseReimbursement, EmployeeOnboarding, DisbursementBatch
+from .export_utils import EXPORT_CHOICES
 
 class EmploymentTypeForm(forms.Form):
     """Form to select employment type during signup"""
@@ -75,12 +76,11 @@ class UserRegisterForm(UserCreationForm):
         return user
 
 class AttendanceForm(forms.ModelForm):
+    # Hidden: events are picked through the /api/events/ autocomplete, so the
+    # form never renders (and loads) every event as <option>s
     event_fk = forms.ModelChoiceField(
-        queryset=Event.objects.all().order_by('-date'),
-        widget=forms.Select(attrs={
-            'class': 'form-control',
-            'list': 'event_list'
-        }),
+        queryset=Event.objects.all(),
+        widget=forms.HiddenInput(),
         label='Select or Type Event',
         help_text='Select from existing events or type a new event name',
         required=False
@@ -359,4 +359,80 @@ class SalariedEmployeeRegistrationForm(UserCreationForm):
 
         if password1 and password2 and password1 != password2:
             raise ValidationError("Passwords do not match.")
-        return cleaned_data
\ No newline at end of file
+        return cleaned_data
+
+def job_role_choices():
+    """Job roles held by at least one profile, kept in the shared two-level cache"""
+    from .cache_utils import shared_cache, ROLE_CHOICES_KEY
+
+    def build():
+        in_use = set(
+            Profile.objects.exclude(job_role__isnull=True).exclude(job_role='')
+            .values_list('job_role', flat=True).distinct()
+        )
+        return [(value, label) for value, label in Profile.JOB_ROLES if value in in_use]
+
+    # Profiles are saved on every login, so this relies on a short timeout rather than invalidation
+    return shared_cache.get_or_set(ROLE_CHOICES_KEY, build, timeout=300)
+
+
+class BalanceFilterForm(forms.Form):
+    """GET filters for the manage balances page"""
+    q = forms.CharField(required=False, max_length=150, label='Search',
+                        widget=forms.TextInput(attrs={'placeholder': '🔍 Search by name, username or email...'}))
+    employment_type = forms.ChoiceField(required=False, choices=(('', 'All employment types'),) + Profile.EMPLOYMENT_TYPES)
+    job_role = forms.ChoiceField(required=False)
+    min_balance = forms.DecimalField(required=False, decimal_places=2, max_digits=10,
+                                     widget=forms.NumberInput(attrs={'placeholder': 'Min balance', 'step': '0.01'}))
+    max_balance = forms.DecimalField(required=False, decimal_places=2, max_digits=10,
+                                     widget=forms.NumberInput(attrs={'placeholder': 'Max balance', 'step': '0.01'}))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['job_role'].choices = [('', 'All job roles')] + job_role_choices()
+
+    def filter(self, users):
+        """Apply the valid filters to a User queryset"""
+        from django.db.models import Q
+
+        if not self.is_valid():
+            return users
+
+        data = self.cleaned_data
+        if data['q']:
+            users = users.filter(
+                Q(username__icontains=data['q']) | Q(email__icontains=data['q']) |
+                Q(first_name__icontains=data['q']) | Q(last_name__icontains=data['q'])
+            )
+        if data['employment_type']:
+            users = users.filter(profile__employment_type=data['employment_type'])
+        if data['job_role']:
+            users = users.filter(profile__job_role=data['job_role'])
+        if data['min_balance'] is not None:
+            users = users.filter(profile__balance__gte=data['min_balance'])
+        if data['max_balance'] is not None:
+            users = users.filter(profile__balance__lte=data['max_balance'])
+        return users
+
+
+class ExportForm(forms.Form):
+    """Date range and dataset for CSV exports"""
+    kind = forms.ChoiceField(choices=EXPORT_CHOICES, label='Data')
+    start = forms.DateField(widget=forms.DateInput(attrs={'type': 'date'}))
+    end = forms.DateField(widget=forms.DateInput(attrs={'type': 'date'}))
+    username = forms.CharField(required=False, max_length=150, label='Only this user',
+                               widget=forms.TextInput(attrs={'placeholder': 'Username (optional)'}))
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start, end = cleaned_data.get('start'), cleaned_data.get('end')
+        if start and end and start > end:
+            raise ValidationError("The start date must be on or before the end date.")
+        return cleaned_data
+
+
+class DisbursementForm(forms.Form):
+    """Who to pay, and from what, in a batch disbursement"""
+    source = forms.ChoiceField(choices=DisbursementBatch.SOURCE_CHOICES, label='Pay from')
+    users = forms.ModelMultipleChoiceField(queryset=User.objects.all())
+    notes = forms.CharField(required=False, widget=forms.Textarea(attrs={'rows': 2}))
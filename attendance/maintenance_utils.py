@@ -0,0 +1,230 @@
+"""
+Maintenance Utilities
+A small framework for data-repair jobs over AttendanceRecord. A job says
+which fields it rewrites and how to fix one record; run_job() walks the
+matching records in primary-key chunks, saves each chunk with one
+bulk_update in its own transaction and records a MaintenanceCheckpoint, so
+an interrupted run resumes where it stopped and a finished one isn't
+applied twice. A run claims its checkpoint with a conditional UPDATE, so
+two runs over one range can't proceed together, and a job that isn't
+idempotent refuses a range overlapping one it has already touched.
+"""
+import datetime
+import time
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import AttendanceRecord, MaintenanceCheckpoint
+from .activity_utils import refresh_activities
+from .cache_utils import bump_user_cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE_CHUNK_SIZE = 2000
+# Seconds without a saved chunk after which a 'running' checkpoint is taken to be a killed run
+CHECKPOINT_STALE_AFTER = 15 * 60
+
+# name -> job class, filled by @register
+JOBS = {}
+
+
+def register(job_class):
+    JOBS[job_class.name] = job_class
+    return job_class
+
+
+class MaintenanceJob:
+    """
+    Base class for attendance repair jobs.
+
+    Subclasses set name, help and fields (the columns fix() may change) and
+    implement fix(record), which corrects the record in place and returns a
+    description of the change, or None if the record was already right.
+    """
+    name = None
+    help = ''
+    fields = []
+    # Related objects fix() or describe() read, fetched with the chunk
+    select_related = ('user',)
+    # Rewrite the activity feed entries of changed records
+    refresh_activity = False
+    # True if fixing an already fixed record changes nothing, so ranges may overlap
+    idempotent = False
+
+    def queryset(self):
+        return AttendanceRecord.objects.all()
+
+    def fix(self, record):
+        raise NotImplementedError
+
+
+@register
+class TimezoneRepairJob(MaintenanceJob):
+    name = 'timezone_repair'
+    help = 'Convert check-in times that were stored in UTC to local time (Africa/Nairobi)'
+    fields = ['check_in_time']
+    select_related = ('user', 'event_fk')
+    refresh_activity = True
+
+    def fix(self, record):
+        original_time = record.check_in_time
+        stored_as_utc = datetime.datetime.combine(record.date, original_time).replace(tzinfo=datetime.timezone.utc)
+        corrected_time = stored_as_utc.astimezone(timezone.get_current_timezone()).time()
+        if corrected_time == original_time:
+            return None
+        record.check_in_time = corrected_time
+        return f"{record.user.username} ({record.date}): {original_time} → {corrected_time}"
+
+
+class CheckpointCompleted(Exception):
+    """The job already ran to completion over this scope"""
+
+
+class CheckpointConflict(Exception):
+    """Another run holds this scope, or the job already touched part of it"""
+
+
+def job_scope(start=None, end=None):
+    return f"{start or ''}..{end or ''}" if start or end else ''
+
+
+def _scope_range(scope):
+    """The (first, last) dates a job_scope() string covers"""
+    start, _, end = scope.partition('..')
+    return (
+        datetime.date.fromisoformat(start) if start else datetime.date.min,
+        datetime.date.fromisoformat(end) if end else datetime.date.max,
+    )
+
+
+def _check_overlap(job, scope):
+    """Refuse a range sharing records with another run of a job that isn't idempotent"""
+    if job.idempotent:
+        return
+    first, last = _scope_range(scope)
+    for other in MaintenanceCheckpoint.objects.filter(job=job.name).exclude(scope=scope):
+        other_first, other_last = _scope_range(other.scope)
+        if first <= other_last and other_first <= last:
+            raise CheckpointConflict(
+                f"{job.name} has a {other.get_status_display().lower()} run over {other.scope or 'all dates'} "
+                f"that overlaps this range, and running it twice over a record isn't safe"
+            )
+
+
+def _claim_checkpoint(checkpoint, restart):
+    """
+    Take the checkpoint for this run with one conditional UPDATE, so of two
+    runs started over the same scope only one proceeds. A 'running' row whose
+    run stopped saving chunks CHECKPOINT_STALE_AFTER seconds ago was killed
+    and can be taken over.
+    """
+    now = timezone.now()
+    stale = now - datetime.timedelta(seconds=CHECKPOINT_STALE_AFTER)
+    claimable = Q(status='paused') | Q(status='running', updated_at__lt=stale)
+    fields = {'status': 'running', 'updated_at': now}
+    if restart:
+        claimable |= Q(status='completed')
+        fields.update(last_pk=0, processed=0, changed=0, finished_at=None)
+    if not MaintenanceCheckpoint.objects.filter(claimable, pk=checkpoint.pk).update(**fields):
+        checkpoint.refresh_from_db()
+        if checkpoint.status == 'completed':
+            raise CheckpointCompleted(
+                f"{checkpoint.job} already completed for this range on "
+                f"{timezone.localtime(checkpoint.finished_at):%Y-%m-%d %H:%M}"
+            )
+        raise CheckpointConflict(f"{checkpoint.job} is already running over this range")
+    checkpoint.refresh_from_db()
+
+
+def run_job(job, start=None, end=None, dry_run=False, restart=False, chunk_size=MAINTENANCE_CHUNK_SIZE, progress=None):
+    """
+    Run a MaintenanceJob over records dated start..end (either may be None).
+
+    Args:
+        dry_run: report what would change without saving or checkpointing
+        restart: ignore an existing checkpoint for this scope and start over
+        progress: optional callable(stats) called after each chunk
+
+    Returns:
+        dict: processed, changed, elapsed (seconds), rate (records/second),
+              resumed_from (pk) and changes (descriptions of changed records)
+
+    Raises:
+        CheckpointCompleted: if the job already finished over this scope and
+                             restart wasn't given
+        CheckpointConflict: if another run holds this scope, or the job isn't
+                            idempotent and already ran over part of it
+    """
+    queryset = job.queryset()
+    if start:
+        queryset = queryset.filter(date__gte=start)
+    if end:
+        queryset = queryset.filter(date__lte=end)
+    queryset = queryset.select_related(*job.select_related).order_by('pk')
+
+    checkpoint = None
+    if not dry_run:
+        scope = job_scope(start, end)
+        _check_overlap(job, scope)
+        checkpoint, _ = MaintenanceCheckpoint.objects.get_or_create(
+            job=job.name, scope=scope, defaults={'status': 'paused'}
+        )
+        _claim_checkpoint(checkpoint, restart)
+
+    last_pk = checkpoint.last_pk if checkpoint else 0
+    stats = {
+        'processed': 0, 'changed': 0, 'elapsed': 0.0, 'rate': 0.0,
+        'total': queryset.filter(pk__gt=last_pk).count(),
+        'resumed_from': last_pk, 'changes': [],
+    }
+    started = time.monotonic()
+
+    try:
+        while True:
+            records = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+            if not records:
+                break
+            last_pk = records[-1].pk
+
+            changed = []
+            for record in records:
+                description = job.fix(record)
+                if description:
+                    changed.append(record)
+                    stats['changes'].append(description)
+
+            if not dry_run:
+                with transaction.atomic():
+                    if changed:
+                        AttendanceRecord.objects.bulk_update(changed, job.fields)
+                        if job.refresh_activity:
+                            refresh_activities(changed)
+                        bump_user_cache(*{record.user_id for record in changed})
+                    checkpoint.last_pk = last_pk
+                    checkpoint.processed += len(records)
+                    checkpoint.changed += len(changed)
+                    checkpoint.save(update_fields=['last_pk', 'processed', 'changed', 'updated_at'])
+
+            stats['processed'] += len(records)
+            stats['changed'] += len(changed)
+            stats['elapsed'] = time.monotonic() - started
+            stats['rate'] = stats['processed'] / stats['elapsed'] if stats['elapsed'] else 0.0
+            if progress:
+                progress(stats)
+    except BaseException:
+        # Let the next run resume from the last saved chunk without waiting out CHECKPOINT_STALE_AFTER
+        if checkpoint:
+            MaintenanceCheckpoint.objects.filter(pk=checkpoint.pk, status='running').update(status='paused')
+        raise
+
+    if checkpoint:
+        checkpoint.status = 'completed'
+        checkpoint.finished_at = timezone.now()
+        checkpoint.save(update_fields=['status', 'finished_at', 'updated_at'])
+
+    logger.info(
+        f"Maintenance job {job.name}{' (dry run)' if dry_run else ''}: {stats['changed']} of "
+        f"{stats['processed']} records changed in {stats['elapsed']:.1f}s"
+    )
+    return stats
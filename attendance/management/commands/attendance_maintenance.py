@@ -0,0 +1,72 @@
+"""
+Management command to run a resumable data-repair job over attendance records
+Run with: python manage.py attendance_maintenance JOB [--from DATE] [--to DATE] [--dry-run] [--restart]
+Jobs: see attendance/maintenance_utils.py (python manage.py attendance_maintenance --help)
+"""
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from attendance.maintenance_utils import JOBS, run_job, CheckpointCompleted, CheckpointConflict, MAINTENANCE_CHUNK_SIZE
+
+
+def _date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'{value} is not a date (use YYYY-MM-DD)')
+
+
+class Command(BaseCommand):
+    help = 'Run a chunked, resumable repair job over attendance records: ' + '; '.join(
+        f'{name}: {job.help}' for name, job in JOBS.items()
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('job', choices=sorted(JOBS), help='Job to run')
+        parser.add_argument('--from', dest='start', help='First attendance date to process (YYYY-MM-DD)')
+        parser.add_argument('--to', dest='end', help='Last attendance date to process (YYYY-MM-DD)')
+        parser.add_argument('--dry-run', action='store_true', help='Show what would change without saving')
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Start from the beginning even if a checkpoint exists (re-applies a completed job)'
+        )
+        parser.add_argument('--chunk-size', type=int, default=MAINTENANCE_CHUNK_SIZE)
+        parser.add_argument('--show', type=int, default=20, help='How many changed records to list (default 20)')
+
+    def handle(self, *args, **options):
+        job = JOBS[options['job']]()
+        start = _date(options['start']) if options['start'] else None
+        end = _date(options['end']) if options['end'] else None
+
+        def progress(stats):
+            self.stdout.write(
+                f"  {stats['processed']}/{stats['total']} processed, {stats['changed']} changed "
+                f"({stats['rate']:,.0f} records/s)"
+            )
+
+        try:
+            stats = run_job(
+                job, start=start, end=end,
+                dry_run=options['dry_run'],
+                restart=options['restart'],
+                chunk_size=options['chunk_size'],
+                progress=progress
+            )
+        except CheckpointCompleted as e:
+            raise CommandError(f'{e}. Pass --restart to run it again.')
+        except CheckpointConflict as e:
+            raise CommandError(str(e))
+
+        if stats['resumed_from']:
+            self.stdout.write(f"Resumed after record #{stats['resumed_from']}")
+        for description in stats['changes'][:options['show']]:
+            self.stdout.write(f'  {description}')
+        if len(stats['changes']) > options['show']:
+            self.stdout.write(f"  ... and {len(stats['changes']) - options['show']} more")
+
+        summary = (f"{stats['changed']} of {stats['processed']} records in {stats['elapsed']:.1f}s "
+                   f"({stats['rate']:,.0f} records/s)")
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'Dry run, nothing saved: {job.name} would change {summary}'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'✓ {job.name} changed {summary}'))
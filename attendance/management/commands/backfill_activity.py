@@ -0,0 +1,22 @@
+"""
+Management command to populate the activity feed from existing history
+Run with: python manage.py backfill_activity [--chunk-size N]
+"""
+from django.core.management.base import BaseCommand
+from attendance.activity_utils import backfill_activity
+
+
+class Command(BaseCommand):
+    help = 'Create activity feed entries for attendance, adjustments and payments recorded before the feed existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=2000,
+            help='Rows read and inserted per batch (default: 2000)'
+        )
+
+    def handle(self, *args, **options):
+        created = backfill_activity(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'✓ Activity feed backfilled with {created} entries'))
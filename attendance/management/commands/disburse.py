@@ -0,0 +1,72 @@
+"""
+Management command to pay outstanding balances or approved reimbursements over M-Pesa
+Run with: python manage.py disburse --source balance|reimbursements [--user USERNAME ...] [--dry-run]
+          python manage.py disburse --batch ID    (send whatever an earlier batch didn't get to)
+"""
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from attendance.models import DisbursementBatch
+from attendance.disbursement_utils import collect_legs, create_batch, run_batch
+
+
+class Command(BaseCommand):
+    help = 'Send M-Pesa STK pushes to everyone owed from balances or approved reimbursements'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', choices=[value for value, _ in DisbursementBatch.SOURCE_CHOICES])
+        parser.add_argument('--batch', type=int, help='Resume an existing batch instead of creating one')
+        parser.add_argument(
+            '--user',
+            action='append',
+            dest='usernames',
+            help='Only pay these users (can be given more than once)'
+        )
+        parser.add_argument('--notes', default='')
+        parser.add_argument('--concurrency', type=int, help='Parallel requests (default MPESA_DISBURSEMENT_CONCURRENCY)')
+        parser.add_argument('--rate', type=float, help='Requests per second (default MPESA_RATE_LIMIT)')
+        parser.add_argument('--dry-run', action='store_true', help='List who would be paid without sending anything')
+
+    def handle(self, *args, **options):
+        if bool(options['source']) == bool(options['batch']):
+            raise CommandError('Give either --source or --batch')
+
+        if options['batch']:
+            try:
+                batch = DisbursementBatch.objects.get(pk=options['batch'])
+            except DisbursementBatch.DoesNotExist:
+                raise CommandError(f"Disbursement batch {options['batch']} not found")
+        else:
+            user_ids = None
+            if options['usernames']:
+                user_ids = list(User.objects.filter(username__in=options['usernames']).values_list('pk', flat=True))
+                if len(user_ids) != len(set(options['usernames'])):
+                    raise CommandError('One or more usernames were not found')
+
+            if options['dry_run']:
+                legs = collect_legs(options['source'], user_ids)
+                usernames = dict(User.objects.filter(pk__in={leg['user_id'] for leg in legs}).values_list('pk', 'username'))
+                for leg in legs:
+                    self.stdout.write(
+                        f"  {usernames[leg['user_id']]:<20} {leg['phone_number']:<14} "
+                        f"{leg['amount']:>10}  {leg['payment_purpose']}"
+                    )
+                total = sum(leg['amount'] for leg in legs)
+                self.stdout.write(self.style.WARNING(f'Dry run, nothing sent: would pay {len(legs)} people KSH {total:,}'))
+                return
+
+            try:
+                batch = create_batch(options['source'], user_ids=user_ids, notes=options['notes'])
+            except ValidationError as e:
+                raise CommandError(e.messages[0])
+            self.stdout.write(f'Created disbursement batch #{batch.pk} with {batch.payments.count()} payments')
+
+        def progress(done, total, sent, failed):
+            if done % 10 == 0 or done == total:
+                self.stdout.write(f'  {done}/{total} pushes, {sent} sent, {failed} failed')
+
+        stats = run_batch(batch.pk, concurrency=options['concurrency'], rate=options['rate'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(
+            f"✓ Batch #{batch.pk}: {stats['sent']} of {stats['total']} pushes sent, "
+            f"{stats['failed']} failed, in {stats['elapsed']:.1f}s"
+        ))
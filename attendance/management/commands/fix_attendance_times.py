@@ -1,47 +1,31 @@
 """
-Management command to fix existing attendance record times by adding 3 hours
-Run with: python manage.py fix_attendance_times
+Management command to fix existing attendance record times stored in UTC
+Run with: python manage.py fix_attendance_times [--from DATE] [--to DATE] [--dry-run] [--restart]
+Shortcut for: python manage.py attendance_maintenance timezone_repair
 """
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from attendance.models import AttendanceRecord
-import datetime
+
 
 class Command(BaseCommand):
     help = 'Fix attendance record times by correcting timezone offset'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', help='First attendance date to fix (YYYY-MM-DD)')
+        parser.add_argument('--to', dest='end', help='Last attendance date to fix (YYYY-MM-DD)')
+        parser.add_argument('--dry-run', action='store_true', help='Show what would change without saving')
+        parser.add_argument('--restart', action='store_true', help='Start over even if a checkpoint exists')
+
     def handle(self, *args, **options):
-        records = AttendanceRecord.objects.all()
-        fixed_count = 0
-        
-        for record in records:
-            # Store original time
-            original_time = record.check_in_time
-            
-            # Create a datetime combining date and time
-            dt_naive = datetime.datetime.combine(record.date, original_time)
-            
-            # Make it timezone aware in UTC (assuming it was stored as UTC)
-            dt_utc = dt_naive.replace(tzinfo=datetime.timezone.utc)
-            
-            # Convert to local timezone (Africa/Nairobi)
-            dt_local = dt_utc.astimezone(timezone.get_current_timezone())
-            
-            # Extract the corrected time
-            corrected_time = dt_local.time()
-            
-            # Only update if time is different (to avoid unnecessary writes)
-            if corrected_time != original_time:
-                record.check_in_time = corrected_time
-                record.save(update_fields=['check_in_time'])
-                fixed_count += 1
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f'Fixed {record.user.username} ({record.date}): '
-                        f'{original_time} → {corrected_time}'
-                    )
-                )
-        
-        self.stdout.write(
-            self.style.SUCCESS(f'\nTotal records fixed: {fixed_count}')
+        arguments = ['timezone_repair']
+        if options['start']:
+            arguments += ['--from', options['start']]
+        if options['end']:
+            arguments += ['--to', options['end']]
+        call_command(
+            'attendance_maintenance', *arguments,
+            dry_run=options['dry_run'],
+            restart=options['restart'],
+            stdout=self.stdout,
+            stderr=self.stderr
         )
@@ -0,0 +1,61 @@
+"""
+Management command to compute (and optionally commit) a month's salaried payroll
+Run with: python manage.py payroll_run [--month YYYY-MM] [--commit]
+"""
+import datetime
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from attendance.payroll_utils import draft_payroll_run, commit_payroll_run
+
+
+class Command(BaseCommand):
+    help = 'Compute the payroll draft for salaried employees and optionally commit it as salary payments'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--month',
+            help='Month to pay as YYYY-MM (defaults to last month)'
+        )
+        parser.add_argument(
+            '--commit',
+            action='store_true',
+            help='Create the salary payments after computing the draft'
+        )
+
+    def handle(self, *args, **options):
+        if options['month']:
+            try:
+                month_year = datetime.datetime.strptime(options['month'], '%Y-%m').date()
+            except ValueError:
+                raise CommandError('--month must look like 2025-01')
+        else:
+            month_year = (timezone.localdate().replace(day=1) - datetime.timedelta(days=1)).replace(day=1)
+
+        try:
+            run, already_paid = draft_payroll_run(month_year)
+        except ValidationError as e:
+            raise CommandError(' '.join(e.messages))
+
+        lines = list(run.lines.select_related('user'))
+        self.stdout.write(f'Payroll draft for {month_year:%B %Y}:')
+        for line in lines:
+            self.stdout.write(
+                f'  {line.user.username:<20} {line.days_worked:>3} days  {line.overtime_hours:>4} OT hrs  '
+                f'base {line.base_salary:>10}  OT {line.overtime_pay:>9}  supper {line.supper_allowance:>8}  '
+                f'total {line.total_amount:>10}'
+            )
+        if already_paid:
+            self.stdout.write(self.style.WARNING(f'  {len(already_paid)} employees already paid for this month were skipped'))
+        total = sum(line.total_amount for line in lines)
+        self.stdout.write(self.style.SUCCESS(f'✓ Draft computed: {len(lines)} employees, KSH {total:,.2f}'))
+
+        if not options['commit']:
+            self.stdout.write('Review the draft in the admin, or re-run with --commit to pay it.')
+            return
+
+        try:
+            created = commit_payroll_run(run)
+        except ValidationError as e:
+            raise CommandError(' '.join(e.messages))
+        self.stdout.write(self.style.SUCCESS(f'✓ Committed {created} salary payments'))
@@ -0,0 +1,40 @@
+"""
+Management command to recompute every Profile.balance from the balance ledger
+Run with: python manage.py rebuild_balances [--reseed] [--user USERNAME ...]
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from attendance.balance_utils import reseed_ledger, rebuild_balances
+
+
+class Command(BaseCommand):
+    help = 'Recompute user balances from the balance ledger in one set-based pass'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reseed',
+            action='store_true',
+            help='Rebuild the ledger from attendance, adjustments and salary payments first'
+        )
+        parser.add_argument(
+            '--user',
+            action='append',
+            dest='usernames',
+            help='Only rebuild these users (can be given more than once)'
+        )
+
+    def handle(self, *args, **options):
+        user_ids = None
+        if options['usernames']:
+            if options['reseed']:
+                raise CommandError('--reseed rebuilds the whole ledger and cannot be combined with --user')
+            user_ids = list(User.objects.filter(username__in=options['usernames']).values_list('id', flat=True))
+            if len(user_ids) != len(set(options['usernames'])):
+                raise CommandError('One or more usernames were not found')
+
+        if options['reseed']:
+            entries = reseed_ledger()
+            self.stdout.write(self.style.SUCCESS(f'✓ Ledger reseeded with {entries} entries'))
+
+        updated = rebuild_balances(user_ids)
+        self.stdout.write(self.style.SUCCESS(f'✓ Rebuilt {updated} balances from the ledger'))
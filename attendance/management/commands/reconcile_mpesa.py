@@ -0,0 +1,62 @@
+"""
+Management command to settle pending M-Pesa payments whose callback never arrived
+Run with: python manage.py reconcile_mpesa [--older-than SECONDS] [--limit N] [--dry-run]
+          python manage.py reconcile_mpesa --stats [--days N]
+Schedule it with cron (e.g. every 5 minutes); runs never overlap and each is
+recorded as an MpesaReconcileRun.
+"""
+import datetime
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from attendance.reconcile_utils import reconcile_pending, run_reconciliation, settlement_metrics, ReconcileBusy
+
+
+class Command(BaseCommand):
+    help = 'Query M-Pesa for stale pending payments and apply the results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, help='Seconds pending before a payment is queried (default MPESA_RECONCILE_AFTER)')
+        parser.add_argument('--limit', type=int, help='Most payments to query (default MPESA_RECONCILE_BATCH)')
+        parser.add_argument('--concurrency', type=int, help='Parallel queries (default MPESA_RECONCILE_CONCURRENCY)')
+        parser.add_argument('--dry-run', action='store_true', help='Query M-Pesa but change nothing')
+        parser.add_argument('--stats', action='store_true', help='Only show settlement metrics')
+        parser.add_argument('--days', type=int, default=7, help='Days of payments the metrics cover (default 7)')
+
+    def reconcile(self, options):
+        """Stats of this run, or None if another run is in progress"""
+        selection = {key: options[key] for key in ('older_than', 'limit', 'concurrency')}
+        if options['dry_run']:
+            return reconcile_pending(dry_run=True, **selection)
+        try:
+            return run_reconciliation('command', **selection)
+        except ReconcileBusy as e:
+            self.stdout.write(self.style.WARNING(f'{e}; skipped'))
+            return None
+
+    def handle(self, *args, **options):
+        if not options['stats']:
+            stats = self.reconcile(options)
+            if stats is None:
+                return
+            outcomes = ', '.join(
+                f'{stats[key]} {key}' for key in sorted(stats) if key not in ('checked', 'elapsed')
+            ) or 'nothing pending'
+            summary = f"{stats['checked']} payments checked in {stats['elapsed']:.1f}s: {outcomes}"
+            if options['dry_run']:
+                self.stdout.write(self.style.WARNING(f'Dry run, nothing changed: {summary}'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'✓ Reconciled {summary}'))
+
+        metrics = settlement_metrics(timezone.now() - datetime.timedelta(days=options['days']))
+        seconds = metrics['settle_seconds']
+        self.stdout.write(f"Payments settled in the last {options['days']} days: {metrics['settled']}")
+        for status, count in sorted(metrics['by_status'].items()):
+            self.stdout.write(f'  {status:<10} {count}')
+        for source, count in sorted(metrics['by_source'].items()):
+            self.stdout.write(f'  via {source:<10} {count}')
+        if metrics['settled']:
+            self.stdout.write(
+                f"Settle time: median {seconds['p50']:.0f}s, 90th percentile {seconds['p90']:.0f}s, "
+                f"slowest {seconds['max']:.0f}s"
+            )
+        self.stdout.write(f"Still pending: {metrics['pending']} ({metrics['stale_pending']} overdue)")
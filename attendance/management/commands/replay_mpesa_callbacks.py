@@ -0,0 +1,72 @@
+"""
+Management command to apply logged M-Pesa callbacks again
+Run with: python manage.py replay_mpesa_callbacks [--since DATE] [--id ID ...] [--reapply] [--dry-run]
+By default replays callbacks that were never applied: still received (e.g. the
+worker restarted), unmatched (arrived before their push was saved) or errored.
+"""
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from attendance.models import MpesaCallbackLog
+from attendance.mpesa_utils import process_callback_log
+
+REPLAY_STATUSES = ('received', 'unmatched', 'error')
+
+
+class Command(BaseCommand):
+    help = 'Re-process M-Pesa callbacks from the callback log, oldest first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only callbacks received on or after this date (YYYY-MM-DD)')
+        parser.add_argument('--id', type=int, action='append', dest='ids', help='Only this log entry (can be repeated)')
+        parser.add_argument(
+            '--reapply',
+            action='store_true',
+            help='Also apply callbacks that were already processed (not duplicates)'
+        )
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=60,
+            help='Skip callbacks younger than this many seconds, which are still being applied (default 60)'
+        )
+        parser.add_argument('--dry-run', action='store_true', help='List the callbacks without applying them')
+
+    def handle(self, *args, **options):
+        entries = MpesaCallbackLog.objects.order_by('received_at', 'pk')
+        if options['ids']:
+            entries = entries.filter(pk__in=options['ids'])
+        else:
+            statuses = REPLAY_STATUSES + (('processed',) if options['reapply'] else ())
+            entries = entries.filter(
+                status__in=statuses,
+                received_at__lte=timezone.now() - datetime.timedelta(seconds=options['min_age'])
+            )
+        if options['since']:
+            try:
+                since = datetime.date.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError(f"{options['since']} is not a date (use YYYY-MM-DD)")
+            entries = entries.filter(received_at__date__gte=since)
+
+        outcomes = {}
+        for entry in entries.iterator():
+            if options['dry_run']:
+                self.stdout.write(
+                    f"  #{entry.pk} {timezone.localtime(entry.received_at):%Y-%m-%d %H:%M:%S} "
+                    f"{entry.checkout_request_id or '?'} result {entry.result_code} ({entry.status})"
+                )
+                outcomes[entry.status] = outcomes.get(entry.status, 0) + 1
+                continue
+            status = process_callback_log(entry.pk, reapply=options['reapply'] or bool(options['ids']))
+            status = status or 'busy'
+            outcomes[status] = outcomes.get(status, 0) + 1
+            if status == 'error':
+                entry.refresh_from_db(fields=['error'])
+                self.stdout.write(self.style.ERROR(f'  #{entry.pk}: {entry.error}'))
+
+        summary = ', '.join(f'{count} {status}' for status, count in sorted(outcomes.items())) or 'nothing to do'
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'Dry run, nothing applied: {summary}'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'✓ Replayed callbacks: {summary}'))
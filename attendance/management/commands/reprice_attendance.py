@@ -0,0 +1,94 @@
+"""
+Management command to re-apply the pay rate card to existing attendance
+Run with: python manage.py reprice_attendance [--from DATE] [--to DATE] [--user USERNAME ...]
+                                              [--employment-type TYPE] [--include-paid] [--dry-run]
+"""
+import datetime
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from attendance.models import AttendanceRecord, Profile
+from attendance.pay_utils import reprice_attendance, REPRICE_CHUNK_SIZE
+
+
+def _date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f'{value} is not a date (use YYYY-MM-DD)')
+
+
+class Command(BaseCommand):
+    help = 'Recompute attendance amounts from the PayRule rate card and post the differences to balances'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', help='First attendance date to reprice (YYYY-MM-DD)')
+        parser.add_argument('--to', dest='end', help='Last attendance date to reprice (YYYY-MM-DD)')
+        parser.add_argument(
+            '--user',
+            action='append',
+            dest='usernames',
+            help='Only reprice these users (can be given more than once)'
+        )
+        parser.add_argument(
+            '--employment-type',
+            choices=[value for value, _ in Profile.EMPLOYMENT_TYPES],
+            help='Only reprice users with this employment type'
+        )
+        parser.add_argument(
+            '--include-paid',
+            action='store_true',
+            help='Also reprice records already marked paid (does not change balances)'
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Show what would change without saving')
+        parser.add_argument('--chunk-size', type=int, default=REPRICE_CHUNK_SIZE)
+        parser.add_argument('--show', type=int, default=20, help='How many changed records to list (default 20)')
+
+    def handle(self, *args, **options):
+        records = AttendanceRecord.objects.all()
+        if options['start']:
+            records = records.filter(date__gte=_date(options['start']))
+        if options['end']:
+            records = records.filter(date__lte=_date(options['end']))
+        if options['employment_type']:
+            records = records.filter(user__profile__employment_type=options['employment_type'])
+        if options['usernames']:
+            users = User.objects.filter(username__in=options['usernames'])
+            if users.count() != len(set(options['usernames'])):
+                raise CommandError('One or more usernames were not found')
+            records = records.filter(user__in=users)
+
+        started = time.monotonic()
+
+        def progress(scanned, total, changed):
+            self.stdout.write(f'  {scanned}/{total} records checked, {changed} changed')
+
+        result = reprice_attendance(
+            records,
+            dry_run=options['dry_run'],
+            include_paid=options['include_paid'],
+            chunk_size=options['chunk_size'],
+            progress=progress
+        )
+        elapsed = time.monotonic() - started
+
+        if result['changes']:
+            usernames = dict(User.objects.filter(
+                id__in={change[1] for change in result['changes']}
+            ).values_list('id', 'username'))
+            for record_id, user_id, date, old, new, is_paid in result['changes'][:options['show']]:
+                paid = ' (paid)' if is_paid else ''
+                self.stdout.write(f'  {usernames[user_id]:<20} {date}  {old:>10} -> {new:>10}{paid}')
+            if len(result['changes']) > options['show']:
+                self.stdout.write(f'  ... and {len(result["changes"]) - options["show"]} more')
+
+            self.stdout.write('Balance changes:')
+            for user_id, delta in sorted(result['user_deltas'].items(), key=lambda item: usernames[item[0]]):
+                self.stdout.write(f'  {usernames[user_id]:<20} {delta:+,.2f}')
+
+        summary = (f'{result["changed"]} of {result["scanned"]} records, '
+                   f'balances {result["total_delta"]:+,.2f} KSH, in {elapsed:.1f}s')
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'Dry run, nothing saved: would reprice {summary}'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'✓ Repriced {summary}'))
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:47
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def seed_ledger(apps, schema_editor):
+    """Open the ledger with one entry per row that currently counts towards a balance"""
+    BalanceLedgerEntry = apps.get_model('attendance', 'BalanceLedgerEntry')
+    AttendanceRecord = apps.get_model('attendance', 'AttendanceRecord')
+    BalanceAdjustment = apps.get_model('attendance', 'BalanceAdjustment')
+    SalaryPayment = apps.get_model('attendance', 'SalaryPayment')
+
+    sources = (
+        ('attendance', AttendanceRecord.objects.filter(is_paid=False).exclude(amount_paid=0), 'amount_paid'),
+        ('adjustment', BalanceAdjustment.objects.exclude(amount=0), 'amount'),
+        ('salary', SalaryPayment.objects.exclude(total_amount=0), 'total_amount'),
+    )
+    for source_type, queryset, amount_field in sources:
+        BalanceLedgerEntry.objects.bulk_create(
+            [
+                BalanceLedgerEntry(user_id=user_id, source_type=source_type, source_id=pk, amount=amount)
+                for pk, user_id, amount in queryset.values_list('pk', 'user_id', amount_field).iterator()
+            ],
+            batch_size=2000
+        )
+
+
+def clear_ledger(apps, schema_editor):
+    apps.get_model('attendance', 'BalanceLedgerEntry').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0030_expensereimbursement_checkout_request_id_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceLedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_type', models.CharField(choices=[('attendance', 'Attendance'), ('adjustment', 'Balance Adjustment'), ('salary', 'Salary Payment')], max_length=20)),
+                ('source_id', models.PositiveBigIntegerField(help_text='Primary key of the row that caused this change')),
+                ('amount', models.DecimalField(decimal_places=2, help_text='Signed change to the balance', max_digits=12)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_ledger_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Balance ledger entries',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['source_type', 'source_id'], name='attendance__source__071186_idx'), models.Index(fields=['user', 'created_at'], name='attendance__user_id_0f3c89_idx')],
+            },
+        ),
+        migrations.RunPython(seed_ledger, clear_ledger),
+    ]
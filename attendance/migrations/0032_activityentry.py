@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:53
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0031_balanceledgerentry'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('activity_type', models.CharField(choices=[('attendance', 'Attendance'), ('adjustment', 'Admin Change'), ('payment', 'Payment'), ('salary', 'Salary Payment')], max_length=20)),
+                ('source_id', models.PositiveBigIntegerField(help_text='Primary key of the row this entry describes')),
+                ('occurred_at', models.DateTimeField()),
+                ('summary', models.CharField(blank=True, max_length=255)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, help_text='Signed effect on the balance', max_digits=12)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='activity_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Activity entries',
+                'ordering': ['-occurred_at'],
+                'indexes': [models.Index(fields=['user', '-occurred_at'], name='attendance__user_id_d614ee_idx')],
+                'constraints': [models.UniqueConstraint(fields=('activity_type', 'source_id'), name='unique_activity_per_source')],
+            },
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:58
+
+import logging
+import re
+import unicodedata
+from django.conf import settings
+from django.db import migrations, models, transaction
+
+logger = logging.getLogger(__name__)
+
+
+_NON_WORD = re.compile(r'[\W_]+')
+
+
+def normalize_event_name(name):
+    """Frozen copy of attendance.event_utils.normalize_event_name as of this migration"""
+    name = unicodedata.normalize('NFKD', name or '')
+    name = ''.join(char for char in name if not unicodedata.combining(char))
+    return ' '.join(_NON_WORD.sub(' ', name.casefold()).split())
+
+
+def fill_normalized_names(apps, schema_editor):
+    Event = apps.get_model('attendance', 'Event')
+    events = []
+    for event in Event.objects.only('id', 'name').iterator(chunk_size=2000):
+        event.normalized_name = normalize_event_name(event.name)
+        events.append(event)
+    Event.objects.bulk_update(events, ['normalized_name'], batch_size=2000)
+
+
+def create_trigram_index(apps, schema_editor):
+    """pg_trgm GIN index for substring search on PostgreSQL; other databases use the B-tree index"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    try:
+        # Savepoint so a missing CREATE EXTENSION privilege doesn't abort the migration
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            schema_editor.execute(
+                'CREATE INDEX IF NOT EXISTS event_normalized_name_trgm '
+                'ON attendance_event USING gin (normalized_name gin_trgm_ops)'
+            )
+    except Exception as e:
+        logger.warning(f"Skipping pg_trgm index on attendance_event: {e}")
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS event_normalized_name_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0033_event_date_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='normalized_name',
+            field=models.CharField(blank=True, editable=False, help_text='Lowercased name without punctuation, used for lookups', max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['normalized_name', 'date'], name='event_normalized_name_idx'),
+        ),
+        migrations.RunPython(fill_normalized_names, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
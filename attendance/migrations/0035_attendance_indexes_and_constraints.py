@@ -0,0 +1,82 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:58
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Min, Sum
+
+
+def remove_duplicate_attendance(apps, schema_editor):
+    """
+    Keep the first record for each (user, date) and delete the rest so the
+    unique constraint can be added. Whatever the duplicates posted to the
+    balance ledger is reversed and their activity feed entries are removed.
+    """
+    AttendanceRecord = apps.get_model('attendance', 'AttendanceRecord')
+    BalanceLedgerEntry = apps.get_model('attendance', 'BalanceLedgerEntry')
+    ActivityEntry = apps.get_model('attendance', 'ActivityEntry')
+    Profile = apps.get_model('attendance', 'Profile')
+
+    duplicated_days = (
+        AttendanceRecord.objects.values('user_id', 'date')
+        .annotate(first_id=Min('id'), rows=Count('id'))
+        .filter(rows__gt=1)
+    )
+    for day in duplicated_days:
+        duplicates = AttendanceRecord.objects.filter(
+            user_id=day['user_id'], date=day['date']
+        ).exclude(id=day['first_id'])
+        duplicate_ids = list(duplicates.values_list('id', flat=True))
+
+        posted = (
+            BalanceLedgerEntry.objects.filter(source_type='attendance', source_id__in=duplicate_ids)
+            .values('source_id').annotate(total=Sum('amount'))
+        )
+        reversals = [
+            BalanceLedgerEntry(user_id=day['user_id'], source_type='attendance',
+                               source_id=row['source_id'], amount=-row['total'])
+            for row in posted if row['total']
+        ]
+        if reversals:
+            BalanceLedgerEntry.objects.bulk_create(reversals)
+            Profile.objects.filter(user_id=day['user_id']).update(
+                balance=F('balance') - sum(row['total'] for row in posted if row['total'])
+            )
+
+        ActivityEntry.objects.filter(activity_type='attendance', source_id__in=duplicate_ids).delete()
+        duplicates.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0034_event_normalized_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_attendance, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='salarypayment',
+            unique_together=set(),
+        ),
+        migrations.AddIndex(
+            model_name='attendancerecord',
+            index=models.Index(condition=models.Q(('is_paid', False)), fields=['user'], name='attendance_unpaid_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='attendancerecord',
+            index=models.Index(fields=['event_fk', 'date'], name='attendance_event_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expensereimbursement',
+            index=models.Index(fields=['status', 'requested_at'], name='reimbursement_status_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='attendancerecord',
+            constraint=models.UniqueConstraint(fields=('user', 'date'), name='unique_attendance_per_user_per_day'),
+        ),
+        migrations.AddConstraint(
+            model_name='salarypayment',
+            constraint=models.UniqueConstraint(fields=('user', 'month_year'), name='unique_salary_per_user_per_month'),
+        ),
+    ]
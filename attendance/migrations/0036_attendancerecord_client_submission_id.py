@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0035_attendance_indexes_and_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attendancerecord',
+            name='client_submission_id',
+            field=models.CharField(blank=True, editable=False, help_text='Idempotency key of an offline submission', max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0036_attendancerecord_client_submission_id'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayrollRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month_year', models.DateField(help_text='First day of the month being paid', unique=True)),
+                ('status', models.CharField(choices=[('draft', 'Draft'), ('committed', 'Committed')], default='draft', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('computed_at', models.DateTimeField(blank=True, help_text='When the draft lines were last computed', null=True)),
+                ('committed_at', models.DateTimeField(blank=True, null=True)),
+                ('notes', models.TextField(blank=True)),
+                ('committed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payroll_runs_committed', to=settings.AUTH_USER_MODEL)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payroll_runs_created', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-month_year'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PayrollRunLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('days_worked', models.PositiveIntegerField(default=0)),
+                ('overtime_hours', models.PositiveIntegerField(default=0)),
+                ('base_salary', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('overtime_pay', models.DecimalField(decimal_places=2, default=0.0, max_digits=10)),
+                ('supper_allowance', models.DecimalField(decimal_places=2, default=0.0, max_digits=10)),
+                ('total_amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='attendance.payrollrun')),
+                ('salary_payment', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payroll_line', to='attendance.salarypayment')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payroll_lines', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['user__username'],
+                'constraints': [models.UniqueConstraint(fields=('run', 'user'), name='unique_payroll_line_per_user')],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:08
+
+import datetime
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def seed_default_rules(apps, schema_editor):
+    """The rates that were hardcoded before the rate card: casual 1000 + 100/OT hour, salaried overtime only"""
+    PayRule = apps.get_model('attendance', 'PayRule')
+    for employment_type, base_daily_pay in (('casual', 1000), ('salaried', 0)):
+        PayRule.objects.get_or_create(
+            employment_type=employment_type,
+            job_role='',
+            event=None,
+            effective_from=datetime.date(2000, 1, 1),
+            defaults={'base_daily_pay': base_daily_pay, 'overtime_rate': 100, 'notes': 'Default rate'}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0037_payrollrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PayRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('employment_type', models.CharField(blank=True, choices=[('casual', 'Casual Laborer'), ('salaried', 'Salaried Employee')], help_text='Leave blank to match every employment type', max_length=20)),
+                ('job_role', models.CharField(blank=True, choices=[('repair', 'Repair Technician'), ('driver', 'Driver'), ('accountant', 'Accountant'), ('planner', 'Event Planner'), ('cleaner', 'Cleaner'), ('other', 'Other')], help_text='Leave blank to match every job role', max_length=50)),
+                ('effective_from', models.DateField(help_text='Attendance on or after this date is paid at these rates')),
+                ('base_daily_pay', models.DecimalField(decimal_places=2, help_text='Paid per day attended', max_digits=10)),
+                ('overtime_rate', models.DecimalField(decimal_places=2, help_text='Paid per overtime hour', max_digits=10)),
+                ('notes', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('event', models.ForeignKey(blank=True, help_text='Leave empty to match every event', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='pay_rules', to='attendance.event')),
+            ],
+            options={
+                'ordering': ['employment_type', 'job_role', '-effective_from'],
+                'constraints': [models.UniqueConstraint(fields=('employment_type', 'job_role', 'event', 'effective_from'), name='unique_pay_rule_version'), models.UniqueConstraint(condition=models.Q(('event__isnull', True)), fields=('employment_type', 'job_role', 'effective_from'), name='unique_pay_rule_version_all_events')],
+            },
+        ),
+        migrations.RunPython(seed_default_rules, migrations.RunPython.noop),
+    ]
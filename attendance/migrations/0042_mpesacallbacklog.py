@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0041_disbursementbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MpesaCallbackLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('body', models.TextField(help_text='Raw request body')),
+                ('remote_addr', models.GenericIPAddressField(blank=True, null=True)),
+                ('checkout_request_id', models.CharField(blank=True, db_index=True, max_length=255)),
+                ('result_code', models.IntegerField(blank=True, null=True)),
+                ('event_key', models.CharField(blank=True, max_length=300, null=True, unique=True)),
+                ('status', models.CharField(choices=[('received', 'Received'), ('processed', 'Processed'), ('duplicate', 'Duplicate'), ('unmatched', 'Unknown checkout request'), ('error', 'Error')], default='received', max_length=20)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'verbose_name': 'M-Pesa callback',
+                'ordering': ['-received_at'],
+                'indexes': [models.Index(fields=['status', 'received_at'], name='mpesa_callback_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0043_mpesapayment_settlement'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='attendancerecord',
+            name='client_submission_id',
+            field=models.CharField(blank=True, editable=False, help_text='Idempotency key of an offline submission', max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='attendancerecord',
+            constraint=models.UniqueConstraint(fields=('user', 'client_submission_id'), name='unique_submission_per_user'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0046_mpesa_dispatch_claims'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='maintenancecheckpoint',
+            name='status',
+            field=models.CharField(choices=[('running', 'Running'), ('paused', 'Interrupted'), ('completed', 'Completed')], default='running', max_length=20),
+        ),
+    ]
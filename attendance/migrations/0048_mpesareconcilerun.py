@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:50
+
+from django.db import migrations, models
+
+
+def drop_reconcile_checkpoints(apps, schema_editor):
+    """The scheduler used to take turns on a MaintenanceCheckpoint row"""
+    MaintenanceCheckpoint = apps.get_model('attendance', 'MaintenanceCheckpoint')
+    MaintenanceCheckpoint.objects.filter(job='mpesa_reconcile').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('attendance', '0047_maintenancecheckpoint_paused'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MpesaReconcileRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigger', models.CharField(choices=[('command', 'Management command'), ('scheduler', 'Web process scheduler')], max_length=10)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='running', max_length=20)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('checked', models.PositiveIntegerField(default=0, help_text='Pending payments queried')),
+                ('summary', models.CharField(blank=True, help_text='Count per outcome', max_length=255)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'verbose_name': 'M-Pesa reconciliation run',
+                'ordering': ['-started_at'],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status', 'running')), fields=('status',), name='one_running_mpesa_reconcile')],
+            },
+        ),
+        migrations.RunPython(drop_reconcile_checkpoints, migrations.RunPython.noop),
+    ]
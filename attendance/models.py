@@ -1,9 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
-from django.db.models import Sum
 from django.core.cache import cache
 
 
@@ -83,48 +82,55 @@ class AttendanceRecord(models.Model):
     supper_allowance = models.DecimalField(max_digits=10, decimal_places=2, default=0.0, blank=True,
                                           help_text="Supper allowance for salaried employees")
 
+    # Offline submissions synced later carry a client-generated key so retries are idempotent
+    client_submission_id = models.CharField(max_length=64, null=True, blank=True, editable=False,
+                                            help_text="Idempotency key of an offline submission")
+
     def __str__(self):
         return f"{self.user.username} - {self.date}"
 
     @property
     def daily_pay(self):
-        """Calculate daily pay: KSH 1000 base + KSH 100 per overtime hour"""
-        base_pay = 1000
-        overtime_rate = 100
-        return base_pay + (self.overtime_hours * overtime_rate)
+        """Day rate plus overtime under the pay rule for this record's user, event and date"""
+        from .pay_utils import price_record
+        return price_record(self).total
     
     @property
     def earned_amount(self):
-        """Amount earned from attendance (1000 + 100 per overtime hour)"""
-        return 1000 + (self.overtime_hours * 100)
+        """Amount earned from attendance under the current pay rules"""
+        return self.daily_pay
+
+    class Meta:
+        constraints = [
+            # Attendance can only be marked once per day
+            models.UniqueConstraint(fields=['user', 'date'], name='unique_attendance_per_user_per_day'),
+            # Offline idempotency keys are generated per device, so only unique per user
+            models.UniqueConstraint(fields=['user', 'client_submission_id'], name='unique_submission_per_user'),
+        ]
+        indexes = [
+            # Unpaid rows per user (balance, payroll, "mark all paid")
+            models.Index(fields=['user'], condition=models.Q(is_paid=False), name='attendance_unpaid_idx'),
+            models.Index(fields=['event_fk', 'date'], name='attendance_event_date_idx'),
+        ]
 
 
 @receiver(post_save, sender=AttendanceRecord)
-def update_balance_on_attendance(sender, instance, **kwargs):
+def update_balance_on_attendance(sender, instance, created, update_fields=None, **kwargs):
     """
-    Update user's balance whenever attendance record is created or modified.
-    Balance = Sum of all unpaid attendance records
+    Post the change in this record's unpaid amount to the balance ledger.
+    Saves that don't touch amount_paid/is_paid can't move the balance.
     """
-    try:
-        profile = Profile.objects.get(user=instance.user)
-        
-        # Recalculate total from all unpaid records
-        total_attendance = AttendanceRecord.objects.filter(
-            user=instance.user, 
-            is_paid=False
-        ).aggregate(total=Sum('amount_paid'))['total'] or 0
-        
-        # Final balance = attendance payments only
-        profile.balance = total_attendance
-        profile.save()
-    except Profile.DoesNotExist:
-        # Profile not created yet, skip
-        pass
+    if update_fields is not None and not {'amount_paid', 'is_paid'} & set(update_fields):
+        return
+    from .balance_utils import record_balance_change
+    record_balance_change(instance, created=created)
 
 
 class Event(models.Model):
     """Model for tracking events and their details"""
     name = models.CharField(max_length=255)
+    normalized_name = models.CharField(max_length=255, blank=True, editable=False,
+                                       help_text="Lowercased name without punctuation, used for lookups")
     date = models.DateField()
     location = models.CharField(max_length=255, blank=True)
     description = models.TextField(blank=True)
@@ -138,11 +144,43 @@ class Event(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Shown on crew members' cached pages: name and date with their attendance,
+    # the rest in their assignments (see invalidate_event_caches)
+    CACHED_FIELDS = ('name', 'date', 'location', 'client_venue', 'setup_date', 'setup_end_date')
+
     def __str__(self):
         return f"{self.name} - {self.date}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._cached_values = {field: getattr(instance, field) for field in cls.CACHED_FIELDS if field in field_names}
+        return instance
+
+    def changed_cached_fields(self):
+        """CACHED_FIELDS that differ from what was loaded (all of them if it wasn't loaded from the database)"""
+        loaded = getattr(self, '_cached_values', None)
+        if loaded is None:
+            return set(self.CACHED_FIELDS)
+        return {field for field, value in loaded.items() if getattr(self, field) != value}
+
+    def save(self, *args, **kwargs):
+        from .event_utils import normalize_event_name
+        self.normalized_name = normalize_event_name(self.name)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'name' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'normalized_name'}
+        super().save(*args, **kwargs)
+
     class Meta:
         ordering = ['-date']
+        indexes = [
+            # Date-window keyset paging in /api/events/
+            models.Index(fields=['-date', '-id'], name='event_date_id_idx'),
+            # Name lookups and custom-event dedupe; PostgreSQL also gets a
+            # pg_trgm GIN index on normalized_name (migration 0034)
+            models.Index(fields=['normalized_name', 'date'], name='event_normalized_name_idx'),
+        ]
 
 
 class BalanceAdjustment(models.Model):
@@ -162,28 +200,10 @@ class BalanceAdjustment(models.Model):
 
 
 @receiver(post_save, sender='attendance.BalanceAdjustment')
-def update_balance_on_adjustment(sender, instance, **kwargs):
-    """Update user's balance when admin makes adjustment"""
-    try:
-        profile = instance.user.profile
-        
-        # Recalculate total from all unpaid records
-        total_attendance = AttendanceRecord.objects.filter(
-            user=instance.user, 
-            is_paid=False
-        ).aggregate(total=Sum('amount_paid'))['total'] or 0
-        
-        # Get total from adjustments
-        total_adjustments = BalanceAdjustment.objects.filter(
-            user=instance.user
-        ).aggregate(total=Sum('amount'))['total'] or 0
-        
-        # Final balance = attendance payments + adjustments
-        profile.balance = total_attendance + total_adjustments
-        profile.save()
-    except AttributeError:
-        # Profile might not exist yet, skip
-        pass
+def update_balance_on_adjustment(sender, instance, created, **kwargs):
+    """Post admin adjustments to the balance ledger"""
+    from .balance_utils import record_balance_change
+    record_balance_change(instance, created=created)
 
 
 class ExpenseReimbursement(models.Model):
@@ -225,6 +245,10 @@ class ExpenseReimbursement(models.Model):
     
     class Meta:
         ordering = ['-requested_at']
+        indexes = [
+            # Approval queues: reimbursements in a status, oldest/newest first
+            models.Index(fields=['status', 'requested_at'], name='reimbursement_status_idx'),
+        ]
 
 
 @receiver(post_save, sender='attendance.ExpenseReimbursement')
@@ -253,35 +277,222 @@ class SalaryPayment(models.Model):
 
     class Meta:
         ordering = ['-month_year']
-        unique_together = ('user', 'month_year')  # Only one payment per user per month
+        constraints = [
+            # Only one payment per user per month
+            models.UniqueConstraint(fields=['user', 'month_year'], name='unique_salary_per_user_per_month'),
+        ]
 
 
 @receiver(post_save, sender='attendance.SalaryPayment')
-def update_balance_on_salary_payment(sender, instance, **kwargs):
-    """Add salary payment to user's balance"""
-    try:
-        profile = instance.user.profile
-        
-        # Recalculate total from all sources
-        total_attendance = AttendanceRecord.objects.filter(
-            user=instance.user, 
-            is_paid=False
-        ).aggregate(total=Sum('amount_paid'))['total'] or 0
-        
-        total_adjustments = BalanceAdjustment.objects.filter(
-            user=instance.user
-        ).aggregate(total=Sum('amount'))['total'] or 0
-        
-        total_salaries = SalaryPayment.objects.filter(
-            user=instance.user
-        ).aggregate(total=Sum('total_amount'))['total'] or 0
-        
-        # Note: Reimbursements are refunds and should not be included in balance
-        profile.balance = total_attendance + total_adjustments + total_salaries
-        profile.save()
-    except AttributeError:
-        # Profile might not exist yet, skip
-        pass
+def update_balance_on_salary_payment(sender, instance, created, **kwargs):
+    """Post salary payments to the balance ledger"""
+    from .balance_utils import record_balance_change
+    record_balance_change(instance, created=created)
+
+
+@receiver(post_delete, sender=AttendanceRecord)
+@receiver(post_delete, sender='attendance.BalanceAdjustment')
+@receiver(post_delete, sender='attendance.SalaryPayment')
+def reverse_balance_on_delete(sender, instance, origin=None, **kwargs):
+    """Reverse a deleted row's ledger entries (skipped when the user itself is being deleted)"""
+    origin_model = origin.model if isinstance(origin, models.QuerySet) else type(origin)
+    if origin_model is User:
+        return
+    from .balance_utils import record_balance_removal
+    record_balance_removal(instance)
+
+
+class PayRule(models.Model):
+    """
+    One version of a pay rate. For each attendance record the most specific
+    matching rule wins (event, then job role, then employment type; blank
+    matches anything), and of its versions the latest effective_from on or
+    before the attendance date applies. Change rates by adding a new version.
+    """
+    employment_type = models.CharField(max_length=20, choices=Profile.EMPLOYMENT_TYPES, blank=True,
+                                       help_text="Leave blank to match every employment type")
+    job_role = models.CharField(max_length=50, choices=Profile.JOB_ROLES, blank=True,
+                                help_text="Leave blank to match every job role")
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, null=True, blank=True, related_name='pay_rules',
+                              help_text="Leave empty to match every event")
+    effective_from = models.DateField(help_text="Attendance on or after this date is paid at these rates")
+    base_daily_pay = models.DecimalField(max_digits=10, decimal_places=2, help_text="Paid per day attended")
+    overtime_rate = models.DecimalField(max_digits=10, decimal_places=2, help_text="Paid per overtime hour")
+    notes = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        scope = ' / '.join(filter(None, [
+            self.get_employment_type_display() if self.employment_type else '',
+            self.get_job_role_display() if self.job_role else '',
+            self.event.name if self.event_id else '',
+        ])) or 'Everyone'
+        return f"{scope} from {self.effective_from}: KSH {self.base_daily_pay} + {self.overtime_rate}/OT hour"
+
+    class Meta:
+        ordering = ['employment_type', 'job_role', '-effective_from']
+        constraints = [
+            models.UniqueConstraint(fields=['employment_type', 'job_role', 'event', 'effective_from'],
+                                    name='unique_pay_rule_version'),
+            # NULL events aren't equal to each other in a unique constraint
+            models.UniqueConstraint(fields=['employment_type', 'job_role', 'effective_from'],
+                                    condition=models.Q(event__isnull=True),
+                                    name='unique_pay_rule_version_all_events'),
+        ]
+
+
+@receiver(post_save, sender=PayRule)
+@receiver(post_delete, sender=PayRule)
+def invalidate_pay_rules(sender, instance, **kwargs):
+    """Drop the compiled rate card so the next price lookup rebuilds it"""
+    from django.db import transaction
+    from .cache_utils import shared_cache, PAY_RULES_KEY
+    transaction.on_commit(lambda: shared_cache.delete(PAY_RULES_KEY))
+
+
+class PayrollRun(models.Model):
+    """
+    One month's salaried payroll, computed as a draft for review and then
+    committed as SalaryPayment rows in one go.
+    """
+    STATUS_CHOICES = (
+        ('draft', 'Draft'),
+        ('committed', 'Committed'),
+    )
+
+    month_year = models.DateField(unique=True, help_text="First day of the month being paid")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='draft')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='payroll_runs_created')
+    created_at = models.DateTimeField(auto_now_add=True)
+    computed_at = models.DateTimeField(null=True, blank=True, help_text="When the draft lines were last computed")
+    committed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='payroll_runs_committed')
+    committed_at = models.DateTimeField(null=True, blank=True)
+    notes = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"Payroll {self.month_year.strftime('%B %Y')} ({self.get_status_display()})"
+
+    class Meta:
+        ordering = ['-month_year']
+
+
+class PayrollRunLine(models.Model):
+    """One salaried employee's pay in a PayrollRun"""
+    run = models.ForeignKey(PayrollRun, on_delete=models.CASCADE, related_name='lines')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payroll_lines')
+    days_worked = models.PositiveIntegerField(default=0)
+    overtime_hours = models.PositiveIntegerField(default=0)
+    base_salary = models.DecimalField(max_digits=10, decimal_places=2)
+    overtime_pay = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
+    supper_allowance = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    salary_payment = models.OneToOneField(SalaryPayment, on_delete=models.SET_NULL, null=True, blank=True,
+                                          related_name='payroll_line')
+
+    def save(self, *args, **kwargs):
+        # Keep the total in step when a reviewer edits a draft line
+        self.total_amount = self.base_salary + self.overtime_pay + self.supper_allowance
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.user.username} - {self.run.month_year.strftime('%B %Y')} - KSH {self.total_amount}"
+
+    class Meta:
+        ordering = ['user__username']
+        constraints = [
+            models.UniqueConstraint(fields=['run', 'user'], name='unique_payroll_line_per_user'),
+        ]
+
+
+class BalanceLedgerEntry(models.Model):
+    """
+    Append-only log of signed balance changes.
+    Profile.balance is the running sum of a user's entries.
+    """
+    SOURCE_TYPES = (
+        ('attendance', 'Attendance'),
+        ('adjustment', 'Balance Adjustment'),
+        ('salary', 'Salary Payment'),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_ledger_entries')
+    source_type = models.CharField(max_length=20, choices=SOURCE_TYPES)
+    source_id = models.PositiveBigIntegerField(help_text="Primary key of the row that caused this change")
+    amount = models.DecimalField(max_digits=12, decimal_places=2, help_text="Signed change to the balance")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        sign = "+" if self.amount >= 0 else "-"
+        return f"{self.user.username} {sign}{abs(self.amount)} ({self.source_type} #{self.source_id})"
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name_plural = "Balance ledger entries"
+        indexes = [
+            models.Index(fields=['source_type', 'source_id']),
+            models.Index(fields=['user', 'created_at']),
+        ]
+
+
+class MaintenanceCheckpoint(models.Model):
+    """
+    Progress of an attendance_maintenance job over one scope (date range), so
+    an interrupted run resumes after the last committed chunk and a finished
+    one isn't applied twice.
+    """
+    STATUS_CHOICES = (
+        ('running', 'Running'),
+        ('paused', 'Interrupted'),
+        ('completed', 'Completed'),
+    )
+
+    job = models.CharField(max_length=50)
+    scope = models.CharField(max_length=100, blank=True, help_text="Filters the job was run with")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='running')
+    last_pk = models.PositiveBigIntegerField(default=0, help_text="Highest primary key already processed")
+    processed = models.PositiveIntegerField(default=0)
+    changed = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.job} [{self.scope or 'all'}] - {self.get_status_display()} ({self.processed} processed)"
+
+    class Meta:
+        ordering = ['-updated_at']
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'scope'], name='unique_maintenance_checkpoint'),
+        ]
+
+
+class ExportJob(models.Model):
+    """
+    A CSV export prepared in the background. The row is what the export page
+    polls, so its status is visible to every worker process, not just the one
+    that wrote the file.
+    """
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    )
+
+    token = models.CharField(max_length=32, unique=True)
+    requested_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='export_jobs')
+    kind = models.CharField(max_length=30)
+    filename = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    rows = models.PositiveIntegerField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.filename} - {self.get_status_display()}"
+
+    class Meta:
+        ordering = ['-created_at']
 
 
 # ========== SIGNAL FOR EVENTS MANAGER GROUP ==========
@@ -389,6 +600,128 @@ class PaymentRecord(models.Model):
         ordering = ['-payment_date']
 
 
+# ============= ACTIVITY FEED =============
+class ActivityEntry(models.Model):
+    """
+    Denormalised per-user timeline of attendance, balance changes and payments.
+    One row per source row, kept in sync by the signals below.
+    """
+    ACTIVITY_TYPES = (
+        ('attendance', 'Attendance'),
+        ('adjustment', 'Admin Change'),
+        ('payment', 'Payment'),
+        ('salary', 'Salary Payment'),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='activity_entries')
+    activity_type = models.CharField(max_length=20, choices=ACTIVITY_TYPES)
+    source_id = models.PositiveBigIntegerField(help_text="Primary key of the row this entry describes")
+    occurred_at = models.DateTimeField()
+    summary = models.CharField(max_length=255, blank=True)
+    amount = models.DecimalField(max_digits=12, decimal_places=2, default=0, help_text="Signed effect on the balance")
+
+    def __str__(self):
+        return f"{self.user.username} - {self.get_activity_type_display()} - {self.occurred_at:%Y-%m-%d %H:%M}"
+
+    class Meta:
+        ordering = ['-occurred_at']
+        verbose_name_plural = "Activity entries"
+        indexes = [
+            models.Index(fields=['user', '-occurred_at']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['activity_type', 'source_id'], name='unique_activity_per_source'),
+        ]
+
+
+@receiver(post_save, sender=AttendanceRecord)
+@receiver(post_save, sender='attendance.BalanceAdjustment')
+@receiver(post_save, sender='attendance.PaymentRecord')
+@receiver(post_save, sender='attendance.SalaryPayment')
+def update_activity_feed(sender, instance, created, **kwargs):
+    """Write or refresh the activity feed entry for this row"""
+    from .activity_utils import record_activity
+    record_activity(instance, created=created)
+
+
+@receiver(post_delete, sender=AttendanceRecord)
+@receiver(post_delete, sender='attendance.BalanceAdjustment')
+@receiver(post_delete, sender='attendance.PaymentRecord')
+@receiver(post_delete, sender='attendance.SalaryPayment')
+def remove_from_activity_feed(sender, instance, origin=None, **kwargs):
+    """Drop a deleted row's feed entry (skipped when the user itself is being deleted)"""
+    origin_model = origin.model if isinstance(origin, models.QuerySet) else type(origin)
+    if origin_model is User:
+        return
+    from .activity_utils import remove_activity
+    remove_activity(instance)
+
+
+# ============= PER-USER CACHE INVALIDATION =============
+@receiver(post_save, sender=Profile)
+@receiver(post_save, sender=AttendanceRecord)
+@receiver(post_save, sender='attendance.BalanceAdjustment')
+@receiver(post_save, sender='attendance.SalaryPayment')
+@receiver(post_save, sender='attendance.PaymentRecord')
+@receiver(post_save, sender='attendance.EmployeeOnboarding')
+@receiver(post_delete, sender=AttendanceRecord)
+@receiver(post_delete, sender='attendance.BalanceAdjustment')
+@receiver(post_delete, sender='attendance.SalaryPayment')
+@receiver(post_delete, sender='attendance.PaymentRecord')
+def invalidate_user_cache(sender, instance, **kwargs):
+    """Bump the owner's cache generation so their cached pages are rebuilt"""
+    from .cache_utils import bump_user_cache
+    bump_user_cache(instance.user_id)
+
+
+def _event_user_ids(event, attendance=True):
+    """Crew members of an event, plus (with attendance) everyone with attendance at it"""
+    user_ids = set(Event.setup_crew.through.objects.filter(event_id=event.pk).values_list('user_id', flat=True))
+    user_ids.update(Event.event_crew.through.objects.filter(event_id=event.pk).values_list('user_id', flat=True))
+    if attendance:
+        user_ids.update(AttendanceRecord.objects.filter(event_fk_id=event.pk).values_list('user_id', flat=True).distinct())
+    return user_ids
+
+
+@receiver(post_save, sender=Event)
+def invalidate_event_caches(sender, instance, created, **kwargs):
+    """
+    Refresh the cached pages of the users who see this event, when something
+    they see changes, and the /api/events/ version
+    """
+    from django.db import transaction
+    from .cache_utils import bump_user_cache, shared_cache, EVENTS_VERSION_KEY
+    transaction.on_commit(lambda: shared_cache.delete(EVENTS_VERSION_KEY))
+    # A new event has no crew or attendance yet; crew changes are handled by invalidate_crew_caches
+    changed = set() if created else instance.changed_cached_fields()
+    if changed:
+        bump_user_cache(*_event_user_ids(instance, attendance=bool(changed & {'name', 'date'})))
+    instance._cached_values = {field: getattr(instance, field) for field in Event.CACHED_FIELDS}
+
+
+@receiver(pre_delete, sender=Event)
+def invalidate_deleted_event_caches(sender, instance, **kwargs):
+    """Before the crew links and attendance references are removed with the event"""
+    from django.db import transaction
+    from .cache_utils import bump_user_cache, shared_cache, EVENTS_VERSION_KEY
+    bump_user_cache(*_event_user_ids(instance))
+    transaction.on_commit(lambda: shared_cache.delete(EVENTS_VERSION_KEY))
+
+
+@m2m_receiver(m2m_changed, sender=Event.setup_crew.through)
+@m2m_receiver(m2m_changed, sender=Event.event_crew.through)
+def invalidate_crew_caches(sender, instance, action, reverse, pk_set, **kwargs):
+    """Refresh my_assignments for users added to or removed from a crew"""
+    from .cache_utils import bump_user_cache, bump_all_user_caches
+    if action == 'post_clear' and not reverse:
+        bump_all_user_caches()
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            bump_user_cache(instance.pk)
+        else:
+            bump_user_cache(*pk_set)
+
+
 # ============= NOTIFICATION AND EMAIL SYSTEM =============
 class EmailNotification(models.Model):
     """Track email notifications sent to users and clients"""
@@ -435,12 +768,24 @@ class MpesaPayment(models.Model):
         ('failed', 'Failed'),
         ('cancelled', 'Cancelled'),
     )
+    # Statuses a payment may move to from each status; completed, failed and cancelled are final
+    TRANSITIONS = {
+        'initiated': ('pending', 'failed', 'cancelled'),
+        'pending': ('completed', 'failed', 'cancelled'),
+    }
+    SETTLED_VIA_CHOICES = (
+        ('dispatch', 'Push not sent'),
+        ('callback', 'Callback'),
+        ('query', 'Status query'),
+    )
     
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='mpesa_payments')
     phone_number = models.CharField(max_length=20, help_text="Phone number in format 254xxxxxxxxx")
     amount = models.DecimalField(max_digits=10, decimal_places=2, help_text="Amount in KSH")
     payment_purpose = models.CharField(max_length=255, help_text="Purpose of payment (salary, reimbursement, etc.)")
-    checkout_request_id = models.CharField(max_length=255, unique=True, help_text="M-Pesa checkout request ID")
+    # Empty until Safaricom accepts the push (payments are created 'initiated' before it is sent)
+    checkout_request_id = models.CharField(max_length=255, unique=True, null=True, blank=True,
+                                           help_text="M-Pesa checkout request ID")
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='initiated')
     
     # M-Pesa response data
@@ -453,6 +798,20 @@ class MpesaPayment(models.Model):
     initiated_at = models.DateTimeField(auto_now_add=True)
     completed_at = models.DateTimeField(null=True, blank=True)
     
+    # Batch disbursements: which batch this leg belongs to and what it pays
+    batch = models.ForeignKey('DisbursementBatch', on_delete=models.SET_NULL, null=True, blank=True,
+                              related_name='payments')
+    reimbursement = models.ForeignKey(ExpenseReimbursement, on_delete=models.SET_NULL, null=True, blank=True,
+                                      related_name='mpesa_payments')
+    attempts = models.PositiveSmallIntegerField(default=0, help_text="STK push requests sent to M-Pesa")
+    # Set by the one worker that claims an 'initiated' payment to send its push
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    
+    # When and how the payment reached a final status, and when the reconciler last asked M-Pesa about it
+    settled_at = models.DateTimeField(null=True, blank=True)
+    settled_via = models.CharField(max_length=10, choices=SETTLED_VIA_CHOICES, blank=True)
+    checked_at = models.DateTimeField(null=True, blank=True)
+    
     def __str__(self):
         return f"M-Pesa {self.amount} KSH - {self.user.username} - {self.status}"
     
@@ -462,7 +821,113 @@ class MpesaPayment(models.Model):
         indexes = [
             models.Index(fields=['user', 'status']),
             models.Index(fields=['checkout_request_id']),
+            # Reconciliation: oldest pending payments first
+            models.Index(fields=['status', 'initiated_at'], name='mpesa_status_initiated_idx'),
+        ]
+
+
+class MpesaCallbackLog(models.Model):
+    """
+    Every M-Pesa callback exactly as it arrived, written before Safaricom is
+    acknowledged. Rows are only ever added; processing fills in the outcome.
+    """
+    STATUS_CHOICES = (
+        ('received', 'Received'),
+        ('processed', 'Processed'),
+        ('duplicate', 'Duplicate'),
+        ('unmatched', 'Unknown checkout request'),
+        ('error', 'Error'),
+    )
+
+    received_at = models.DateTimeField(auto_now_add=True)
+    body = models.TextField(help_text="Raw request body")
+    remote_addr = models.GenericIPAddressField(null=True, blank=True)
+    checkout_request_id = models.CharField(max_length=255, blank=True, db_index=True)
+    result_code = models.IntegerField(null=True, blank=True)
+    # "<CheckoutRequestID>:<ResultCode>" on the one entry that applied the event; repeats of it are duplicates
+    event_key = models.CharField(max_length=300, unique=True, null=True, blank=True)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='received')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # Set while a worker is applying the entry; a claim older than CALLBACK_CLAIM_TIMEOUT is abandoned
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"Callback {self.checkout_request_id or '?'} ({self.result_code}) - {self.status}"
+
+    class Meta:
+        ordering = ['-received_at']
+        verbose_name = "M-Pesa callback"
+        indexes = [
+            models.Index(fields=['status', 'received_at'], name='mpesa_callback_status_idx'),
+        ]
+
+
+class MpesaReconcileRun(models.Model):
+    """
+    One run of the M-Pesa reconciler. At most one row is 'running' at a time,
+    which is what keeps a cron job and a scheduler thread from overlapping; a
+    failed run keeps its error here.
+    """
+    STATUS_CHOICES = (
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    )
+    TRIGGER_CHOICES = (
+        ('command', 'Management command'),
+        ('scheduler', 'Web process scheduler'),
+    )
+
+    trigger = models.CharField(max_length=10, choices=TRIGGER_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='running')
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    checked = models.PositiveIntegerField(default=0, help_text="Pending payments queried")
+    summary = models.CharField(max_length=255, blank=True, help_text="Count per outcome")
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"Reconciliation {self.started_at:%Y-%m-%d %H:%M} - {self.get_status_display()}"
+
+    class Meta:
+        ordering = ['-started_at']
+        verbose_name = "M-Pesa reconciliation run"
+        constraints = [
+            models.UniqueConstraint(fields=['status'], condition=models.Q(status='running'),
+                                    name='one_running_mpesa_reconcile'),
         ]
 
 
+class DisbursementBatch(models.Model):
+    """A set of M-Pesa payments sent together, one MpesaPayment per user or reimbursement"""
+    SOURCE_CHOICES = (
+        ('balance', 'Outstanding balances'),
+        ('reimbursements', 'Approved reimbursements'),
+    )
+    STATUS_CHOICES = (
+        ('draft', 'Draft'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+    )
+
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='draft')
+    notes = models.TextField(blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                                   related_name='disbursement_batches')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True, help_text="When every push had been sent")
+
+    def __str__(self):
+        return f"Disbursement #{self.pk} - {self.get_source_display()} ({self.get_status_display()})"
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name_plural = "Disbursement batches"
+
+
 # ============= EVENT CREW MANAGEMENT FOR CRM =============
@@ -1,18 +1,91 @@
 """
 M-Pesa STK Push Integration Utilities
 Handles M-Pesa STK push requests, callbacks, and payment processing
+
+Use get_mpesa_client() rather than constructing MpesaClient: the shared
+client keeps one pooled HTTP session per thread and reuses the OAuth token,
+which is cached (in the default cache, so across workers) until shortly
+before it expires.
 """
 import base64
+import hashlib
 import json
+import random
+import threading
+import time
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.retry import Retry
+from datetime import datetime, timedelta
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q
 from django.utils import timezone
-from .models import MpesaPayment, EmailNotification
+from .models import MpesaPayment, MpesaCallbackLog, EmailNotification
 import logging
 
 logger = logging.getLogger(__name__)
 
+# HTTP statuses Daraja answers itself when it turns a request away unprocessed.
+# Gateway errors (502, 504) are left out: the push may have started behind them.
+RETRYABLE_STATUSES = (429, 503)
+# Seconds before the first retry of a push; doubles on each further attempt
+RETRY_BACKOFF = 1.0
+# Seconds after which a callback log entry claimed by a worker that died can be claimed again
+CALLBACK_CLAIM_TIMEOUT = 300
+# Result code M-Pesa sends when the customer dismisses the prompt
+RESULT_CANCELLED_BY_USER = 1032
+
+
+def is_retryable(error):
+    """
+    True if a failed request certainly didn't start a push, so sending it again
+    is safe: the connection was never made, or Daraja turned the request away.
+    Anything else (a dropped connection, a read timeout, a gateway error) may
+    have come after the push started and is left to the status query.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = getattr(error.args[0] if error.args else None, 'reason', None)
+        return isinstance(reason, NewConnectionError)
+    response = getattr(error, 'response', None)
+    return isinstance(error, requests.exceptions.HTTPError) and response is not None \
+        and response.status_code in RETRYABLE_STATUSES
+
+
+def format_phone_number(phone):
+    """Normalise a Kenyan phone number to the 254XXXXXXXXX form M-Pesa expects"""
+    phone = phone.strip().replace(' ', '')
+    if phone.startswith('+'):
+        phone = phone[1:]
+    if phone.startswith('0'):
+        phone = '254' + phone[1:]
+    elif not phone.startswith('254'):
+        phone = '254' + phone
+    return phone
+
+
+class RateLimiter:
+    """Spaces calls made through wait() at most `rate` per second, across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
 
 class MpesaClient:
     """M-Pesa API client for STK push and payment operations"""
@@ -26,6 +99,12 @@ class MpesaClient:
     AUTH_URL_PROD = "https://api.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
     STK_PUSH_URL_PROD = "https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
     QUERY_URL_PROD = "https://api.safaricom.co.ke/mpesa/stkpushquery/v1/query"
+
+    TIMEOUT = 10
+    # Refresh the token this many seconds before Safaricom says it expires
+    TOKEN_REFRESH_MARGIN = 60
+    # Used when the token response has no usable expires_in (Daraja tokens last an hour)
+    DEFAULT_TOKEN_LIFETIME = 3599
     
     def __init__(self):
         self.consumer_key = settings.MPESA_CONSUMER_KEY
@@ -33,7 +112,6 @@ class MpesaClient:
         self.business_short_code = settings.MPESA_BUSINESS_SHORT_CODE
         self.pass_key = settings.MPESA_PASS_KEY
         self.environment = settings.MPESA_ENVIRONMENT
-        self.access_token = None
         
         # Set URLs based on environment
         if self.environment == 'production':
@@ -44,23 +122,100 @@ class MpesaClient:
             self.auth_url = self.AUTH_URL
             self.stk_push_url = self.STK_PUSH_URL
             self.query_url = self.QUERY_URL
+
+        # Different credentials get different cached tokens
+        fingerprint = hashlib.sha256(f"{self.environment}:{self.consumer_key}".encode()).hexdigest()[:16]
+        self.token_cache_key = f"mpesa:token:{fingerprint}"
+        self._token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        """This thread's keep-alive session (requests.Session isn't safe to share between threads)"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            # Connection errors are retried for every method, since the request
+            # never reached Safaricom. Error responses are only retried for GET
+            # (the token request): re-sending a POST could push a second prompt.
+            retry = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset({'GET'}),
+                raise_on_status=False
+            )
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(max_retries=retry, pool_connections=2, pool_maxsize=10))
+            self._local.session = session
+        return session
     
-    def get_access_token(self):
-        """Get M-Pesa access token"""
-        try:
-            response = requests.get(
-                self.auth_url,
-                auth=(self.consumer_key, self.consumer_secret),
-                timeout=10
+    def get_access_token(self, force_refresh=False):
+        """Get M-Pesa access token, from this process, the shared cache or Safaricom"""
+        if not force_refresh and self._token and time.monotonic() < self._token_expires_at:
+            return self._token
+
+        with self._token_lock:
+            if not force_refresh:
+                if self._token and time.monotonic() < self._token_expires_at:
+                    return self._token
+                cached = cache.get(self.token_cache_key)
+                if cached and cached['expires_at'] > time.time():
+                    self._remember_token(cached['token'], cached['expires_at'] - time.time())
+                    return self._token
+
+            try:
+                response = self.session.get(
+                    self.auth_url,
+                    auth=(self.consumer_key, self.consumer_secret),
+                    timeout=self.TIMEOUT
+                )
+                response.raise_for_status()
+                data = response.json()
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Failed to get M-Pesa access token: {str(e)}")
+                raise
+
+            try:
+                expires_in = int(data.get('expires_in', self.DEFAULT_TOKEN_LIFETIME))
+            except (TypeError, ValueError):
+                expires_in = self.DEFAULT_TOKEN_LIFETIME
+            lifetime = max(expires_in - self.TOKEN_REFRESH_MARGIN, 1)
+            cache.set(self.token_cache_key, {'token': data['access_token'], 'expires_at': time.time() + lifetime}, lifetime)
+            self._remember_token(data['access_token'], lifetime)
+            return self._token
+
+    def _remember_token(self, token, lifetime):
+        self._token = token
+        self._token_expires_at = time.monotonic() + lifetime
+
+    def _post(self, url, payload):
+        """POST with the cached token, fetching a new one once if Safaricom rejects it"""
+        for attempt in range(2):
+            response = self.session.post(
+                url,
+                json=payload,
+                headers={
+                    "Authorization": f"Bearer {self.get_access_token(force_refresh=bool(attempt))}",
+                    "Content-Type": "application/json"
+                },
+                timeout=self.TIMEOUT
             )
-            response.raise_for_status()
-            self.access_token = response.json()['access_token']
-            return self.access_token
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to get M-Pesa access token: {str(e)}")
-            raise
+            if response.status_code != 401:
+                break
+            logger.warning("M-Pesa rejected the cached access token, fetching a new one")
+        response.raise_for_status()
+        return response.json()
+
+    def _password(self):
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(
+            f"{self.business_short_code}{self.pass_key}{timestamp}".encode()
+        ).decode()
+        return timestamp, password
     
-    def initiate_stk_push(self, user, phone_number, amount, payment_purpose, payment_id=None):
+    def initiate_stk_push(self, user, phone_number, amount, payment_purpose, payment_id=None, payment=None):
         """
         Initiate STK push to collect payment from customer
         
@@ -70,20 +225,18 @@ class MpesaClient:
             amount: Amount in KSH
             payment_purpose: Description of payment
             payment_id: Optional payment record ID
+            payment: Optional 'initiated' MpesaPayment to send; it is moved to
+                     'pending' instead of a new record being created
             
         Returns:
-            dict: Response containing checkout_request_id and other details
+            dict: Response containing checkout_request_id and other details;
+                  on failure, retryable says whether sending again is safe
         """
+        if payment is not None:
+            payment_id = payment.id
         try:
-            # Get access token
-            if not self.access_token:
-                self.get_access_token()
-            
             # Generate timestamp and password
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            password = base64.b64encode(
-                f"{self.business_short_code}{self.pass_key}{timestamp}".encode()
-            ).decode()
+            timestamp, password = self._password()
             
             # Prepare request payload
             payload = {
@@ -100,33 +253,27 @@ class MpesaClient:
                 "TransactionDesc": payment_purpose[:20]  # Limited to 20 chars
             }
             
-            # Make request
-            headers = {
-                "Authorization": f"Bearer {self.access_token}",
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(
-                self.stk_push_url,
-                json=payload,
-                headers=headers,
-                timeout=10
-            )
-            response.raise_for_status()
+            response_data = self._post(self.stk_push_url, payload)
             
-            response_data = response.json()
-            
-            # Create payment record if successful
+            # Create (or update) the payment record if successful
             if response_data.get('ResponseCode') == '0':
-                payment = MpesaPayment.objects.create(
-                    user=user,
-                    phone_number=phone_number,
-                    amount=amount,
-                    payment_purpose=payment_purpose,
-                    checkout_request_id=response_data.get('CheckoutRequestID'),
-                    merchant_request_id=response_data.get('MerchantRequestID'),
-                    status='pending'
-                )
+                if payment is not None:
+                    transition_payment(
+                        payment.pk,
+                        'pending',
+                        checkout_request_id=response_data.get('CheckoutRequestID'),
+                        merchant_request_id=response_data.get('MerchantRequestID')
+                    )
+                else:
+                    payment = MpesaPayment.objects.create(
+                        user=user,
+                        phone_number=phone_number,
+                        amount=amount,
+                        payment_purpose=payment_purpose,
+                        checkout_request_id=response_data.get('CheckoutRequestID'),
+                        merchant_request_id=response_data.get('MerchantRequestID'),
+                        status='pending'
+                    )
                 
                 logger.info(f"STK push initiated for {user.username}: {payment.id}")
                 return {
@@ -141,7 +288,8 @@ class MpesaClient:
                 return {
                     'success': False,
                     'message': response_data.get('ResponseDescription', 'Failed to initiate payment'),
-                    'error_code': response_data.get('ResponseCode')
+                    'error_code': response_data.get('ResponseCode'),
+                    'retryable': False
                 }
                 
         except requests.exceptions.RequestException as e:
@@ -149,19 +297,14 @@ class MpesaClient:
             return {
                 'success': False,
                 'message': 'Failed to connect to M-Pesa service. Please try again.',
-                'error': str(e)
+                'error': str(e),
+                'retryable': is_retryable(e)
             }
     
     def query_payment_status(self, checkout_request_id):
         """Query the status of an STK push request"""
         try:
-            if not self.access_token:
-                self.get_access_token()
-            
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            password = base64.b64encode(
-                f"{self.business_short_code}{self.pass_key}{timestamp}".encode()
-            ).decode()
+            timestamp, password = self._password()
             
             payload = {
                 "BusinessShortCode": self.business_short_code,
@@ -170,83 +313,328 @@ class MpesaClient:
                 "CheckoutRequestID": checkout_request_id
             }
             
-            headers = {
-                "Authorization": f"Bearer {self.access_token}",
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(
-                self.query_url,
-                json=payload,
-                headers=headers,
-                timeout=10
-            )
-            response.raise_for_status()
-            
-            return response.json()
+            return self._post(self.query_url, payload)
             
         except requests.exceptions.RequestException as e:
             logger.error(f"Error querying payment status: {str(e)}")
             return {'error': str(e)}
 
 
-def process_mpesa_callback(request_data):
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_mpesa_client():
+    """Process-wide MpesaClient, created on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MpesaClient()
+    return _client
+
+
+def transition_payment(payment_id, status, **fields):
     """
-    Process M-Pesa callback from STK push
-    
+    Move a payment to status, saving fields with it, if MpesaPayment.TRANSITIONS
+    allows that from the status it is in. This is one conditional UPDATE, so of
+    several concurrent or repeated attempts exactly one succeeds.
+
+    Returns:
+        bool: True if this call made the transition
+    """
+    sources = [source for source, targets in MpesaPayment.TRANSITIONS.items() if status in targets]
+    return MpesaPayment.objects.filter(pk=payment_id, status__in=sources).update(status=status, **fields) == 1
+
+
+def _mark_dispatch_failed(payment, message):
+    """Record why a queued push never reached the customer"""
+    transition_payment(
+        payment.pk,
+        'failed',
+        result_description=message[:1000],
+        settled_at=timezone.now(),
+        settled_via='dispatch'
+    )
+
+
+def dispatch_stk_push(payment_id, retries=0, limiter=None):
+    """
+    Send the STK push for an 'initiated' MpesaPayment. Runs on the background
+    executor when MPESA_ASYNC_DISPATCH is on; safe to call twice for the same
+    payment (only the first call sends anything).
+
     Args:
-        request_data: Callback data from M-Pesa
+        retries: how many more times to try, with exponential backoff, when
+                 the push failed before reaching Safaricom
+        limiter: optional RateLimiter to wait on before each request
     """
+    # Claim the payment in the database, so of a double-clicked admin action, the
+    # queued task and the reconciler re-dispatching it, only one worker pushes
+    claimed = MpesaPayment.objects.filter(
+        pk=payment_id, status='initiated', checkout_request_id__isnull=True, dispatched_at__isnull=True
+    ).update(dispatched_at=timezone.now())
+    if not claimed:
+        status = MpesaPayment.objects.filter(pk=payment_id).values_list('status', flat=True).first()
+        if status is None:
+            return {'success': False, 'message': 'Payment not found'}
+        if status == 'initiated':
+            return {'success': False, 'message': 'This payment is already being sent'}
+        return {'success': False, 'message': f'Payment is already {status}'}
+
+    payment = MpesaPayment.objects.select_related('user').get(pk=payment_id)
+
+    client = get_mpesa_client()
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+        if limiter:
+            limiter.wait()
+        MpesaPayment.objects.filter(pk=payment.pk).update(attempts=F('attempts') + 1)
+        result = client.initiate_stk_push(
+            payment.user,
+            payment.phone_number,
+            payment.amount,
+            payment.payment_purpose,
+            payment=payment
+        )
+        if result.get('success') or not result.get('retryable'):
+            break
+        logger.warning(f"STK push for payment {payment.id} failed (attempt {attempt + 1}): {result.get('error')}")
+
+    if not result.get('success'):
+        _mark_dispatch_failed(payment, result.get('error') or result['message'])
+    elif payment.reimbursement_id:
+        from .models import ExpenseReimbursement
+        ExpenseReimbursement.objects.filter(pk=payment.reimbursement_id).update(
+            checkout_request_id=result['checkout_request_id']
+        )
+    return result
+
+
+def queue_stk_push(payment):
+    """
+    Send an 'initiated' payment's STK push: in the background when
+    settings.MPESA_ASYNC_DISPATCH is on (the caller polls for the outcome),
+    otherwise straight away. A queued push lost to a worker restart is sent
+    by the reconciler once it is MPESA_RECONCILE_AFTER seconds old.
+
+    Returns:
+        dict: with success, payment_id and status ('initiated' while queued),
+              plus initiate_stk_push's fields when sent synchronously
+    """
+    if getattr(settings, 'MPESA_ASYNC_DISPATCH', True):
+        from . import background
+        transaction.on_commit(lambda: background.submit(dispatch_stk_push, payment.id))
+        return {
+            'success': True,
+            'payment_id': payment.id,
+            'status': 'initiated',
+            'message': 'STK push queued'
+        }
+
+    result = dispatch_stk_push(payment.id)
+    result.update(payment_id=payment.id, status='pending' if result.get('success') else 'failed')
+    return result
+
+
+def start_stk_push(user, phone_number, amount, payment_purpose, reimbursement_id=None):
+    """Record an 'initiated' MpesaPayment for user and queue its STK push (see queue_stk_push)"""
+    payment = MpesaPayment.objects.create(
+        user=user,
+        phone_number=phone_number,
+        amount=amount,
+        payment_purpose=payment_purpose,
+        reimbursement_id=reimbursement_id,
+        status='initiated'
+    )
+    return queue_stk_push(payment)
+
+
+def log_mpesa_callback(body, remote_addr=None):
+    """
+    Store a callback exactly as received and schedule it to be applied, so the
+    view can acknowledge Safaricom straight away. Nothing is lost if applying
+    it fails or the worker restarts: replay_mpesa_callbacks picks it up.
+    """
+    body = body.decode('utf-8', errors='replace') if isinstance(body, bytes) else body
+    checkout_request_id, result_code = '', None
     try:
-        data = request_data.get('Body', {}).get('stkCallback', {})
-        checkout_request_id = data.get('CheckoutRequestID')
-        result_code = data.get('ResultCode')
-        result_description = data.get('ResultDesc')
-        merchant_request_id = data.get('MerchantRequestID')
-        
-        # Find payment record
+        callback = json.loads(body)['Body']['stkCallback']
+        checkout_request_id = str(callback.get('CheckoutRequestID') or '')[:255]
+        result_code = int(callback['ResultCode'])
+    except (ValueError, KeyError, TypeError):
+        pass
+
+    log = MpesaCallbackLog.objects.create(
+        body=body,
+        remote_addr=remote_addr,
+        checkout_request_id=checkout_request_id,
+        result_code=result_code
+    )
+    if getattr(settings, 'MPESA_ASYNC_CALLBACKS', True):
+        from . import background
+        transaction.on_commit(lambda: background.submit(process_callback_log, log.pk))
+    else:
+        process_callback_log(log.pk)
+    return log
+
+
+def process_callback_log(log_id, reapply=False):
+    """
+    Apply a logged callback to its MpesaPayment. Each (CheckoutRequestID,
+    ResultCode) event is applied by one entry only; repeats of it are marked
+    duplicate. reapply=True applies an already processed entry again (for
+    replaying after a fix).
+
+    Returns:
+        str: the entry's new status, or None if it is being processed elsewhere
+    """
+    # Claim the entry in the database so the background task and a replay (in
+    # any process) can't apply it together; a claim left by a dead worker expires
+    now = timezone.now()
+    claimed = MpesaCallbackLog.objects.filter(pk=log_id).filter(
+        Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - timedelta(seconds=CALLBACK_CLAIM_TIMEOUT))
+    ).update(claimed_at=now)
+    if not claimed:
+        return None
+    try:
+        log = MpesaCallbackLog.objects.get(pk=log_id)
+        if log.status in ('processed', 'duplicate') and not reapply:
+            return log.status
+
+        entries = MpesaCallbackLog.objects.filter(pk=log.pk)
+        if log.checkout_request_id and not log.event_key:
+            event_key = f"{log.checkout_request_id}:{log.result_code}"
+            # A repeat delivery costs one lookup on the unique event_key index;
+            # the IntegrityError covers a repeat being processed at the same moment
+            try:
+                if MpesaCallbackLog.objects.filter(event_key=event_key).exists():
+                    raise IntegrityError
+                with transaction.atomic():
+                    entries.update(event_key=event_key)
+            except IntegrityError:
+                entries.update(status='duplicate', processed_at=timezone.now(), error='')
+                logger.info(f"Duplicate M-Pesa callback {log.pk} for {log.checkout_request_id} ignored")
+                return 'duplicate'
+        entries.update(attempts=F('attempts') + 1)
+
         try:
-            payment = MpesaPayment.objects.get(checkout_request_id=checkout_request_id)
-        except MpesaPayment.DoesNotExist:
-            logger.warning(f"Callback received for unknown checkout ID: {checkout_request_id}")
-            return False
-        
-        # Update payment record based on result
-        if result_code == 0:  # Success
-            payment.status = 'completed'
-            payment.result_code = result_code
-            payment.result_description = result_description
-            payment.merchant_request_id = merchant_request_id
-            payment.completed_at = timezone.now()
-            
-            # Extract callback data if available
-            callback_metadata = data.get('CallbackMetadata', {}).get('Item', [])
-            for item in callback_metadata:
-                if item.get('Name') == 'MpesaReceiptNumber':
-                    payment.receipt_number = item.get('Value')
-                elif item.get('Name') == 'TransactionDate':
-                    payment.transaction_date = item.get('Value')
-            
-            payment.save()
-            
+            outcome = process_mpesa_callback(json.loads(log.body))
+        except Exception as e:
+            # Release the event so a replay (or a repeat of the callback) can apply it
+            logger.exception(f"Error processing M-Pesa callback {log.pk}")
+            entries.update(status='error', event_key=None, error=f"{type(e).__name__}: {e}")
+            return 'error'
+
+        status = 'unmatched' if outcome == 'unmatched' else 'processed'
+        entries.update(
+            status=status,
+            processed_at=timezone.now(),
+            error='',
+            # A callback can beat the dispatcher saving its checkout ID; let a replay claim it later
+            **({'event_key': None} if status == 'unmatched' else {})
+        )
+        return status
+    finally:
+        MpesaCallbackLog.objects.filter(pk=log_id, claimed_at=now).update(claimed_at=None)
+
+
+def _parse_transaction_date(value):
+    """M-Pesa sends TransactionDate as a number like 20240131154512 (Nairobi time)"""
+    try:
+        return timezone.make_aware(datetime.strptime(str(value), '%Y%m%d%H%M%S'))
+    except (TypeError, ValueError):
+        logger.warning(f"Unrecognised M-Pesa TransactionDate: {value!r}")
+        return None
+
+
+def result_status(result_code):
+    """The final payment status an M-Pesa result code means"""
+    if result_code == 0:
+        return 'completed'
+    if result_code == RESULT_CANCELLED_BY_USER:
+        return 'cancelled'
+    return 'failed'
+
+
+def apply_payment_result(payment_id, result_code, result_description='', via='callback', **fields):
+    """
+    Settle a pending payment from an M-Pesa result code, whether it came from
+    a callback or a status query. The status only moves along
+    MpesaPayment.TRANSITIONS, so a repeated or late result changes nothing,
+    and the confirmation email is sent once.
+
+    Returns:
+        str: the status the payment moved to, or 'unchanged' if it had already moved on
+    """
+    status = result_status(result_code)
+    now = timezone.now()
+    if status == 'completed':
+        fields.setdefault('completed_at', now)
+
+    with transaction.atomic():
+        if not transition_payment(
+            payment_id,
+            status,
+            result_code=result_code,
+            result_description=result_description or '',
+            settled_at=now,
+            settled_via=via,
+            **fields
+        ):
+            logger.info(f"Payment {payment_id} already moved on; {status} result from {via} ignored")
+            return 'unchanged'
+
+        if status == 'completed':
+            payment = MpesaPayment.objects.select_related('user').get(pk=payment_id)
             # Send confirmation email
             send_payment_confirmation_email(payment)
-            
-            logger.info(f"Payment {payment.id} completed successfully")
-            return True
-        else:
-            # Payment failed or was cancelled
-            payment.status = 'failed'
-            payment.result_code = result_code
-            payment.result_description = result_description
-            payment.save()
-            
-            logger.warning(f"Payment {payment.id} failed: {result_description}")
-            return False
-            
-    except Exception as e:
-        logger.error(f"Error processing M-Pesa callback: {str(e)}")
-        return False
+
+    if status == 'completed':
+        logger.info(f"Payment {payment_id} completed successfully ({via})")
+    else:
+        logger.warning(f"Payment {payment_id} {status} ({via}): {result_description}")
+    return status
+
+
+def process_mpesa_callback(request_data):
+    """
+    Apply a parsed M-Pesa STK push callback to its payment record
+    
+    Args:
+        request_data: Callback data from M-Pesa
+        
+    Returns:
+        str: the status the payment moved to ('completed', 'failed' or
+             'cancelled'), 'unchanged' if it had already moved on, or
+             'unmatched' if no payment has that checkout ID
+    """
+    data = request_data.get('Body', {}).get('stkCallback', {})
+    checkout_request_id = data.get('CheckoutRequestID')
+    result_code = data.get('ResultCode')
+    
+    # Find payment record
+    payment_id = MpesaPayment.objects.filter(
+        checkout_request_id=checkout_request_id
+    ).values_list('pk', flat=True).first() if checkout_request_id else None
+    if payment_id is None:
+        logger.warning(f"Callback received for unknown checkout ID: {checkout_request_id}")
+        return 'unmatched'
+    
+    fields = {}
+    if result_code == 0:  # Success
+        fields['merchant_request_id'] = data.get('MerchantRequestID') or ''
+        
+        # Extract callback data if available
+        callback_metadata = data.get('CallbackMetadata', {}).get('Item', [])
+        for item in callback_metadata:
+            if item.get('Name') == 'MpesaReceiptNumber':
+                fields['receipt_number'] = str(item.get('Value') or '')
+            elif item.get('Name') == 'TransactionDate':
+                fields['transaction_date'] = _parse_transaction_date(item.get('Value'))
+    
+    return apply_payment_result(payment_id, result_code, data.get('ResultDesc'), via='callback', **fields)
 
 
 def send_payment_confirmation_email(payment):
@@ -275,21 +663,20 @@ def send_payment_confirmation_email(payment):
             """
         )
         
-        # Send email asynchronously if celery is configured
-        send_email.delay(notification.id)
+        # Send from the background executor once the payment update is committed
+        from . import background
+        transaction.on_commit(lambda: background.submit(send_email, notification.id))
         
     except Exception as e:
         logger.error(f"Error creating payment confirmation email: {str(e)}")
 
 
-# Celery task (if celery is configured)
 def send_email(notification_id):
-    """Send email notification"""
+    """Send email notification (runs on the background executor)"""
+    from django.core.mail import send_mail
+    
+    notification = EmailNotification.objects.get(id=notification_id)
     try:
-        from django.core.mail import send_mail
-        
-        notification = EmailNotification.objects.get(id=notification_id)
-        
         send_mail(
             notification.subject,
             notification.message,
@@ -0,0 +1,210 @@
+"""
+Pay Utilities
+Prices attendance from the PayRule rate card. The rules are compiled into a
+lookup table kept in shared_cache (dropped whenever a rule changes), so
+pricing a record or a whole queryset doesn't query the rules again.
+
+reprice_attendance() re-applies the rate card to existing records after a
+rate change, in chunks, posting the differences to the balance ledger.
+"""
+from collections import namedtuple
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+from django.utils import timezone
+from .models import PayRule, ActivityEntry, AttendanceRecord
+from .balance_utils import to_amount, defer_balance_updates
+from .cache_utils import shared_cache, PAY_RULES_KEY
+import logging
+
+logger = logging.getLogger(__name__)
+
+Price = namedtuple('Price', ['base_pay', 'overtime_pay', 'total'])
+
+REPRICE_CHUNK_SIZE = 2000
+
+
+def _compile_rules():
+    """{(employment_type, job_role, event_id): [(effective_from, base_daily_pay, overtime_rate), ...newest first]}"""
+    table = {}
+    rules = PayRule.objects.order_by('-effective_from').values_list(
+        'employment_type', 'job_role', 'event_id', 'effective_from', 'base_daily_pay', 'overtime_rate'
+    )
+    for employment_type, job_role, event_id, effective_from, base_daily_pay, overtime_rate in rules:
+        table.setdefault((employment_type, job_role, event_id), []).append(
+            (effective_from, base_daily_pay, overtime_rate)
+        )
+    return table
+
+
+def get_rule_table():
+    return shared_cache.get_or_set(PAY_RULES_KEY, _compile_rules)
+
+
+def find_rates(table, employment_type, job_role, event_id, date):
+    """
+    (base_daily_pay, overtime_rate) for one record, from a compiled table.
+    Rules for the event beat rules for the job role, which beat rules for the
+    employment type; blank fields in a rule match anything.
+    """
+    keys = dict.fromkeys(
+        (etype, role, event)
+        for event in (event_id, None)
+        for role in (job_role or '', '')
+        for etype in (employment_type or 'casual', '')
+    )
+    for key in keys:
+        for effective_from, base_daily_pay, overtime_rate in table.get(key, ()):
+            if effective_from <= date:
+                return base_daily_pay, overtime_rate
+    raise ImproperlyConfigured(
+        f"No pay rule covers {employment_type or 'casual'} staff on {date}. Add one under Pay rules in the admin."
+    )
+
+
+def _price(table, employment_type, job_role, event_id, date, overtime_hours):
+    base_daily_pay, overtime_rate = find_rates(table, employment_type, job_role, event_id, date)
+    base_pay = to_amount(base_daily_pay)
+    overtime_pay = to_amount(overtime_rate * (overtime_hours or 0))
+    return Price(base_pay, overtime_pay, base_pay + overtime_pay)
+
+
+def price(employment_type, overtime_hours, job_role=None, event_id=None, date=None):
+    """Price one day's attendance. date defaults to today"""
+    return _price(get_rule_table(), employment_type, job_role, event_id,
+                  date or timezone.localdate(), overtime_hours)
+
+
+def price_record(record):
+    """Price an AttendanceRecord for its user's employment type and role"""
+    profile = getattr(record.user, 'profile', None)
+    return price(
+        profile.employment_type if profile else None,
+        record.overtime_hours,
+        job_role=profile.job_role if profile else None,
+        event_id=record.event_fk_id,
+        date=record.date
+    )
+
+
+def price_records(queryset, chunk_size=2000):
+    """
+    Price every record in an AttendanceRecord queryset in one query.
+
+    Returns:
+        dict: {record id: (user_id, Price)}
+    """
+    table = get_rule_table()
+    rows = queryset.order_by().values_list(
+        'pk', 'user_id', 'date', 'overtime_hours', 'event_fk_id',
+        'user__profile__employment_type', 'user__profile__job_role'
+    )
+    return {
+        pk: (user_id, _price(table, employment_type, job_role, event_id, date, overtime_hours))
+        for pk, user_id, date, overtime_hours, event_id, employment_type, job_role in rows.iterator(chunk_size=chunk_size)
+    }
+
+
+def _apply_reprices(changes):
+    """
+    Write one chunk of (record_id, user_id, date, old, new, is_paid) changes.
+    A rate change leaves only a handful of distinct (old, new) pairs, so records
+    are updated with one UPDATE per pair rather than a per-row CASE. A record
+    whose amount or paid flag changed since it was read is left alone.
+
+    Returns:
+        list: the changes that were actually written
+    """
+    by_amount = {}
+    for change in changes:
+        _, _, _, old, new, is_paid = change
+        by_amount.setdefault((old, new, is_paid), []).append(change)
+
+    applied = []
+    with defer_balance_updates() as batch:
+        for (old, new, is_paid), group in by_amount.items():
+            matched = set(AttendanceRecord.objects.select_for_update().filter(
+                pk__in=[change[0] for change in group], amount_paid=old, is_paid=is_paid
+            ).values_list('pk', flat=True))
+            if not matched:
+                continue
+            AttendanceRecord.objects.filter(pk__in=matched).update(amount_paid=new)
+            ActivityEntry.objects.filter(activity_type='attendance', source_id__in=matched).update(amount=new)
+            applied.extend(change for change in group if change[0] in matched)
+        # Paid records no longer count towards the balance, so only unpaid ones move the ledger
+        for record_id, user_id, _, old, new, is_paid in applied:
+            if not is_paid:
+                batch.post(user_id, 'attendance', record_id, new - old)
+    return applied
+
+
+def reprice_attendance(queryset, dry_run=False, include_paid=False, chunk_size=REPRICE_CHUNK_SIZE, progress=None):
+    """
+    Recompute amount_paid from the rate card for every record in queryset.
+
+    Records are read in keyset-paged chunks ordered by user, and each chunk's
+    changes are written in its own transaction by _apply_reprices(): one
+    UPDATE per (old amount, new amount, is_paid) group, matching only rows
+    that still hold the old amount and paid flag. A record edited between the
+    read and the write keeps its new amount and isn't counted as changed.
+    Deltas of the unpaid rows actually written are posted with batch.post();
+    defer_balance_updates() bulk-inserts them when the chunk commits and
+    recomputes the balances of the users they touch.
+
+    Args:
+        queryset: AttendanceRecord queryset to reprice
+        dry_run: compute the changes without writing them
+        include_paid: also reprice records already marked paid (this doesn't
+                      move balances, only the recorded amount)
+        progress: optional callable(scanned, total, changed) called after each chunk
+
+    Returns:
+        dict: scanned, changed, total_delta, user_deltas ({user_id: delta of
+              unpaid amounts}) and changes, a list of
+              (record_id, user_id, date, old amount, new amount, is_paid)
+    """
+    if not include_paid:
+        queryset = queryset.filter(is_paid=False)
+    queryset = queryset.order_by('user_id', 'pk')
+    total = queryset.count()
+    table = get_rule_table()
+
+    result = {'scanned': 0, 'changed': 0, 'total_delta': to_amount(0), 'user_deltas': {}, 'changes': []}
+    last = None
+    while True:
+        page = queryset
+        if last:
+            page = page.filter(Q(user_id__gt=last[0]) | Q(user_id=last[0], pk__gt=last[1]))
+        rows = list(page.values_list(
+            'pk', 'user_id', 'date', 'overtime_hours', 'event_fk_id', 'amount_paid', 'is_paid',
+            'user__profile__employment_type', 'user__profile__job_role'
+        )[:chunk_size])
+        if not rows:
+            break
+        last = (rows[-1][1], rows[-1][0])
+
+        changes = []
+        for pk, user_id, date, overtime_hours, event_id, amount_paid, is_paid, employment_type, job_role in rows:
+            new = _price(table, employment_type, job_role, event_id, date, overtime_hours).total
+            old = to_amount(amount_paid)
+            if new == old:
+                continue
+            changes.append((pk, user_id, date, old, new, is_paid))
+
+        if changes and not dry_run:
+            changes = _apply_reprices(changes)
+        for _, user_id, _, old, new, is_paid in changes:
+            if not is_paid:
+                result['user_deltas'][user_id] = result['user_deltas'].get(user_id, to_amount(0)) + new - old
+                result['total_delta'] += new - old
+
+        result['scanned'] += len(rows)
+        result['changed'] += len(changes)
+        result['changes'].extend(changes)
+        if progress:
+            progress(result['scanned'], total, result['changed'])
+
+    logger.info(
+        f"Repriced attendance{' (dry run)' if dry_run else ''}: {result['changed']} of "
+        f"{result['scanned']} records changed, balance delta {result['total_delta']}"
+    )
+    return result
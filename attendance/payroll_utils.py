@@ -0,0 +1,174 @@
+"""
+Payroll Utilities
+Monthly payroll for salaried employees. A run is computed as a draft (one
+grouped query over the month's attendance, with overtime priced from the
+PayRule rate card), reviewed in the admin, then committed: every
+SalaryPayment is written with one bulk_create and the affected balances are
+updated once.
+"""
+import datetime
+from decimal import Decimal
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, Sum, Q, Exists, OuterRef, Value, DecimalField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import Profile, AttendanceRecord, SalaryPayment, PayrollRun, PayrollRunLine
+from .balance_utils import defer_balance_updates, to_amount
+from .pay_utils import price_records
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def month_bounds(month_year):
+    """First day of month_year's month and the first day of the next month"""
+    start = month_year.replace(day=1)
+    return start, (start + datetime.timedelta(days=32)).replace(day=1)
+
+
+def compute_payroll(month_year):
+    """
+    Pay for every salaried employee for one month: one grouped query for days,
+    overtime hours and supper allowance, and one to price the month's overtime.
+
+    Returns:
+        tuple: (lines, already_paid) where lines is a list of dicts with
+               user_id, days_worked, overtime_hours, base_salary, overtime_pay,
+               supper_allowance and total_amount, and already_paid lists the
+               user ids that already have a SalaryPayment for the month
+    """
+    start, end = month_bounds(month_year)
+    in_month = Q(user__attendancerecord__date__gte=start, user__attendancerecord__date__lt=end)
+
+    rows = (
+        Profile.objects.filter(employment_type='salaried', user__is_active=True)
+        .values('user_id', 'monthly_salary')
+        .annotate(
+            days_worked=Count('user__attendancerecord', filter=in_month),
+            overtime_hours=Coalesce(Sum('user__attendancerecord__overtime_hours', filter=in_month), 0),
+            supper=Coalesce(
+                Sum('user__attendancerecord__supper_allowance', filter=in_month),
+                Value(Decimal('0.00')),
+                output_field=DecimalField(max_digits=10, decimal_places=2)
+            ),
+            already_paid=Exists(SalaryPayment.objects.filter(user=OuterRef('user'), month_year=start)),
+        )
+        .order_by('user__username')
+    )
+
+    rows = list(rows)
+    overtime_pay = {}
+    month_records = AttendanceRecord.objects.filter(
+        user_id__in=[row['user_id'] for row in rows if not row['already_paid']],
+        date__gte=start,
+        date__lt=end
+    )
+    for user_id, price in price_records(month_records).values():
+        overtime_pay[user_id] = overtime_pay.get(user_id, Decimal('0.00')) + price.overtime_pay
+
+    lines = []
+    already_paid = []
+    for row in rows:
+        if row['already_paid']:
+            already_paid.append(row['user_id'])
+            continue
+        base_salary = to_amount(row['monthly_salary'])
+        overtime = overtime_pay.get(row['user_id'], Decimal('0.00'))
+        supper_allowance = to_amount(row['supper'])
+        lines.append({
+            'user_id': row['user_id'],
+            'days_worked': row['days_worked'],
+            'overtime_hours': row['overtime_hours'],
+            'base_salary': base_salary,
+            'overtime_pay': overtime,
+            'supper_allowance': supper_allowance,
+            'total_amount': base_salary + overtime + supper_allowance,
+        })
+    return lines, already_paid
+
+
+def draft_payroll_run(month_year, created_by=None):
+    """
+    Create or recompute the draft run for a month.
+
+    Returns:
+        tuple: (run, already_paid user ids)
+
+    Raises:
+        ValidationError: if the month's run has already been committed
+    """
+    start, _ = month_bounds(month_year)
+    with transaction.atomic():
+        run, _ = PayrollRun.objects.select_for_update().get_or_create(
+            month_year=start,
+            defaults={'created_by': created_by}
+        )
+        if run.status != 'draft':
+            raise ValidationError(f"The payroll for {start.strftime('%B %Y')} has already been committed.")
+
+        lines, already_paid = compute_payroll(start)
+        run.lines.all().delete()
+        PayrollRunLine.objects.bulk_create([PayrollRunLine(run=run, **line) for line in lines])
+        run.computed_at = timezone.now()
+        run.save(update_fields=['computed_at'])
+
+    logger.info(f"Payroll draft for {start:%B %Y}: {len(lines)} lines, {len(already_paid)} already paid")
+    return run, already_paid
+
+
+def commit_payroll_run(run, committed_by=None):
+    """
+    Write a draft run's SalaryPayments with one bulk_create and post them to
+    the balance ledger with one balance rebuild.
+
+    Returns:
+        int: number of SalaryPayment rows created
+
+    Raises:
+        ValidationError: if the run isn't a draft, or an employee was paid by
+                         hand for the month after the draft was computed
+    """
+    with transaction.atomic():
+        run = PayrollRun.objects.select_for_update().get(pk=run.pk)
+        if run.status != 'draft':
+            raise ValidationError(f"{run} has already been committed.")
+
+        lines = list(run.lines.select_related('user'))
+        paid = set(
+            SalaryPayment.objects.filter(month_year=run.month_year, user_id__in=[line.user_id for line in lines])
+            .values_list('user__username', flat=True)
+        )
+        if paid:
+            raise ValidationError(
+                f"Already paid for {run.month_year:%B %Y}: {', '.join(sorted(paid))}. Recompute the draft first."
+            )
+
+        note = f"Payroll run {run.month_year:%B %Y}"
+        with defer_balance_updates() as batch:
+            payments = SalaryPayment.objects.bulk_create([
+                SalaryPayment(
+                    user_id=line.user_id,
+                    month_year=run.month_year,
+                    base_salary=line.base_salary,
+                    overtime_pay=line.overtime_pay,
+                    supper_allowance=line.supper_allowance,
+                    total_amount=line.total_amount,
+                    paid_by=committed_by,
+                    notes=note,
+                )
+                for line in lines
+            ])
+            batch.add(payments)
+
+        for line, payment in zip(lines, payments):
+            line.salary_payment = payment
+        PayrollRunLine.objects.bulk_update(lines, ['salary_payment'])
+
+        run.status = 'committed'
+        run.committed_by = committed_by
+        run.committed_at = timezone.now()
+        run.save(update_fields=['status', 'committed_by', 'committed_at'])
+
+    logger.info(f"Payroll for {run.month_year:%B %Y} committed: {len(payments)} salary payments")
+    return len(payments)
@@ -0,0 +1,303 @@
+"""
+Reconciliation Utilities
+A push whose callback never arrives would stay 'pending' for ever.
+reconcile_pending() asks M-Pesa about pending payments older than
+MPESA_RECONCILE_AFTER seconds, several at a time under the shared rate
+limit, and applies the answers through the same state machine as
+callbacks. It also sends queued pushes no worker picked up (the process
+restarted before the task ran) and fails pushes whose sender died
+mid-request, since whether M-Pesa got those can't be known.
+
+run_reconciliation() wraps it in an MpesaReconcileRun row, so runs never
+overlap and a failure is recorded; `manage.py reconcile_mpesa` calls it
+and is meant to run from cron. start_scheduler() can run it on a thread in
+the web process instead, when MPESA_RECONCILE_SCHEDULER is on.
+settlement_metrics() reports how long payments take to settle and how many
+are still waiting.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections, transaction, IntegrityError
+from django.db.models import Q
+from django.utils import timezone
+from .models import MpesaPayment, MpesaReconcileRun
+from .mpesa_utils import (
+    get_mpesa_client, apply_payment_result, result_status, dispatch_stk_push, transition_payment, RateLimiter
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds after which a 'running' reconciliation is taken to have died with its process
+RECONCILE_RUN_TIMEOUT = 30 * 60
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+# Seconds a claimed push may stay unanswered before its sender is presumed dead
+DISPATCH_CLAIM_TIMEOUT = 300
+
+
+def stale_pending(older_than=None, limit=None):
+    """(pk, checkout_request_id) of pending payments, oldest first, not initiated or checked in the last older_than seconds"""
+    older_than = settings.MPESA_RECONCILE_AFTER if older_than is None else older_than
+    cutoff = timezone.now() - datetime.timedelta(seconds=older_than)
+    payments = MpesaPayment.objects.filter(
+        status='pending',
+        checkout_request_id__isnull=False,
+        initiated_at__lte=cutoff
+    ).filter(
+        Q(checked_at__isnull=True) | Q(checked_at__lte=cutoff)
+    ).order_by('initiated_at').values_list('pk', 'checkout_request_id')
+    return list(payments[:limit or settings.MPESA_RECONCILE_BATCH])
+
+
+def stale_initiated(older_than=None, limit=None):
+    """pks of 'initiated' payments no worker has claimed older_than seconds after they were queued, oldest first"""
+    older_than = settings.MPESA_RECONCILE_AFTER if older_than is None else older_than
+    cutoff = timezone.now() - datetime.timedelta(seconds=older_than)
+    payments = MpesaPayment.objects.filter(
+        status='initiated',
+        checkout_request_id__isnull=True,
+        dispatched_at__isnull=True,
+        initiated_at__lte=cutoff
+    ).order_by('initiated_at').values_list('pk', flat=True)
+    return list(payments[:limit or settings.MPESA_RECONCILE_BATCH])
+
+
+def fail_abandoned_dispatches():
+    """
+    Fail 'initiated' payments claimed for sending more than
+    DISPATCH_CLAIM_TIMEOUT seconds ago that never got a checkout ID. Pushing
+    them again could prompt the customer twice, so they are left for an admin.
+
+    Returns:
+        int: payments failed
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=DISPATCH_CLAIM_TIMEOUT)
+    abandoned = MpesaPayment.objects.filter(
+        status='initiated',
+        checkout_request_id__isnull=True,
+        dispatched_at__lte=cutoff
+    ).values_list('pk', flat=True)
+    failed = 0
+    for payment_id in abandoned:
+        failed += transition_payment(
+            payment_id,
+            'failed',
+            result_description='Sending the STK push was interrupted; M-Pesa may not have received it',
+            settled_at=timezone.now(),
+            settled_via='dispatch'
+        )
+    return failed
+
+
+def _redispatch_one(payment_id, limiter):
+    close_old_connections()
+    try:
+        result = dispatch_stk_push(payment_id, limiter=limiter)
+        return 'sent' if result.get('success') else 'send_failed'
+    finally:
+        close_old_connections()
+
+
+def _reconcile_one(payment_id, checkout_request_id, limiter, dry_run):
+    close_old_connections()
+    try:
+        limiter.wait()
+        response = get_mpesa_client().query_payment_status(checkout_request_id)
+        if not dry_run:
+            MpesaPayment.objects.filter(pk=payment_id).update(checked_at=timezone.now())
+        # Daraja answers with an error while the customer still has the prompt open
+        if 'ResultCode' not in response:
+            return 'pending'
+        result_code = int(response['ResultCode'])
+        if dry_run:
+            return result_status(result_code)
+        return apply_payment_result(payment_id, result_code, response.get('ResultDesc'), via='query')
+    finally:
+        close_old_connections()
+
+
+def reconcile_pending(older_than=None, limit=None, concurrency=None, rate=None, dry_run=False):
+    """
+    Query M-Pesa for stale pending payments and settle the ones it has an
+    answer for; send queued pushes that were never picked up.
+
+    Args:
+        older_than: seconds a payment must have been pending (and unchecked),
+                    or queued and unclaimed, for (default MPESA_RECONCILE_AFTER)
+        limit: most payments to query, and to send (default MPESA_RECONCILE_BATCH)
+        concurrency: parallel queries (default MPESA_RECONCILE_CONCURRENCY)
+        rate: queries per second (default MPESA_RATE_LIMIT)
+        dry_run: query without changing anything
+
+    Returns:
+        dict: checked, elapsed and a count per outcome (completed, failed,
+              cancelled, unchanged, pending - no answer yet - and error; for
+              queued pushes sent, send_failed and abandoned, or unsent on a
+              dry run)
+    """
+    concurrency = concurrency or settings.MPESA_RECONCILE_CONCURRENCY
+    rate = settings.MPESA_RATE_LIMIT if rate is None else rate
+    payments = stale_pending(older_than, limit)
+    unsent = stale_initiated(older_than, limit)
+
+    stats = {'checked': len(payments), 'elapsed': 0.0}
+    if dry_run:
+        if unsent:
+            stats['unsent'] = len(unsent)
+    else:
+        abandoned = fail_abandoned_dispatches()
+        if abandoned:
+            stats['abandoned'] = abandoned
+    limiter = RateLimiter(rate)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='mpesa-reconcile') as pool:
+        futures = [pool.submit(_reconcile_one, pk, checkout_id, limiter, dry_run) for pk, checkout_id in payments]
+        if not dry_run:
+            futures += [pool.submit(_redispatch_one, pk, limiter) for pk in unsent]
+        for future in futures:
+            try:
+                outcome = future.result()
+            except Exception:
+                logger.exception("Error reconciling an M-Pesa payment")
+                outcome = 'error'
+            stats[outcome] = stats.get(outcome, 0) + 1
+    stats['elapsed'] = time.monotonic() - started
+
+    if len(stats) > 2:
+        outcomes = ', '.join(f'{stats[key]} {key}' for key in sorted(stats) if key not in ('checked', 'elapsed'))
+        logger.info(
+            f"M-Pesa reconciliation{' (dry run)' if dry_run else ''}: {stats['checked']} pending payments "
+            f"checked in {stats['elapsed']:.1f}s: {outcomes}"
+        )
+    return stats
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def settlement_metrics(since):
+    """
+    How payments initiated since `since` settled: counts by status and by how
+    the result arrived, settle times (seconds from initiation to final
+    status), and the payments still pending.
+    """
+    now = timezone.now()
+    rows = MpesaPayment.objects.filter(initiated_at__gte=since, status__in=FINAL_STATUSES).exclude(
+        settled_at=None
+    ).values_list('status', 'settled_via', 'initiated_at', 'settled_at')
+
+    by_status, by_source, durations = {}, {}, []
+    for status, settled_via, initiated_at, settled_at in rows:
+        by_status[status] = by_status.get(status, 0) + 1
+        by_source[settled_via] = by_source.get(settled_via, 0) + 1
+        durations.append((settled_at - initiated_at).total_seconds())
+    durations.sort()
+
+    pending = MpesaPayment.objects.filter(status='pending')
+    oldest = pending.order_by('initiated_at').values_list('initiated_at', flat=True).first()
+    stale_cutoff = now - datetime.timedelta(seconds=settings.MPESA_RECONCILE_AFTER)
+    return {
+        'since': since.isoformat(),
+        'settled': len(durations),
+        'by_status': by_status,
+        'by_source': by_source,
+        'settle_seconds': {
+            'p50': _percentile(durations, 0.5),
+            'p90': _percentile(durations, 0.9),
+            'max': durations[-1] if durations else None,
+        },
+        'pending': pending.count(),
+        'stale_pending': pending.filter(initiated_at__lte=stale_cutoff).count(),
+        'oldest_pending_seconds': (now - oldest).total_seconds() if oldest else None,
+    }
+
+
+class ReconcileBusy(Exception):
+    """Another reconciliation run is in progress"""
+
+
+def run_reconciliation(trigger='command', **options):
+    """
+    reconcile_pending(**options) recorded as an MpesaReconcileRun. Only one
+    run can be 'running' (a partial unique index), so concurrent callers get
+    ReconcileBusy; a run left 'running' by a killed process for
+    RECONCILE_RUN_TIMEOUT seconds is marked failed first.
+
+    Raises:
+        ReconcileBusy: if another run is in progress
+    """
+    now = timezone.now()
+    MpesaReconcileRun.objects.filter(
+        status='running', started_at__lt=now - datetime.timedelta(seconds=RECONCILE_RUN_TIMEOUT)
+    ).update(status='failed', finished_at=now, error='The run stopped without finishing')
+    try:
+        with transaction.atomic():
+            run = MpesaReconcileRun.objects.create(trigger=trigger)
+    except IntegrityError:
+        raise ReconcileBusy("Another M-Pesa reconciliation is running")
+
+    runs = MpesaReconcileRun.objects.filter(pk=run.pk)
+    try:
+        stats = reconcile_pending(**options)
+    except Exception as e:
+        runs.update(status='failed', finished_at=timezone.now(), error=f"{type(e).__name__}: {e}")
+        raise
+    runs.update(
+        status='completed',
+        finished_at=timezone.now(),
+        checked=stats['checked'],
+        summary=', '.join(
+            f'{stats[key]} {key}' for key in sorted(stats) if key not in ('checked', 'elapsed')
+        )[:255]
+    )
+    return stats
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def _scheduler_loop(interval):
+    while True:
+        time.sleep(interval)
+        close_old_connections()
+        try:
+            # Another process (or cron) already ran this interval
+            recent = timezone.now() - datetime.timedelta(seconds=max(interval - 5, 1))
+            if not MpesaReconcileRun.objects.filter(started_at__gte=recent).exists():
+                run_reconciliation('scheduler')
+        except ReconcileBusy:
+            pass
+        except Exception:
+            logger.exception("M-Pesa reconciliation failed")
+        finally:
+            close_old_connections()
+
+
+def start_scheduler():
+    """
+    Reconcile every MPESA_RECONCILE_INTERVAL seconds on a daemon thread in this
+    process, if MPESA_RECONCILE_SCHEDULER is on (it is off by default; run
+    `manage.py reconcile_mpesa` from cron instead). Called from wsgi.py, so
+    it only works without gunicorn --preload.
+    """
+    global _scheduler
+    interval = getattr(settings, 'MPESA_RECONCILE_INTERVAL', 0)
+    if not getattr(settings, 'MPESA_RECONCILE_SCHEDULER', False) or not interval:
+        return None
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = threading.Thread(
+                target=_scheduler_loop,
+                args=(interval,),
+                name='mpesa-reconcile',
+                daemon=True
+            )
+            _scheduler.start()
+    return _scheduler
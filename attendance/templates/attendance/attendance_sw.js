@@ -0,0 +1,37 @@
+// Keeps the last copy of the mark attendance page so crew can open it at
+// venues without signal. Submissions made offline are queued by the page
+// itself (localStorage) and synced to {% url 'sync_attendance' %}.
+const CACHE_NAME = 'sound-fusion-attendance-v1';
+const MARK_ATTENDANCE_URL = '{% url "mark_attendance" %}';
+
+self.addEventListener('install', event => {
+  self.skipWaiting();
+});
+
+self.addEventListener('activate', event => {
+  event.waitUntil(
+    caches.keys()
+      .then(keys => Promise.all(keys.filter(key => key !== CACHE_NAME).map(key => caches.delete(key))))
+      .then(() => self.clients.claim())
+  );
+});
+
+// Network first for the mark attendance page, falling back to the cached copy
+self.addEventListener('fetch', event => {
+  const url = new URL(event.request.url);
+  if (event.request.method !== 'GET' || url.pathname !== MARK_ATTENDANCE_URL) {
+    return;
+  }
+
+  event.respondWith(
+    fetch(event.request)
+      .then(response => {
+        if (response.ok && !response.redirected) {
+          const copy = response.clone();
+          caches.open(CACHE_NAME).then(cache => cache.put(MARK_ATTENDANCE_URL, copy));
+        }
+        return response;
+      })
+      .catch(() => caches.match(MARK_ATTENDANCE_URL).then(cached => cached || Response.error()))
+  );
+});
@@ -1,3 +1,281 @@
-from django.test import TestCase
+import datetime
+import json
+from decimal import Decimal
+from unittest import skipUnless
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from .attendance_utils import sync_offline_submissions
+from .balance_utils import defer_balance_updates, rebuild_balances
+from .models import (
+    AttendanceRecord, BalanceAdjustment, BalanceLedgerEntry, EmailNotification, Event, ExpenseReimbursement,
+    MpesaCallbackLog, MpesaPayment, PayRule, Profile, SalaryPayment
+)
+from .mpesa_utils import log_mpesa_callback, process_callback_log, transition_payment
 
-# Create your tests here.
+
+@skipUnless(connection.vendor in ('sqlite', 'postgresql'), 'Query plans are only checked on SQLite and PostgreSQL')
+class QueryPlanTests(TestCase):
+    """Hot lookups must keep using their indexes (see migration 0035)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='plan-user')
+        cls.event = Event.objects.create(name='Plan Event', date=datetime.date(2025, 1, 1))
+        AttendanceRecord.objects.create(user=cls.user, date=datetime.date(2025, 1, 1), event_fk=cls.event)
+
+    def assertUsesIndex(self, queryset, index_name):
+        """
+        index_name is the index/constraint name; SQLite names the index behind a
+        UNIQUE constraint sqlite_autoindex_<table>_N, so unique lookups pass the table.
+        """
+        if connection.vendor == 'postgresql':
+            # Tiny test tables would otherwise always be scanned sequentially
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, f"Expected {index_name} in query plan:\n{plan}")
+
+    def unique_index(self, model, constraint_name):
+        if connection.vendor == 'sqlite':
+            return f'sqlite_autoindex_{model._meta.db_table}'
+        return constraint_name
+
+    def test_attendance_by_user_and_date(self):
+        queryset = AttendanceRecord.objects.filter(user=self.user, date=datetime.date(2025, 1, 1))
+        self.assertUsesIndex(queryset, self.unique_index(AttendanceRecord, 'unique_attendance_per_user_per_day'))
+
+    def test_unpaid_attendance_by_user(self):
+        queryset = AttendanceRecord.objects.filter(user=self.user, is_paid=False)
+        self.assertUsesIndex(queryset, 'attendance_unpaid_idx')
+
+    def test_attendance_by_event_and_date(self):
+        queryset = AttendanceRecord.objects.filter(event_fk=self.event, date=datetime.date(2025, 1, 1))
+        self.assertUsesIndex(queryset, 'attendance_event_date_idx')
+
+    def test_reimbursements_by_status(self):
+        queryset = ExpenseReimbursement.objects.filter(status='pending').order_by('requested_at')
+        self.assertUsesIndex(queryset, 'reimbursement_status_idx')
+
+    def test_salary_payment_by_user_and_month(self):
+        queryset = SalaryPayment.objects.filter(user=self.user, month_year=datetime.date(2025, 1, 1))
+        self.assertUsesIndex(queryset, self.unique_index(SalaryPayment, 'unique_salary_per_user_per_month'))
+
+
+class BalanceLedgerTests(TestCase):
+    """Profile.balance moves by ledger deltas as attendance, adjustments and salary payments change"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='ledger-user')
+
+    def balance(self):
+        return Profile.objects.get(user=self.user).balance
+
+    def ledger_total(self):
+        return sum(BalanceLedgerEntry.objects.filter(user=self.user).values_list('amount', flat=True), Decimal('0'))
+
+    def attend(self, day, amount, **fields):
+        return AttendanceRecord.objects.create(
+            user=self.user, date=datetime.date(2025, 1, day), amount_paid=Decimal(amount), **fields
+        )
+
+    def test_attendance_create_edit_delete(self):
+        record = self.attend(1, '1000.00')
+        self.assertEqual(self.balance(), Decimal('1000.00'))
+
+        record.amount_paid = Decimal('1500.00')
+        record.save()
+        self.assertEqual(self.balance(), Decimal('1500.00'))
+
+        record.is_paid = True
+        record.save()
+        self.assertEqual(self.balance(), Decimal('0.00'))
+
+        record.is_paid = False
+        record.save()
+        self.assertEqual(self.balance(), Decimal('1500.00'))
+
+        record.delete()
+        self.assertEqual(self.balance(), Decimal('0.00'))
+        self.assertEqual(self.ledger_total(), Decimal('0.00'))
+
+    def test_paid_attendance_does_not_count(self):
+        self.attend(1, '1000.00', is_paid=True)
+        self.assertEqual(self.balance(), Decimal('0.00'))
+        self.assertFalse(BalanceLedgerEntry.objects.filter(user=self.user).exists())
+
+    def test_saves_that_skip_the_amount_post_nothing(self):
+        record = self.attend(1, '1000.00')
+        record.overtime_hours = 2
+        record.save(update_fields=['overtime_hours'])
+        self.assertEqual(BalanceLedgerEntry.objects.filter(user=self.user).count(), 1)
+
+    def test_adjustment_create_edit_delete(self):
+        adjustment = BalanceAdjustment.objects.create(user=self.user, amount=Decimal('-200.00'))
+        self.assertEqual(self.balance(), Decimal('-200.00'))
+
+        adjustment.amount = Decimal('300.00')
+        adjustment.save()
+        self.assertEqual(self.balance(), Decimal('300.00'))
+
+        adjustment.delete()
+        self.assertEqual(self.balance(), Decimal('0.00'))
+
+    def test_salary_payment_create_edit_delete(self):
+        payment = SalaryPayment.objects.create(
+            user=self.user, month_year=datetime.date(2025, 1, 1),
+            base_salary=Decimal('20000.00'), total_amount=Decimal('20000.00')
+        )
+        self.assertEqual(self.balance(), Decimal('20000.00'))
+
+        payment.total_amount = Decimal('21500.00')
+        payment.save()
+        self.assertEqual(self.balance(), Decimal('21500.00'))
+
+        payment.delete()
+        self.assertEqual(self.balance(), Decimal('0.00'))
+
+    def make_history(self):
+        record = self.attend(1, '1000.00')
+        self.attend(2, '800.00')
+        BalanceAdjustment.objects.create(user=self.user, amount=Decimal('-250.00'))
+        SalaryPayment.objects.create(
+            user=self.user, month_year=datetime.date(2025, 1, 1),
+            base_salary=Decimal('5000.00'), total_amount=Decimal('5000.00')
+        )
+        record.amount_paid = Decimal('1200.00')
+        record.save()
+
+    def test_deferred_updates_give_the_same_totals(self):
+        self.make_history()
+        immediate = self.balance()
+
+        other = User.objects.create(username='ledger-deferred')
+        self.user = other
+        with defer_balance_updates():
+            self.make_history()
+            # Nothing is written until the block exits
+            self.assertEqual(self.balance(), Decimal('0.00'))
+        self.assertEqual(self.balance(), immediate)
+        self.assertEqual(self.ledger_total(), immediate)
+
+    def test_rebuild_agrees_with_ledger(self):
+        self.make_history()
+        expected = self.balance()
+        self.assertEqual(self.ledger_total(), expected)
+
+        Profile.objects.filter(user=self.user).update(balance=Decimal('999999.00'))
+        rebuild_balances([self.user.id])
+        self.assertEqual(self.balance(), expected)
+        self.assertEqual(expected, Decimal('1200.00') + Decimal('800.00') - Decimal('250.00') + Decimal('5000.00'))
+
+
+@override_settings(MPESA_ASYNC_CALLBACKS=False)
+class MpesaCallbackTests(TestCase):
+    """Callbacks are logged, deduplicated by event and applied through MpesaPayment.TRANSITIONS"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='mpesa-user', email='mpesa-user@example.com')
+
+    def setUp(self):
+        self.payment = MpesaPayment.objects.create(
+            user=self.user, phone_number='254700000000', amount=Decimal('100.00'),
+            payment_purpose='Test', status='pending', checkout_request_id='ws_CO_1'
+        )
+
+    def callback(self, result_code, receipt='RCP123'):
+        body = {'Body': {'stkCallback': {
+            'MerchantRequestID': 'm-1',
+            'CheckoutRequestID': self.payment.checkout_request_id,
+            'ResultCode': result_code,
+            'ResultDesc': 'ok' if result_code == 0 else 'failed',
+        }}}
+        if result_code == 0:
+            body['Body']['stkCallback']['CallbackMetadata'] = {'Item': [
+                {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+                {'Name': 'TransactionDate', 'Value': 20250131154512},
+            ]}
+        return log_mpesa_callback(json.dumps(body), '196.201.214.200')
+
+    def test_duplicate_callback_applied_once(self):
+        first = self.callback(0)
+        repeat = self.callback(0)
+        first.refresh_from_db()
+        repeat.refresh_from_db()
+
+        self.assertEqual(first.status, 'processed')
+        self.assertEqual(first.event_key, 'ws_CO_1:0')
+        self.assertEqual(repeat.status, 'duplicate')
+        self.assertIsNone(repeat.event_key)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertEqual(self.payment.receipt_number, 'RCP123')
+        self.assertEqual(EmailNotification.objects.filter(user=self.user).count(), 1)
+
+    def test_late_failure_after_completion_rejected(self):
+        self.callback(0)
+        late = self.callback(1)
+        late.refresh_from_db()
+
+        # A different event, so it is processed, but the payment can't leave 'completed'
+        self.assertEqual(late.status, 'processed')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertEqual(self.payment.result_code, 0)
+        self.assertFalse(transition_payment(self.payment.pk, 'failed'))
+        self.assertFalse(transition_payment(self.payment.pk, 'pending'))
+
+    def test_reapply_is_idempotent(self):
+        log = self.callback(0)
+        self.payment.refresh_from_db()
+        settled_at = self.payment.settled_at
+
+        for _ in range(2):
+            self.assertEqual(process_callback_log(log.pk, reapply=True), 'processed')
+        log.refresh_from_db()
+        self.payment.refresh_from_db()
+        self.assertEqual(log.attempts, 3)
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertEqual(self.payment.settled_at, settled_at)
+        self.assertEqual(EmailNotification.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(MpesaCallbackLog.objects.filter(event_key='ws_CO_1:0').count(), 1)
+
+
+class OfflineSyncTests(TestCase):
+    """Retried offline submissions are applied once per client key"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='offline-user')
+        cls.event = Event.objects.create(name='Offline Event', date=timezone.localdate())
+        PayRule.objects.create(effective_from=datetime.date(2000, 1, 1),
+                               base_daily_pay=Decimal('1000.00'), overtime_rate=Decimal('100.00'))
+
+    def submission(self, key='k1'):
+        return {'idempotency_key': key, 'checked_in_at': timezone.now().isoformat(), 'event_fk': self.event.id}
+
+    def test_same_key_twice_applied_once(self):
+        first = sync_offline_submissions(self.user, [self.submission()])
+        second = sync_offline_submissions(self.user, [self.submission()])
+
+        self.assertEqual(first[0]['status'], 'created')
+        self.assertEqual(second[0]['status'], 'duplicate')
+        self.assertEqual(second[0]['record_id'], first[0]['record_id'])
+        self.assertEqual(AttendanceRecord.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(BalanceLedgerEntry.objects.filter(user=self.user, source_type='attendance').count(), 1)
+        self.assertEqual(Profile.objects.get(user=self.user).balance, Decimal('1000.00'))
+
+    def test_key_repeated_in_one_batch(self):
+        results = sync_offline_submissions(self.user, [self.submission(), self.submission()])
+        self.assertEqual([result['status'] for result in results], ['created', 'duplicate'])
+        self.assertEqual(AttendanceRecord.objects.filter(user=self.user).count(), 1)
+
+    def test_keys_are_per_user(self):
+        other = User.objects.create(username='offline-other')
+        sync_offline_submissions(self.user, [self.submission()])
+        results = sync_offline_submissions(other, [self.submission()])
+        self.assertEqual(results[0]['status'], 'created')
+        self.assertEqual(AttendanceRecord.objects.filter(user=other).count(), 1)
@@ -14,9 +14,19 @@ urlpatterns = [
     path('view-attendance/', views.view_attendance, name='view_attendance'),
     path('edit-attendance/<int:record_id>/', views.edit_attendance, name='edit_attendance'),
     path('attendance/mark', views.mark_attendance, name='mark_attendance'),
+    path('attendance/sw.js', views.attendance_service_worker, name='attendance_service_worker'),
+    path('api/attendance/sync/', views.sync_attendance, name='sync_attendance'),
     path('api/events/', views.get_events, name='get_events'),
+    path('api/cache-stats/', views.cache_stats, name='cache_stats'),
+    path('api/mpesa/settlement-stats/', views.mpesa_settlement_stats, name='mpesa_settlement_stats'),
     path('admin-dashboard/', views.admin_dashboard, name='admin_dashboard'),
     path('manage-balances/', views.manage_balances, name='manage_balances'),
+    path('exports/', views.export_data, name='export_data'),
+    path('exports/<str:token>/status/', views.export_status, name='export_status'),
+    path('exports/<str:token>/download/', views.export_download, name='export_download'),
+    path('disbursements/', views.disbursements, name='disbursements'),
+    path('disbursements/<int:batch_id>/', views.disbursement_detail, name='disbursement_detail'),
+    path('disbursements/<int:batch_id>/status/', views.disbursement_status, name='disbursement_status'),
     path('admin/user-attendance-history/<int:user_id>/', views.view_user_attendance_history, name='view_user_attendance_history'),
     path('admin/reimbursement/<int:reimbursement_id>/action/', views.reimbursement_action, name='reimbursement_action'),
     path('logout/', views.user_logout, name='logout'),
@@ -27,6 +37,7 @@ urlpatterns = [
     path('events/<int:pk>/', views.event_detail, name='event_detail'),
     path('events/<int:pk>/edit/', views.event_edit, name='event_edit'),
     path('events/<int:pk>/delete/', views.event_delete, name='event_delete'),
+    path('events/<int:pk>/check-in/', views.event_check_in, name='event_check_in'),
     
     # Expense Reimbursement URLs
     path('reimbursement/submit/', views.submit_reimbursement, name='submit_reimbursement'),
@@ -1,21 +1,38 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.models import User
-from .forms import UserRegisterForm, AttendanceForm, EventForm, ExpenseReimbursementForm, EmploymentTypeForm, SalariedEmployeeRegistrationForm
+from .forms import UserRegisterForm, AttendanceForm, EventForm, ExpenseReimbursementForm, EmploymentTypeForm, SalariedEmployeeRegistrationForm, BalanceFilterForm, ExportForm, DisbursementForm
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from .models import (
     AttendanceRecord, Profile, Event, BalanceAdjustment, ExpenseReimbursement, 
-    EmployeeOnboarding, MpesaPayment
+    EmployeeOnboarding, MpesaPayment, ActivityEntry, DisbursementBatch
 )
+from .balance_utils import apply_bulk_adjustments
+from .event_utils import search_events, find_or_create_event
+from .attendance_utils import check_in_crew, sync_offline_submissions, attendance_amount
+from .cache_utils import cached_for_user, shared_cache, EVENTS_VERSION_KEY
+from .export_utils import export_rows, stream_csv, export_filename, prepare_export, get_export_job, export_file_path
+from .disbursement_utils import collect_legs, create_batch, start_batch, batch_progress
 from django.utils import timezone
-from django.db.models import Sum
-from django.http import JsonResponse
-from django.views.decorators.http import require_http_methods
+from django.db import transaction, IntegrityError
+from django.db.models import Sum, Count, Max, F, Q, OuterRef, Subquery, Prefetch, Window
+from django.db.models.functions import RowNumber
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.http import JsonResponse, StreamingHttpResponse, FileResponse, Http404
+from django.conf import settings
+from django.urls import reverse
+from django.views.decorators.http import require_http_methods, condition
+from django.utils.cache import patch_cache_control
 from django.views.decorators.csrf import csrf_exempt
 import json
+import base64
+import binascii
 import datetime
+import hashlib
 import logging
+from decimal import Decimal
 
 logger = logging.getLogger(__name__)
 
@@ -27,12 +44,88 @@ def home(request):
     """Landing page"""
     return render(request, 'attendance/home.html')
 
+# /api/events/ paging and window defaults
+EVENTS_API_DEFAULT_LIMIT = 20
+EVENTS_API_MAX_LIMIT = 100
+EVENTS_API_WINDOW_DAYS = 30
+EVENTS_API_MAX_WINDOW_DAYS = 366
+
+
+def _events_version():
+    """Latest Event.updated_at and the event count, shared-cached until an event changes"""
+    return shared_cache.get_or_set(
+        EVENTS_VERSION_KEY,
+        lambda: Event.objects.aggregate(last_modified=Max('updated_at'), count=Count('id'))
+    )
+
+
+def _events_etag(request):
+    version = _events_version()
+    key = '|'.join([
+        str(version['last_modified']), str(version['count']),
+        timezone.localdate().isoformat(), request.GET.urlencode()
+    ])
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def _events_last_modified(request):
+    return _events_version()['last_modified']
+
+
+def _encode_event_cursor(event):
+    return base64.urlsafe_b64encode(f"{event['date'].isoformat()}|{event['id']}".encode()).decode()
+
+
+def _decode_event_cursor(cursor):
+    date_str, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.date.fromisoformat(date_str), int(pk)
+
+
 @require_http_methods(["GET"])
+@condition(etag_func=_events_etag, last_modified_func=_events_last_modified)
 def get_events(request):
-    """API endpoint to fetch all events as JSON for autocomplete"""
-    events = Event.objects.all().order_by('-date').values('id', 'name', 'date')
-    events_list = list(events)
-    return JsonResponse({'events': events_list})
+    """
+    API endpoint for the event autocomplete.
+
+    Query parameters:
+        q: name search, ignoring case and punctuation (see event_utils.search_events)
+        around: centre of the date window (YYYY-MM-DD, default today)
+        days: half-width of the date window in days (default 30)
+        limit: page size (default 20, max 100)
+        cursor: next_cursor from the previous page
+
+    Responses carry an ETag and Last-Modified, so a repeated request returns 304.
+    """
+    try:
+        around = datetime.date.fromisoformat(request.GET['around']) if request.GET.get('around') else timezone.localdate()
+        days = min(int(request.GET.get('days', EVENTS_API_WINDOW_DAYS)), EVENTS_API_MAX_WINDOW_DAYS)
+        limit = min(int(request.GET.get('limit', EVENTS_API_DEFAULT_LIMIT)), EVENTS_API_MAX_LIMIT)
+        cursor = _decode_event_cursor(request.GET['cursor']) if request.GET.get('cursor') else None
+    except (ValueError, TypeError, binascii.Error):
+        return JsonResponse({'error': 'Invalid around, days, limit or cursor'}, status=400)
+    if days < 0 or limit < 1:
+        return JsonResponse({'error': 'days and limit must be positive'}, status=400)
+
+    # Clamp the window at the ends of the calendar rather than overflow
+    window = datetime.timedelta(days=days)
+    start = around - window if around - datetime.date.min >= window else datetime.date.min
+    end = around + window if datetime.date.max - around >= window else datetime.date.max
+    events = Event.objects.filter(date__range=(start, end))
+    q = request.GET.get('q', '').strip()
+    if q:
+        events = search_events(q, events)
+    if cursor:
+        cursor_date, cursor_id = cursor
+        events = events.filter(Q(date__lt=cursor_date) | Q(date=cursor_date, id__lt=cursor_id))
+
+    # Keyset pagination: one extra row tells us whether there is a next page
+    page = list(events.order_by('-date', '-id').values('id', 'name', 'date')[:limit + 1])
+    next_cursor = _encode_event_cursor(page[limit - 1]) if len(page) > limit else None
+
+    response = JsonResponse({'events': page[:limit], 'next_cursor': next_cursor})
+    # Let browsers keep the response but revalidate it with the ETag every time
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 def employment_type_selection(request):
     """First step: Choose employment type"""
@@ -232,157 +325,97 @@ def user_login(request):
 
 @login_required
 def dashboard(request):
-    from .models import PaymentRecord
-    
     user = request.user
     today = timezone.now().date()
-    # Use get_or_create to safely get or create profile
-    profile, created = Profile.objects.get_or_create(user=user)
-    
-    # Refresh profile from database to ensure we have latest balance
-    profile.refresh_from_db()
 
-    # Fetch today's attendance with select_related for event
-    try:
-        today_record = AttendanceRecord.objects.select_related('event_fk').get(user=user, date=today)
-        attendance_status = "Recorded"
-    except AttendanceRecord.DoesNotExist:
-        today_record = None
-        attendance_status = "Not recorded"
-
-    # Get total balance from Profile
-    total_balance = profile.balance
-
-    # Get last 5 attendance records for recent balance changes
-    recent_records = AttendanceRecord.objects.filter(user=user).select_related('event_fk').order_by('-date')[:5]
-    
-    # Get last 5 balance adjustments made by admin
-    recent_adjustments = BalanceAdjustment.objects.filter(user=user).order_by('-date')[:5]
-    
-    # Get last 5 balance adjustments (comprehensive change log)
-    balance_changes = recent_adjustments
-    
-    # Get recent payments marked by user
-    payment_records = PaymentRecord.objects.filter(user=user).order_by('-payment_date')[:5]
-    
-    # Combine and sort all activities by date (most recent first)
-    all_activities = []
-    
-    # Add attendance records
-    for record in recent_records:
-        # Combine date and check_in_time to create a proper datetime
-        record_datetime = datetime.datetime.combine(record.date, record.check_in_time)
-        # Make it timezone aware in the app's timezone
-        record_datetime = timezone.make_aware(record_datetime, timezone=timezone.get_current_timezone())
-        all_activities.append({
-            'type': 'attendance',
-            'date': record.date,
-            'datetime': record_datetime,
-            'object': record
-        })
-    
-    # Add balance adjustments
-    for adjustment in recent_adjustments:
-        all_activities.append({
-            'type': 'adjustment',
-            'date': adjustment.date,
-            'datetime': adjustment.date,
-            'object': adjustment
-        })
-    
-    # Add payment records
-    for payment in payment_records:
-        all_activities.append({
-            'type': 'payment',
-            'date': payment.payment_date,
-            'datetime': payment.payment_date,
-            'object': payment
-        })
-    
-    # Sort all activities by datetime, most recent first
-    all_activities.sort(key=lambda x: x['datetime'], reverse=True)
-    
-    # Keep only the top 10 most recent activities
-    all_activities = all_activities[:10]
+    def build():
+        # Use get_or_create to safely get or create profile
+        profile, created = Profile.objects.get_or_create(user=user)
 
-    # For salaried employees, show salary information
-    # Check if employee has completed onboarding with status "accepted" or higher
-    salary_info = None
-    if profile.employment_type == 'salaried':
-        # Check onboarding status - show salary once accepted
+        # Fetch today's attendance with select_related for event
         try:
-            onboarding = EmployeeOnboarding.objects.filter(user=user).latest('submitted_at')
-            # Show salary info if status is accepted, completed, or any active status (not pending/rejected)
-            if onboarding.status in ['accepted', 'completed']:
-                from .models import SalaryPayment
+            today_record = AttendanceRecord.objects.select_related('event_fk').get(user=user, date=today)
+            attendance_status = "Recorded"
+        except AttendanceRecord.DoesNotExist:
+            today_record = None
+            attendance_status = "Not recorded"
+
+        # Latest 10 entries from the materialised activity feed (one indexed range scan)
+        all_activities = list(ActivityEntry.objects.filter(user=user)[:10])
+
+        # For salaried employees, show salary information
+        # Check if employee has completed onboarding with status "accepted" or higher
+        salary_info = None
+        if profile.employment_type == 'salaried':
+            from .models import SalaryPayment
+            # Check onboarding status - show salary once accepted
+            try:
+                onboarding = EmployeeOnboarding.objects.filter(user=user).latest('submitted_at')
+                # Show salary info if status is accepted, completed, or any active status (not pending/rejected)
+                if onboarding.status in ['accepted', 'completed']:
+                    last_salary = SalaryPayment.objects.filter(user=user).order_by('-month_year').first()
+                    salary_info = {
+                        'job_role': profile.job_role,
+                        'monthly_salary': profile.monthly_salary,
+                        'last_salary_payment': last_salary,
+                        'employment_type': 'Salaried Employee',
+                        'onboarding_status': onboarding.get_status_display() if hasattr(onboarding, 'get_status_display') else onboarding.status
+                    }
+            except EmployeeOnboarding.DoesNotExist:
+                # No onboarding record, but still salaried - show basic info
                 last_salary = SalaryPayment.objects.filter(user=user).order_by('-month_year').first()
                 salary_info = {
                     'job_role': profile.job_role,
                     'monthly_salary': profile.monthly_salary,
                     'last_salary_payment': last_salary,
-                    'employment_type': 'Salaried Employee',
-                    'onboarding_status': onboarding.get_status_display() if hasattr(onboarding, 'get_status_display') else onboarding.status
+                    'employment_type': 'Salaried Employee'
                 }
-        except EmployeeOnboarding.DoesNotExist:
-            # No onboarding record, but still salaried - show basic info
-            from .models import SalaryPayment
-            last_salary = SalaryPayment.objects.filter(user=user).order_by('-month_year').first()
-            salary_info = {
-                'job_role': profile.job_role,
-                'monthly_salary': profile.monthly_salary,
-                'last_salary_payment': last_salary,
-                'employment_type': 'Salaried Employee'
-            }
 
-    context = {
-        'user': user,
-        'profile': profile,
-        'today_record': today_record,
-        'attendance_status': attendance_status,
-        'total_balance': total_balance,
-        'recent_records': recent_records,
-        'recent_adjustments': recent_adjustments,
-        'balance_changes': balance_changes,
-        'payment_records': payment_records,
-        'all_activities': all_activities,
-        'salary_info': salary_info,
-    }
+        return {
+            'profile': profile,
+            'today_record': today_record,
+            'attendance_status': attendance_status,
+            'total_balance': profile.balance,
+            'all_activities': all_activities,
+            'salary_info': salary_info,
+        }
+
+    # Cached per user until any of their records, balance or profile change
+    context = dict(cached_for_user(user.id, f'dashboard:{today.isoformat()}', build))
+    context['user'] = user
 
     return render(request, 'attendance/dashboard.html', context)
 
 @login_required
 def view_attendance(request):
     user = request.user
-    # Optimize query with select_related for event_fk
-    records = AttendanceRecord.objects.filter(user=user).select_related('event_fk').order_by('-date')
-    
-    # Get balance adjustments made by admin - with error handling
-    try:
-        adjustments = BalanceAdjustment.objects.filter(user=user).select_related('adjusted_by').order_by('-date')
-    except Exception:
-        adjustments = []
-        messages.warning(request, "Could not load adjustment history.")
-    
-    # Get total balance from Profile - ensure it exists
-    profile, created = Profile.objects.get_or_create(user=user)
-    total_balance = profile.balance
-    
-    # Get salary info and payment history for salaried employees
-    salary_payments = []
-    monthly_salary = None
-    if profile.employment_type == 'salaried':
-        from .models import SalaryPayment
-        monthly_salary = profile.monthly_salary
-        salary_payments = SalaryPayment.objects.filter(user=user).order_by('-month_year')
-    
-    return render(request, 'attendance/view_attendance.html', {
-        'records': records,
-        'adjustments': adjustments,
-        'total_balance': total_balance,
-        'salary_payments': salary_payments,
-        'monthly_salary': monthly_salary,
-        'is_salaried': profile.employment_type == 'salaried'
-    })
+
+    def build():
+        # Optimize query with select_related for event_fk
+        records = list(AttendanceRecord.objects.filter(user=user).select_related('event_fk').order_by('-date'))
+        adjustments = list(BalanceAdjustment.objects.filter(user=user).select_related('adjusted_by').order_by('-date'))
+
+        # Get total balance from Profile - ensure it exists
+        profile, created = Profile.objects.get_or_create(user=user)
+
+        # Get salary info and payment history for salaried employees
+        salary_payments = []
+        monthly_salary = None
+        if profile.employment_type == 'salaried':
+            from .models import SalaryPayment
+            monthly_salary = profile.monthly_salary
+            salary_payments = list(SalaryPayment.objects.filter(user=user).select_related('paid_by').order_by('-month_year'))
+
+        return {
+            'records': records,
+            'adjustments': adjustments,
+            'total_balance': profile.balance,
+            'salary_payments': salary_payments,
+            'monthly_salary': monthly_salary,
+            'is_salaried': profile.employment_type == 'salaried'
+        }
+
+    return render(request, 'attendance/view_attendance.html', cached_for_user(user.id, 'view_attendance', build))
 
 
 @login_required
@@ -394,13 +427,14 @@ def mark_attendance(request):
     except AttributeError:
         profile = Profile.objects.create(user=user)
 
-    # Check if record exists for today - limit to once per day
-    try:
-        record = AttendanceRecord.objects.get(user=user, date=today)
-        messages.warning(request, "You have already marked attendance today. You can edit it in your records if needed.")
+    already_marked = "You have already marked attendance today. You can edit it in your records if needed."
+    record = AttendanceRecord(user=user, date=today)
+
+    # Once per day is enforced by the (user, date) unique constraint when saving;
+    # this check only saves the user filling in the form for nothing
+    if request.method != "POST" and AttendanceRecord.objects.filter(user=user, date=today).exists():
+        messages.warning(request, already_marked)
         return redirect('view_attendance')
-    except AttendanceRecord.DoesNotExist:
-        record = AttendanceRecord(user=user, date=today)
 
     if request.method == "POST":
         # Handle event selection - either from dropdown or custom name
@@ -410,9 +444,10 @@ def mark_attendance(request):
         # Validate and set event
         if event_name_input:
             # User typed a custom event name
-            event, _ = Event.objects.get_or_create(
-                name=event_name_input,
-                date=today,
+            # Resolves to an existing event whose name only differs in case/punctuation
+            event, _ = find_or_create_event(
+                event_name_input,
+                today,
                 defaults={'location': 'Custom Event', 'description': 'User-entered event'}
             )
             record.event_fk = event
@@ -464,20 +499,23 @@ def mark_attendance(request):
         current_time_local = current_time_aware.astimezone(timezone.get_current_timezone())
         record.check_in_time = current_time_local.time()
         
-        # Calculate amount_paid based on employment type
-        # Salaried: Only overtime (no 1000 KSH base)
-        # Hourly: Base 1000 KSH + overtime
-        if profile.employment_type == 'salaried':
-            # Salaried: Only overtime amount
-            record.amount_paid = record.overtime_hours * 100
-        else:
-            # Hourly: Base + overtime
-            record.amount_paid = 1000 + (record.overtime_hours * 100)
+        # Price the day from the rate card (salaried staff are paid overtime only by default)
+        record.amount_paid = attendance_amount(
+            profile.employment_type, record.overtime_hours,
+            job_role=profile.job_role, event_id=record.event_fk_id, date=record.date
+        )
         
         # Store original overtime hours on first creation
         record.original_overtime_hours = record.overtime_hours
         
-        record.save()
+        # A single INSERT; a double submit or a second worker hits the unique
+        # constraint and only its savepoint is rolled back
+        try:
+            with transaction.atomic():
+                record.save(force_insert=True)
+        except IntegrityError:
+            messages.warning(request, already_marked)
+            return redirect('view_attendance')
         
         messages.success(request, "Attendance marked successfully!")
         return redirect('dashboard')
@@ -490,6 +528,41 @@ def mark_attendance(request):
         'today': today
     })
 
+# Offline submissions accepted per sync request
+ATTENDANCE_SYNC_MAX_BATCH = 50
+
+
+@login_required
+@require_http_methods(["POST"])
+def sync_attendance(request):
+    """
+    Apply attendance queued by mark_attendance.html while the phone was offline.
+    Body: {"submissions": [{"idempotency_key", "checked_in_at", "event_fk" or "event_name", "overtime_hours"}]}
+    Safe to retry: submissions already applied come back as 'duplicate'.
+    """
+    try:
+        submissions = json.loads(request.body)['submissions']
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'success': False, 'error': 'Expected JSON with a submissions list'}, status=400)
+    if not isinstance(submissions, list) or not all(isinstance(item, dict) for item in submissions):
+        return JsonResponse({'success': False, 'error': 'submissions must be a list of objects'}, status=400)
+    if len(submissions) > ATTENDANCE_SYNC_MAX_BATCH:
+        return JsonResponse({'success': False, 'error': f'At most {ATTENDANCE_SYNC_MAX_BATCH} submissions per request'}, status=400)
+
+    results = sync_offline_submissions(request.user, submissions)
+    return JsonResponse({'success': True, 'results': results})
+
+
+def attendance_service_worker(request):
+    """
+    Service worker that keeps a copy of the mark attendance page so it opens
+    without signal. Served from /attendance/ so its scope covers the page.
+    """
+    response = render(request, 'attendance/attendance_sw.js', content_type='application/javascript')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
 @login_required
 def edit_attendance(request, record_id):
     record = get_object_or_404(AttendanceRecord, pk=record_id, user=request.user)
@@ -514,9 +587,10 @@ def edit_attendance(request, record_id):
         # Validate and set event
         if event_name_input:
             # User typed a custom event name
-            event, _ = Event.objects.get_or_create(
-                name=event_name_input,
-                date=record.date,
+            # Resolves to an existing event whose name only differs in case/punctuation
+            event, _ = find_or_create_event(
+                event_name_input,
+                record.date,
                 defaults={'location': 'Custom Event', 'description': 'User-entered event'}
             )
             record.event_fk = event
@@ -533,11 +607,10 @@ def edit_attendance(request, record_id):
 
         # Store the old amount earned based on employment type
         try:
-            employment_type = request.user.profile.employment_type
+            profile = request.user.profile
         except AttributeError:
             # Profile doesn't exist, create it
             profile, _ = Profile.objects.get_or_create(user=request.user)
-            employment_type = profile.employment_type
         
         old_overtime = record.overtime_hours
         old_earned = record.amount_paid
@@ -545,11 +618,11 @@ def edit_attendance(request, record_id):
         # Update record with new overtime
         record.overtime_hours = overtime_hours
         
-        # Calculate NEW earned amount based on employment type
-        if employment_type == 'salaried':
-            new_earned = overtime_hours * 100
-        else:
-            new_earned = 1000 + (overtime_hours * 100)
+        # Calculate NEW earned amount from the rate card for the record's day and event
+        new_earned = attendance_amount(
+            profile.employment_type, overtime_hours,
+            job_role=profile.job_role, event_id=record.event_fk_id, date=record.date
+        )
         
         # Update amount_paid to the new earned amount
         # The balance signal will handle the recalculation properly
@@ -570,121 +643,343 @@ def edit_attendance(request, record_id):
             messages.success(request, f"Attendance updated! Overtime changed from {old_overtime}h to {overtime_hours}h.")
         return redirect('view_attendance')
 
-    events = Event.objects.all().order_by('-date')
-    return render(request, 'attendance/edit_attendance.html', {'record': record, 'events': events})
+    return render(request, 'attendance/edit_attendance.html', {'record': record})
 
 def is_admin(user):
     return user.is_superuser
 
+
+def is_events_manager(user):
+    return user.is_superuser or user.groups.filter(name='Events Manager').exists()
+
+
+@login_required
+@user_passes_test(is_admin)
+def cache_stats(request):
+    """Hit/miss counters for this worker's shared two-level cache"""
+    return JsonResponse(shared_cache.stats())
+
+
+@login_required
+@user_passes_test(is_admin)
+def mpesa_settlement_stats(request):
+    """How long M-Pesa payments take to settle, and how many are still pending (?days=, default 7)"""
+    from .reconcile_utils import settlement_metrics
+    try:
+        days = max(int(request.GET.get('days', 7)), 1)
+    except ValueError:
+        return JsonResponse({'error': 'days must be a number'}, status=400)
+    return JsonResponse(settlement_metrics(timezone.now() - datetime.timedelta(days=days)))
+
+
+ADMIN_DASHBOARD_PAGE_SIZE = 50
+MANAGE_BALANCES_PAGE_SIZE = 50
+
+# ?sort= values accepted by admin_dashboard
+ADMIN_DASHBOARD_SORTS = {
+    'username': ('username',),
+    'balance': ('profile__balance', 'username'),
+    '-balance': ('-profile__balance', 'username'),
+    'last_attendance': (F('last_attendance').asc(nulls_first=True), 'username'),
+    '-last_attendance': (F('last_attendance').desc(nulls_last=True), 'username'),
+}
+
+
+def _create_missing_profiles(users):
+    """Create profiles for any of these users that don't have one yet, in one INSERT"""
+    missing = users.filter(profile__isnull=True).values_list('pk', flat=True)
+    Profile.objects.bulk_create([Profile(user_id=pk) for pk in missing], ignore_conflicts=True)
+
+
+def _apply_posted_adjustments(request, users, default_reason):
+    """
+    Save the adjustment_<id>/reason_<id> grid posted by the balance pages.
+    Only filled-in rows for users in the given queryset are considered.
+    """
+    amounts = {}
+    for key, value in request.POST.items():
+        user_id = key[len('adjustment_'):]
+        if key.startswith('adjustment_') and user_id.isdigit() and value.strip():
+            amounts[int(user_id)] = value
+    
+    rows = [
+        {'user': user, 'amount': amounts[user.id], 'reason': request.POST.get(f'reason_{user.id}')}
+        for user in users.filter(pk__in=amounts.keys()).order_by('username')
+    ]
+    return apply_bulk_adjustments(rows, request.user, default_reason)
+
 @user_passes_test(is_admin)
 def admin_dashboard(request):
     users = User.objects.filter(is_superuser=False).exclude(username='admin')
     
     if request.method == 'POST':
-        for user in users:
-            user_id = str(user.id)
-            adjustment_amount = request.POST.get(f'adjustment_{user_id}')
-            
-            if adjustment_amount:
-                try:
-                    adjustment_amount = float(adjustment_amount)
-                    
-                    # Create BalanceAdjustment record
-                    BalanceAdjustment.objects.create(
-                        user=user,
-                        adjusted_by=request.user,
-                        amount=adjustment_amount,
-                        reason=request.POST.get(f'reason_{user_id}', 'Admin adjustment')
-                    )
-                    
-                    # Signal will automatically recalculate balance
-                    # Balance = sum of all unpaid attendance + sum of all adjustments
-                    
-                    messages.success(request, f"Balance adjusted for {user.username}")
-                    
-                except (ValueError, TypeError):
-                    messages.error(request, f"Invalid adjustment amount for {user.username}")
+        results = _apply_posted_adjustments(request, users, 'Admin adjustment')
+        
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return JsonResponse({
+                'success': all(result['status'] == 'saved' for result in results),
+                'results': results
+            })
+        
+        for result in results:
+            if result['status'] == 'saved':
+                messages.success(request, f"Balance adjusted for {result['username']}")
+            else:
+                messages.error(request, result['error'])
         
         return redirect('admin_dashboard')
 
-    # Get user data with optimized queries
-    user_data = []
-    users = users.prefetch_related('profile')  # Prefetch profile to avoid N+1 queries
+    _create_missing_profiles(users)
+    eligible_users = users
+    
+    # One annotated query for the table: latest attendance via correlated subqueries,
+    # last 5 adjustments per user via a window-limited prefetch
+    latest = AttendanceRecord.objects.filter(user=OuterRef('pk')).order_by('-date', '-check_in_time')
+    recent_adjustments = BalanceAdjustment.objects.select_related('adjusted_by').annotate(
+        row_number=Window(RowNumber(), partition_by=F('user'), order_by=F('date').desc())
+    ).filter(row_number__lte=5).order_by('-date')
+    
+    users = users.select_related('profile').annotate(
+        last_attendance=Subquery(latest.values('date')[:1]),
+        last_check_in=Subquery(latest.values('check_in_time')[:1]),
+        last_event_name=Subquery(latest.values('event_fk__name')[:1]),
+        last_overtime_hours=Subquery(latest.values('overtime_hours')[:1]),
+        last_amount_paid=Subquery(latest.values('amount_paid')[:1]),
+        last_is_paid=Subquery(latest.values('is_paid')[:1]),
+    ).prefetch_related(
+        Prefetch('balance_adjustments', queryset=recent_adjustments, to_attr='recent_adjustments')
+    )
+    
+    sort = request.GET.get('sort', 'username')
+    users = users.order_by(*ADMIN_DASHBOARD_SORTS.get(sort, ADMIN_DASHBOARD_SORTS['username']))
+    page_obj = Paginator(users, ADMIN_DASHBOARD_PAGE_SIZE).get_page(request.GET.get('page'))
     
-    for user in users:
-        profile, _ = Profile.objects.get_or_create(user=user)
-        if _:
-            profile.balance = 0
-            profile.save()
-            
-        # Use select_related for event_fk to reduce queries
-        latest_record = AttendanceRecord.objects.filter(user=user).select_related('event_fk').order_by('-date').first()
-        recent_adjustments = BalanceAdjustment.objects.filter(user=user).select_related('adjusted_by').order_by('-date')[:5]
-        
+    user_data = []
+    for user in page_obj:
+        latest_record = None
+        if user.last_attendance:
+            latest_record = {
+                'date': user.last_attendance,
+                'check_in_time': user.last_check_in,
+                'event': user.last_event_name,
+                'overtime_hours': user.last_overtime_hours,
+                'amount_paid': user.last_amount_paid,
+                'is_paid': user.last_is_paid,
+            }
         user_data.append({
             'user': user,
-            'profile': profile,
-            'total_balance': profile.balance,
+            'profile': user.profile,
+            'total_balance': user.profile.balance,
             'latest_record': latest_record,
-            'recent_adjustments': recent_adjustments,
+            'recent_adjustments': user.recent_adjustments,
         })
 
     context = {
-        'user_data': user_data
+        'user_data': user_data,
+        'page_obj': page_obj,
+        'sort': sort,
+        'total_users': page_obj.paginator.count,
+        'total_balance': Profile.objects.filter(user__in=eligible_users).aggregate(total=Sum('balance'))['total'] or 0,
     }
     return render(request, 'attendance/admin_dashboard.html', context)
 
+@login_required
+@user_passes_test(is_admin)
+def export_data(request):
+    """CSV export: short ranges stream straight to the browser, long ones are prepared in the background"""
+    params = request.POST if request.method == 'POST' else request.GET
+    form = ExportForm(params or None)
+    if not form.is_valid():
+        if request.method == 'POST':
+            return JsonResponse({'success': False, 'error': form.errors.get_json_data()}, status=400)
+        return render(request, 'attendance/export_data.html', {
+            'form': form,
+            'stream_max_days': settings.EXPORT_STREAM_MAX_DAYS,
+        })
+
+    data = form.cleaned_data
+    kind, start, end, username = data['kind'], data['start'], data['end'], data['username'] or None
+    long_range = (end - start).days + 1 > settings.EXPORT_STREAM_MAX_DAYS
+
+    if request.method == 'POST' or long_range:
+        token = prepare_export(kind, start, end, request.user, username)
+        status_url = reverse('export_status', args=[token])
+        if request.method == 'POST':
+            return JsonResponse({'success': True, 'token': token, 'status_url': status_url}, status=202)
+        messages.info(request, "That range is large, so it is being prepared in the background.")
+        return render(request, 'attendance/export_data.html', {
+            'form': form,
+            'stream_max_days': settings.EXPORT_STREAM_MAX_DAYS,
+            'status_url': status_url,
+        })
+
+    response = StreamingHttpResponse(stream_csv(export_rows(kind, start, end, username)), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{export_filename(kind, start, end, username)}"'
+    return response
+
+
+def _own_export(request, token):
+    job = get_export_job(token)
+    if job is None or job.requested_by_id != request.user.id:
+        raise Http404("Export not found or expired")
+    return job
+
+
+@login_required
+@user_passes_test(is_admin)
+def export_status(request, token):
+    """Polled by the export page until a prepared export is ready"""
+    job = _own_export(request, token)
+    payload = {'status': job.status, 'filename': job.filename, 'rows': job.rows}
+    if job.status == 'ready':
+        payload['download_url'] = reverse('export_download', args=[token])
+    elif job.status == 'failed':
+        payload['error'] = job.error or 'Export failed'
+    return JsonResponse(payload)
+
+
+@login_required
+@user_passes_test(is_admin)
+def export_download(request, token):
+    job = _own_export(request, token)
+    if job.status != 'ready':
+        raise Http404("Export is not ready")
+    try:
+        handle = open(export_file_path(token), 'rb')
+    except FileNotFoundError:
+        raise Http404("Export file has expired")
+    return FileResponse(handle, as_attachment=True, filename=job.filename, content_type='text/csv')
+
+@login_required
+@user_passes_test(is_admin)
+def disbursements(request):
+    """Pay everyone owed from balances or approved reimbursements as one batch of STK pushes"""
+    source = request.POST.get('source') or request.GET.get('source') or 'balance'
+    if source not in dict(DisbursementBatch.SOURCE_CHOICES):
+        source = 'balance'
+
+    if request.method == 'POST':
+        form = DisbursementForm(request.POST)
+        if form.is_valid():
+            try:
+                batch = create_batch(
+                    form.cleaned_data['source'],
+                    created_by=request.user,
+                    user_ids=[user.pk for user in form.cleaned_data['users']],
+                    notes=form.cleaned_data['notes']
+                )
+            except ValidationError as e:
+                messages.error(request, e.messages[0])
+            else:
+                start_batch(batch)
+                messages.success(request, f"Sending {batch.payments.count()} payments.")
+                return redirect('disbursement_detail', batch_id=batch.pk)
+        else:
+            messages.error(request, "Pick at least one person to pay.")
+
+    legs = collect_legs(source)
+    users = User.objects.in_bulk({leg['user_id'] for leg in legs})
+    for leg in legs:
+        leg['user'] = users[leg['user_id']]
+    return render(request, 'attendance/disbursements.html', {
+        'source': source,
+        'sources': DisbursementBatch.SOURCE_CHOICES,
+        'legs': legs,
+        'total_amount': sum((leg['amount'] for leg in legs), Decimal('0')),
+        'batches': DisbursementBatch.objects.select_related('created_by')[:10],
+    })
+
+
+@login_required
+@user_passes_test(is_admin)
+def disbursement_detail(request, batch_id):
+    batch = get_object_or_404(DisbursementBatch, pk=batch_id)
+    return render(request, 'attendance/disbursement_detail.html', {
+        'batch': batch,
+        'progress': batch_progress(batch),
+        'payments': batch.payments.select_related('user').order_by('pk'),
+    })
+
+
+@login_required
+@user_passes_test(is_admin)
+def disbursement_status(request, batch_id):
+    """Polled by the disbursement page while pushes are sent and settled"""
+    batch = get_object_or_404(DisbursementBatch, pk=batch_id)
+    progress = batch_progress(batch)
+    progress['by_status'] = {
+        status: {'count': row['count'], 'amount': str(row['amount'])}
+        for status, row in progress['by_status'].items()
+    }
+    progress['paid_amount'] = str(progress['paid_amount'])
+    progress['total_amount'] = str(progress['total_amount'])
+    progress['payments'] = list(batch.payments.order_by('pk').values(
+        'id', 'status', 'attempts', 'result_description', 'receipt_number'
+    ))
+    return JsonResponse(progress)
+
 @user_passes_test(is_admin)
 def manage_balances(request):
     """Dedicated view for managing user balances"""
     users = User.objects.filter(is_superuser=False).exclude(username='admin')
     
     if request.method == 'POST':
-        for user in users:
-            user_id = str(user.id)
-            adjustment_amount = request.POST.get(f'adjustment_{user_id}')
-            reason = request.POST.get(f'reason_{user_id}', 'Balance adjustment')
-            
-            if adjustment_amount:
-                try:
-                    adjustment_amount = float(adjustment_amount)
-                    
-                    # Create BalanceAdjustment record with correct field names
-                    BalanceAdjustment.objects.create(
-                        user=user,
-                        adjusted_by=request.user,
-                        amount=adjustment_amount,
-                        reason=reason
-                    )
-                    
-                    # Signal will automatically recalculate balance
-                    
-                except (ValueError, TypeError):
-                    messages.error(request, f"Invalid adjustment amount for {user.username}")
+        results = _apply_posted_adjustments(request, users, 'Balance adjustment')
+        
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return JsonResponse({
+                'success': all(result['status'] == 'saved' for result in results),
+                'results': results
+            })
+        
+        errors = [result['error'] for result in results if result['status'] != 'saved']
+        for error in errors:
+            messages.error(request, error)
         
-        messages.success(request, "All balance adjustments have been saved successfully!")
+        if not errors:
+            messages.success(request, "All balance adjustments have been saved successfully!")
+        elif len(errors) < len(results):
+            messages.success(request, f"{len(results) - len(errors)} balance adjustments saved.")
         return redirect('manage_balances')
 
-    # Prepare user balance data
-    user_balance_data = []
-    total_balance = 0
-    
-    for user in users:
-        profile, _ = Profile.objects.get_or_create(user=user)
-        if _:
-            profile.balance = 0
-            profile.save()
-        
-        user_balance_data.append({
-            'user': user,
-            'profile': profile,
-            'balance': profile.balance,
+    _create_missing_profiles(users)
+    
+    filter_form = BalanceFilterForm(request.GET or None)
+    users = filter_form.filter(users).select_related('profile')
+    
+    # Per-role subtotals in one grouped query; the grand totals are their sum
+    role_labels = dict(Profile.JOB_ROLES)
+    role_totals = []
+    total_balance = Decimal('0.00')
+    total_users = 0
+    for row in users.values('profile__job_role').annotate(
+        balance=Sum('profile__balance'), users=Count('pk')
+    ).order_by('profile__job_role'):
+        role_totals.append({
+            'job_role': role_labels.get(row['profile__job_role'], 'Unassigned'),
+            'balance': row['balance'] or Decimal('0.00'),
+            'users': row['users'],
         })
-        total_balance += float(profile.balance)
+        total_balance += row['balance'] or 0
+        total_users += row['users']
+    
+    page_obj = Paginator(users.order_by('username'), MANAGE_BALANCES_PAGE_SIZE).get_page(request.GET.get('page'))
+    user_balance_data = [
+        {'user': user, 'profile': user.profile, 'balance': user.profile.balance}
+        for user in page_obj
+    ]
+    
+    query_string = request.GET.copy()
+    query_string.pop('page', None)
 
     context = {
         'user_balance_data': user_balance_data,
         'total_balance': total_balance,
+        'total_users': total_users,
+        'role_totals': role_totals,
+        'filter_form': filter_form,
+        'page_obj': page_obj,
+        'query_string': query_string.urlencode(),
     }
     return render(request, 'attendance/manage_balances.html', context)
 
@@ -738,10 +1033,59 @@ def event_detail(request, pk):
     
     context = {
         'event': event,
+        'is_events_manager': is_events_manager(request.user),
     }
     return render(request, 'attendance/event_detail.html', context)
 
 
+@login_required
+@user_passes_test(is_events_manager)
+def event_check_in(request, pk):
+    """
+    Check in an event's crew for today in one request.
+    GET shows the crew; POST takes JSON {"user_ids": [...], "overtime_hours": 0}
+    and returns a result per user.
+    """
+    event = get_object_or_404(Event, pk=pk)
+
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            user_ids = [int(user_id) for user_id in data.get('user_ids', [])]
+            overtime_hours = int(data.get('overtime_hours') or 0)
+        except (ValueError, TypeError, AttributeError):
+            return JsonResponse({'success': False, 'error': 'Expected JSON with a list of user_ids'}, status=400)
+        if not user_ids:
+            return JsonResponse({'success': False, 'error': 'No crew members selected'}, status=400)
+        if overtime_hours < 0:
+            return JsonResponse({'success': False, 'error': 'Overtime hours cannot be negative'}, status=400)
+
+        results = check_in_crew(event, user_ids, overtime_hours=overtime_hours)
+        checked_in = sum(1 for result in results if result['status'] == 'checked_in')
+        logger.info(f"{request.user.username} checked in {checked_in} crew for event {event.pk}")
+        return JsonResponse({'success': True, 'checked_in': checked_in, 'results': results})
+
+    today = timezone.localdate()
+    setup_ids = set(event.setup_crew.values_list('id', flat=True))
+    crew = User.objects.filter(
+        Q(setup_events=event) | Q(event_crew_assignments=event)
+    ).distinct().order_by('first_name', 'username')
+    checked_in_ids = set(
+        AttendanceRecord.objects.filter(user__in=crew, date=today).values_list('user_id', flat=True)
+    )
+    crew_rows = [
+        {'user': member, 'role': 'Setup' if member.id in setup_ids else 'Event Day',
+         'checked_in': member.id in checked_in_ids}
+        for member in crew
+    ]
+
+    return render(request, 'attendance/event_check_in.html', {
+        'event': event,
+        'crew_rows': crew_rows,
+        'today': today,
+    })
+
+
 @login_required
 @user_passes_test(is_admin)
 def event_edit(request, pk):
@@ -923,7 +1267,7 @@ def send_reimbursement_stk_push(request, reimbursement_id):
     reimbursement = get_object_or_404(ExpenseReimbursement, pk=reimbursement_id)
     
     if request.method == 'POST':
-        from .mpesa_utils import MpesaClient
+        from .mpesa_utils import start_stk_push
         
         try:
             # Get phone number from reimbursement user's profile
@@ -949,28 +1293,27 @@ def send_reimbursement_stk_push(request, reimbursement_id):
             else:
                 phone = '254' + phone
             
-            mpesa_client = MpesaClient()
-            result = mpesa_client.initiate_stk_push(
-                user=target_user,
-                phone_number=phone,
-                amount=int(amount),
-                payment_purpose=f'Reimbursement: {reimbursement.description[:20]}'
+            # The checkout request ID is stored on the reimbursement once M-Pesa accepts the push
+            result = start_stk_push(
+                target_user,
+                phone,
+                int(amount),
+                f'Reimbursement: {reimbursement.description[:20]}',
+                reimbursement_id=reimbursement.id
             )
             
             if result.get('success'):
-                # Store checkout request ID for tracking
-                reimbursement.checkout_request_id = result.get('checkout_request_id')
-                reimbursement.save()
-                
                 return JsonResponse({
                     'success': True,
-                    'message': 'STK push sent successfully to ' + phone,
+                    'message': ('STK push queued for ' if result['status'] == 'initiated' else 'STK push sent successfully to ') + phone,
+                    'payment_id': result['payment_id'],
+                    'status': result['status'],
                     'checkout_request_id': result.get('checkout_request_id'),
                 })
             else:
                 return JsonResponse({
                     'success': False,
-                    'error': result.get('error', 'Failed to initiate STK push')
+                    'error': result.get('error') or result.get('message', 'Failed to initiate STK push')
                 })
                 
         except Exception as e:
@@ -1157,7 +1500,7 @@ def reimbursement_action(request, reimbursement_id):
 def request_mpesa_payment(request):
     """Request payment via M-Pesa STK push"""
     if request.method == 'POST':
-        from .mpesa_utils import MpesaClient
+        from .mpesa_utils import start_stk_push
         import json
         
         try:
@@ -1187,14 +1530,8 @@ def request_mpesa_payment(request):
             else:
                 phone = '254' + phone  # Add country code
             
-            # Initiate M-Pesa payment
-            mpesa = MpesaClient()
-            result = mpesa.initiate_stk_push(
-                request.user,
-                phone,
-                amount,
-                purpose
-            )
+            # Initiate M-Pesa payment; poll check_payment_status with the payment_id for the outcome
+            result = start_stk_push(request.user, phone, amount, purpose)
             
             return JsonResponse(result)
             
@@ -1207,22 +1544,15 @@ def request_mpesa_payment(request):
 
 @csrf_exempt
 def mpesa_callback(request):
-    """Handle M-Pesa callback from STK push"""
-    from .mpesa_utils import process_mpesa_callback
-    import json
+    """Record an M-Pesa callback and acknowledge it; it is applied in the background"""
+    from .mpesa_utils import log_mpesa_callback
     
     if request.method == 'POST':
         try:
-            callback_data = json.loads(request.body)
-            success = process_mpesa_callback(callback_data)
-            
-            if success:
-                return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Success'})
-            else:
-                return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Failed'})
-                
+            log_mpesa_callback(request.body, request.META.get('REMOTE_ADDR'))
+            return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
         except Exception as e:
-            logger.error(f"Error processing M-Pesa callback: {str(e)}")
+            logger.error(f"Error recording M-Pesa callback: {str(e)}")
             return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Error'}, status=500)
     
     return JsonResponse({'error': 'POST required'}, status=405)
@@ -1231,8 +1561,6 @@ def mpesa_callback(request):
 @login_required
 def check_payment_status(request):
     """Check status of M-Pesa payment"""
-    from .mpesa_utils import MpesaClient
-    
     if request.method == 'GET':
         try:
             payment_id = request.GET.get('payment_id')
@@ -1249,6 +1577,8 @@ def check_payment_status(request):
             return JsonResponse({
                 'payment_id': payment.id,
                 'status': payment.status,
+                'checkout_request_id': payment.checkout_request_id,
+                'result_description': payment.result_description or None,
                 'amount': str(payment.amount),
                 'receipt_number': payment.receipt_number or None,
                 'completed_at': payment.completed_at.isoformat() if payment.completed_at else None
@@ -1299,7 +1629,7 @@ def stk_push_modal(request):
         return render(request, 'attendance/admin/stk_push_modal.html', context)
     
     elif request.method == 'POST':
-        from .mpesa_utils import MpesaClient
+        from .mpesa_utils import start_stk_push
         
         try:
             phone = request.POST.get('phone')
@@ -1337,25 +1667,21 @@ def stk_push_modal(request):
             else:
                 target_user = request.user
             
-            mpesa_client = MpesaClient()
-            result = mpesa_client.initiate_stk_push(
-                user=target_user,
-                phone_number=phone,
-                amount=amount_int,
-                payment_purpose=purpose
-            )
+            result = start_stk_push(target_user, phone, amount_int, purpose)
             
             if result.get('success'):
                 return JsonResponse({
                     'success': True,
                     'message': 'STK push sent successfully. Customer will receive prompt on their phone.',
+                    'payment_id': result['payment_id'],
+                    'status': result['status'],
                     'checkout_request_id': result.get('checkout_request_id'),
                     'merchant_request_id': result.get('merchant_request_id'),
                 })
             else:
                 return JsonResponse({
                     'success': False,
-                    'error': result.get('error', 'Failed to initiate STK push')
+                    'error': result.get('error') or result.get('message', 'Failed to initiate STK push')
                 })
                 
         except Exception as e:
@@ -1370,13 +1696,38 @@ def check_stk_status(request):
         return JsonResponse({'success': False, 'error': 'Unauthorized'}, status=403)
     
     checkout_id = request.GET.get('checkout_id')
+    payment_id = request.GET.get('payment_id')
+    if payment_id:
+        # Queued pushes have no checkout ID yet; report the stored status, and
+        # only ask M-Pesa about a pending push when refresh=1
+        payment = MpesaPayment.objects.filter(pk=payment_id).first()
+        if payment is None:
+            return JsonResponse({'success': False, 'error': 'Payment not found'}, status=404)
+        stored = {
+            'success': payment.status != 'failed',
+            'payment_id': payment.id,
+            'status': payment.status,
+            'checkout_request_id': payment.checkout_request_id,
+            'message': payment.result_description,
+        }
+        if payment.status != 'pending' or request.GET.get('refresh') != '1':
+            return JsonResponse(stored)
+        checkout_id = payment.checkout_request_id
     if not checkout_id:
-        return JsonResponse({'success': False, 'error': 'Checkout ID required'})
+        return JsonResponse({'success': False, 'error': 'Checkout ID or payment ID required'})
     
     try:
-        from .mpesa_utils import MpesaClient
-        mpesa_client = MpesaClient()
+        from .mpesa_utils import get_mpesa_client, apply_payment_result
+        mpesa_client = get_mpesa_client()
         result = mpesa_client.query_payment_status(checkout_id)
+        # Apply the answer like the reconciler does; Daraja answers with an
+        # error while the customer still has the prompt open
+        payment = MpesaPayment.objects.filter(checkout_request_id=checkout_id).only('pk').first()
+        if payment is not None and 'ResultCode' in result:
+            MpesaPayment.objects.filter(pk=payment.pk).update(checked_at=timezone.now())
+            apply_payment_result(payment.pk, int(result['ResultCode']), result.get('ResultDesc'), via='query')
+            result['payment_id'] = payment.pk
+            result['status'] = MpesaPayment.objects.filter(pk=payment.pk).values_list('status', flat=True).get()
         return JsonResponse(result)
     except Exception as e:
         logger.error(f"Error checking STK status: {str(e)}")
@@ -1386,18 +1737,20 @@ def check_stk_status(request):
 @login_required
 def my_assignments(request):
     """View all events where user is assigned as crew member"""
-    from django.db.models import Q
-    
     user = request.user
-    
-    # Get all events where user is in setup_crew or event_crew using Q objects
-    # This uses the ManyToManyField to properly filter
-    all_events = Event.objects.filter(
-        Q(setup_crew=user) | Q(event_crew=user)
-    ).distinct().prefetch_related('setup_crew', 'event_crew').order_by('-date')
-    
-    context = {
-        'events': all_events,
-    }
-    
+
+    def build():
+        # Events where the user is in setup_crew or event_crew, one query per crew
+        setup_assignments = list(user.setup_events.order_by('-date'))
+        event_assignments = list(user.event_crew_assignments.order_by('-date'))
+        return {
+            'setup_assignments': setup_assignments,
+            'event_assignments': event_assignments,
+            'setup_count': len(setup_assignments),
+            'event_count': len(event_assignments),
+            'all_count': len(setup_assignments) + len(event_assignments),
+        }
+
+    context = cached_for_user(user.id, 'my_assignments', build)
+
     return render(request, 'attendance/my_assignments.html', context)
\ No newline at end of file
@@ -5,6 +5,7 @@ pip install -r requirements.txt
 
 python manage.py collectstatic --noinput
 python manage.py migrate
+python manage.py createcachetable
 
 # Auto-create admin user if not exists
 echo "=== Creating default admin user ==="
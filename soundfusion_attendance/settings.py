@@ -140,19 +140,74 @@ os.makedirs(MEDIA_ROOT, exist_ok=True)
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Caching Configuration for better performance
-CACHES = {
-    'default': {
+# The default cache must be shared by every gunicorn worker: cache invalidation,
+# export status, the M-Pesa token, dispatch claims and the reconciler lock all
+# live in it. CACHE_BACKEND picks the backend:
+#   db (default, run createcachetable) | redis (CACHE_LOCATION or REDIS_URL =
+#   redis://host:6379/0) | file (CACHE_LOCATION = directory) | locmem
+# locmem is per process, so it is only for a single-process server. Tests
+# always use local memory.
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'db').lower()
+if 'test' in sys.argv:
+    CACHE_BACKEND = 'locmem'
+
+if CACHE_BACKEND == 'redis':
+    DEFAULT_CACHE = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get('CACHE_LOCATION') or os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0'),
+        'KEY_PREFIX': 'sound-fusion',
+    }
+elif CACHE_BACKEND == 'file':
+    DEFAULT_CACHE = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_LOCATION', os.path.join(BASE_DIR, '.django_cache')),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000
+        }
+    }
+elif CACHE_BACKEND == 'db':
+    DEFAULT_CACHE = {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'attendance_cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000
+        }
+    }
+else:
+    DEFAULT_CACHE = {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'sound-fusion-cache',
         'OPTIONS': {
             'MAX_ENTRIES': 1000
         }
     }
+
+CACHES = {
+    # Shared between workers (unless CACHE_BACKEND=locmem)
+    'default': DEFAULT_CACHE,
+    # Always in-process: the L1 tier of attendance.cache_utils.TwoLevelCache
+    'local': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sound-fusion-l1',
+        'OPTIONS': {
+            'MAX_ENTRIES': 500
+        }
+    },
 }
 
 # Cache timeout (1 hour)
 CACHE_TIMEOUT = 3600
 
+# Threads for in-process background work (prepared exports, M-Pesa dispatch)
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', 4))
+
+# Date ranges longer than this are exported with "prepare and download" instead of streaming
+EXPORT_STREAM_MAX_DAYS = int(os.environ.get('EXPORT_STREAM_MAX_DAYS', 92))
+
+# How long the in-process L1 copy of shared data is trusted before re-reading L2.
+# Invalidations reach other workers' L1 within this window.
+L1_CACHE_TIMEOUT = int(os.environ.get('L1_CACHE_TIMEOUT', 30))
+
 # Login URL - redirect to custom login path instead of default /accounts/login/
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'dashboard'
@@ -207,6 +262,31 @@ MPESA_ENVIRONMENT = os.environ.get('MPESA_ENVIRONMENT', 'sandbox')  # sandbox or
 # M-Pesa callback URL - Point to your hosted domain
 MPESA_CALLBACK_URL = os.environ.get('MPESA_CALLBACK_URL', 'https://sound-fusion-attendance.onrender.com/api/mpesa/callback/')
 
+# Send STK pushes from the background executor so payment views return at once
+# (the page then polls for the outcome). Set to False to send inside the request.
+MPESA_ASYNC_DISPATCH = os.environ.get('MPESA_ASYNC_DISPATCH', 'True') == 'True'
+
+# Callbacks are always logged first; this applies them in the background
+# (False applies them before the response, still after logging)
+MPESA_ASYNC_CALLBACKS = os.environ.get('MPESA_ASYNC_CALLBACKS', 'True') == 'True'
+
+# Batch disbursements: parallel STK push requests, requests per second across
+# them (keep under the Daraja app's limit) and retries of pushes that failed
+# before reaching Safaricom
+MPESA_DISBURSEMENT_CONCURRENCY = int(os.environ.get('MPESA_DISBURSEMENT_CONCURRENCY', '10'))
+MPESA_RATE_LIMIT = float(os.environ.get('MPESA_RATE_LIMIT', '5'))
+MPESA_DISBURSEMENT_RETRIES = int(os.environ.get('MPESA_DISBURSEMENT_RETRIES', '3'))
+
+# Pending payments with no callback after MPESA_RECONCILE_AFTER seconds are
+# queried by `manage.py reconcile_mpesa`; schedule it with cron (e.g. a Render
+# cron job every 5 minutes). MPESA_RECONCILE_SCHEDULER=true runs it every
+# MPESA_RECONCILE_INTERVAL seconds on a thread in each web process instead.
+MPESA_RECONCILE_SCHEDULER = os.environ.get('MPESA_RECONCILE_SCHEDULER', 'False').lower() in ('true', '1', 'yes')
+MPESA_RECONCILE_INTERVAL = int(os.environ.get('MPESA_RECONCILE_INTERVAL', '300'))
+MPESA_RECONCILE_AFTER = int(os.environ.get('MPESA_RECONCILE_AFTER', '120'))
+MPESA_RECONCILE_BATCH = int(os.environ.get('MPESA_RECONCILE_BATCH', '200'))
+MPESA_RECONCILE_CONCURRENCY = int(os.environ.get('MPESA_RECONCILE_CONCURRENCY', '5'))
+
 # Additional security headers for production
 if not DEBUG:
     SECURE_HSTS_SECONDS = 31536000  # 1 year
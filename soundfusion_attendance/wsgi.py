@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'soundfusion_attendance.settings')
 
 application = get_wsgi_application()
+
+# Only starts a thread when MPESA_RECONCILE_SCHEDULER is on; otherwise cron runs
+# `manage.py reconcile_mpesa` (see attendance/reconcile_utils.py)
+from attendance.reconcile_utils import start_scheduler
+
+start_scheduler()